@@ -0,0 +1,385 @@
+"""Инкрементальные резервные копии с хранением по содержимому.
+
+Каждый файл хранится один раз в objects/<xx>/<sha256> (сжатым gzip), снимок - JSON-манифест
+путь -> хэш, размер, mtime. Файлы, у которых размер и mtime совпадают с прошлым снимком,
+не перечитываются, поэтому повторный снимок стоит немногим больше обхода каталогов.
+Архив для отправки собирается из объектов потоком, без временной копии на диске.
+Для больших установок export() делит снимок на тома ограниченного размера, сжимает их
+параллельно и отправляет каждый том сразу по готовности вместе с манифестом и SHA-256.
+Синхронные методы BackupStore выполняются в потоке (asyncio.to_thread).
+"""
+import asyncio
+import fcntl
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytz
+
+import db
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = 'backups'
+BACKUP_SOURCES = ('files', 'users', 'awg-decode.py', 'newclient.sh', 'removeclient.sh')
+# Временные файлы, блокировки и служебные файлы SQLite (база копируется через backup API)
+SKIP_SUFFIXES = ('.tmp', '.lock', '-wal', '-shm', '-journal')
+KEEP_LAST = 10
+KEEP_DAILY = 14
+CHUNK_SIZE = 1 << 20
+PROGRESS_EVERY = 1000
+# Минимальная дата, которую можно записать в zip
+ZIP_EPOCH = 315532800
+# Бот может загрузить в Telegram файл не больше 50 МБ
+VOLUME_SIZE = 45 * 1024 * 1024
+# Тома планируются по размеру сжатых объектов, запас - на заголовки zip
+VOLUME_FILL = 0.9
+EXPORT_WORKERS = 4
+
+def volume_name(backup_id, index):
+    return f"backup_{backup_id}.vol{index:03d}.zip"
+
+def manifest_name(backup_id):
+    return f"backup_{backup_id}.manifest.json"
+
+class BackupStore:
+    def __init__(self, root=BACKUP_DIR, sources=BACKUP_SOURCES, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY):
+        self.root = root
+        self.sources = sources
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        """Блокировка хранилища: потоки одного процесса и разные процессы (bot.py, bot_manager.py).
+
+        Без неё rotate() другого процесса удалил бы объекты, которые snapshot() уже записал,
+        но на которые ещё не ссылается сохранённый манифест.
+        """
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _manifest_path(self, snapshot_id):
+        return os.path.join(self.root, 'snapshots', f"{snapshot_id}.json")
+
+    def iter_files(self):
+        for source in self.sources:
+            if os.path.isfile(source):
+                yield source
+            elif os.path.isdir(source):
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if not name.endswith(SKIP_SUFFIXES):
+                            yield os.path.join(root, name)
+
+    def _hash(self, path):
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def _add_object(self, path):
+        """Кладёт файл в хранилище, если такого содержимого ещё нет. Возвращает (хэш, размер, новый)."""
+        digest, size = self._hash(path)
+        target = self._object_path(digest)
+        if os.path.exists(target):
+            return digest, size, False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp_path, target)
+        return digest, size, True
+
+    def _add_sqlite(self, path):
+        # Копия базы через backup API согласована даже при одновременной записи ботом
+        tmp_path = os.path.join(self.root, f".{uuid.uuid4().hex[:8]}.db.tmp")
+        source = sqlite3.connect(path)
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        try:
+            return self._add_object(tmp_path)
+        finally:
+            os.remove(tmp_path)
+
+    def snapshot(self, progress=None):
+        """Создаёт снимок источников; progress(обработано файлов) вызывается каждые PROGRESS_EVERY файлов."""
+        with self.locked():
+            os.makedirs(os.path.join(self.root, 'snapshots'), exist_ok=True)
+            parent = self.latest()
+            previous = parent['files'] if parent else {}
+            files = {}
+            stats = Counter()
+            for path in self.iter_files():
+                try:
+                    stat = os.stat(path)
+                    old = previous.get(path)
+                    is_sqlite = path.endswith('.db')
+                    if (old and not is_sqlite and old['size'] == stat.st_size
+                            and old['mtime_ns'] == stat.st_mtime_ns):
+                        files[path] = old
+                        stats['unchanged'] += 1
+                    else:
+                        digest, size, new = self._add_sqlite(path) if is_sqlite else self._add_object(path)
+                        files[path] = {'hash': digest, 'size': size, 'mtime_ns': stat.st_mtime_ns, 'mode': stat.st_mode & 0o777}
+                        stats['stored' if new else 'deduplicated'] += 1
+                        if new:
+                            stats['stored_bytes'] += size
+                except (FileNotFoundError, sqlite3.Error) as e:
+                    # Файл удалили во время обхода или база недоступна - снимок без него
+                    logger.warning(f"Файл {path} пропущен в бэкапе: {str(e)}")
+                    continue
+                stats['total_bytes'] += files[path]['size']
+                if progress and len(files) % PROGRESS_EVERY == 0:
+                    progress(len(files))
+            now = datetime.now(pytz.utc)
+            snapshot_id = now.strftime('%Y%m%d-%H%M%S')
+            if parent and parent['id'] >= snapshot_id:
+                snapshot_id = f"{snapshot_id}-{uuid.uuid4().hex[:4]}"
+            manifest = {
+                'id': snapshot_id,
+                'created': now.isoformat(),
+                'parent': parent['id'] if parent else None,
+                'files': files,
+                'stats': {**stats, 'files': len(files)}
+            }
+            if not db.save_json(self._manifest_path(snapshot_id), manifest):
+                raise OSError(f"Не удалось сохранить манифест снимка {snapshot_id}")
+            logger.info(f"Снимок {snapshot_id}: файлов {len(files)}, новых объектов {stats['stored']}")
+            return manifest
+
+    def list_snapshots(self):
+        """ID снимков от старых к новым."""
+        try:
+            names = os.listdir(os.path.join(self.root, 'snapshots'))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith('.json'))
+
+    def load(self, snapshot_id):
+        return db.load_json(self._manifest_path(snapshot_id), None)
+
+    def latest(self):
+        snapshots = self.list_snapshots()
+        return self.load(snapshots[-1]) if snapshots else None
+
+    def open_object(self, digest):
+        return gzip.open(self._object_path(digest), 'rb')
+
+    def rotate(self):
+        """Оставляет keep_last последних снимков и последний снимок каждого из keep_daily дней.
+
+        Объекты, на которые не ссылается ни один оставшийся снимок, удаляются.
+        Возвращает (удалённые снимки, освобождено байт).
+        """
+        with self.locked():
+            snapshots = self.list_snapshots()
+            keep = set(snapshots[-self.keep_last:]) if self.keep_last else set()
+            days = {}
+            for snapshot_id in reversed(snapshots):
+                day = snapshot_id[:8]
+                if day not in days and len(days) < self.keep_daily:
+                    days[day] = snapshot_id
+            keep |= set(days.values())
+            removed = [snapshot_id for snapshot_id in snapshots if snapshot_id not in keep]
+            for snapshot_id in removed:
+                os.remove(self._manifest_path(snapshot_id))
+            referenced = set()
+            for snapshot_id in keep:
+                manifest = self.load(snapshot_id)
+                if manifest is None:
+                    # Нечитаемый манифест: не удаляем объекты, которые могли ему принадлежать
+                    logger.error(f"Манифест снимка {snapshot_id} не читается, очистка объектов пропущена")
+                    return removed, 0
+                referenced.update(entry['hash'] for entry in manifest['files'].values())
+            freed = 0
+            objects_dir = os.path.join(self.root, 'objects')
+            for root, _, names in os.walk(objects_dir, topdown=False):
+                for name in names:
+                    if name not in referenced:
+                        path = os.path.join(root, name)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                if root != objects_dir and not os.listdir(root):
+                    os.rmdir(root)
+            if removed:
+                logger.info(f"Удалено старых снимков: {len(removed)}, освобождено {freed} байт")
+            return removed, freed
+
+    def write_zip(self, manifest, fileobj, paths=None):
+        """Пишет zip-архив снимка (или только paths) в fileobj; поток может быть без seek (например, pipe)."""
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+            for path in sorted(manifest['files'] if paths is None else paths):
+                entry = manifest['files'][path]
+                info = zipfile.ZipInfo(path, date_time=time.localtime(max(entry['mtime_ns'] / 1e9, ZIP_EPOCH))[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = (0o100000 | entry['mode']) << 16
+                with self.open_object(entry['hash']) as src, \
+                        archive.open(info, 'w', force_zip64=entry['size'] > zipfile.ZIP64_LIMIT) as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    async def stream_zip(self, manifest, consume):
+        """Отдаёт архив снимка корутине consume(reader) через pipe, пока поток его собирает."""
+        # Ошибку посреди потока получатель увидел бы как обрезанный архив, поэтому объекты проверяются заранее
+        missing = {entry['hash'] for entry in manifest['files'].values() if not os.path.exists(self._object_path(entry['hash']))}
+        if missing:
+            raise FileNotFoundError(f"В хранилище нет объектов снимка {manifest['id']}: {len(missing)}")
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb')
+        writer = os.fdopen(write_fd, 'wb')
+
+        def produce():
+            try:
+                self.write_zip(manifest, writer)
+            finally:
+                writer.close()
+
+        producer = asyncio.create_task(asyncio.to_thread(produce))
+        try:
+            result = await consume(reader)
+        finally:
+            # Если получатель прервался, запись в закрытый pipe завершит поток с BrokenPipeError
+            reader.close()
+            try:
+                await producer
+            except BrokenPipeError:
+                pass
+        return result
+
+    def plan_volumes(self, manifest, volume_size=VOLUME_SIZE):
+        """Делит файлы снимка на тома по размеру сжатых объектов: в томе они сожмутся примерно так же."""
+        shards, current, current_size = [], [], 0
+        limit = volume_size * VOLUME_FILL
+        for path in sorted(manifest['files']):
+            size = os.path.getsize(self._object_path(manifest['files'][path]['hash']))
+            if current and current_size + size > limit:
+                shards.append(current)
+                current, current_size = [], 0
+            current.append(path)
+            current_size += size
+        if current:
+            shards.append(current)
+        return shards
+
+    def _write_volume(self, manifest, paths, volume_path, volume_size):
+        """Пишет том; если один большой файл не уместился, том режется на части .001, .002...
+
+        Возвращает [(путь части, размер, sha256)].
+        """
+        self.write_zip(manifest, volume_path, paths)
+        if os.path.getsize(volume_path) <= volume_size:
+            digest, size = self._hash(volume_path)
+            return [(volume_path, size, digest)]
+        parts = []
+        with open(volume_path, 'rb') as src:
+            while True:
+                part_path = f"{volume_path}.{len(parts) + 1:03d}"
+                digest = hashlib.sha256()
+                written = 0
+                with open(part_path, 'wb') as dst:
+                    while written < volume_size:
+                        chunk = src.read(min(CHUNK_SIZE, volume_size - written))
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        dst.write(chunk)
+                        written += len(chunk)
+                if not written:
+                    os.remove(part_path)
+                    break
+                parts.append((part_path, written, digest.hexdigest()))
+        os.remove(volume_path)
+        return parts
+
+    async def export(self, manifest, targets, volume_size=VOLUME_SIZE, workers=EXPORT_WORKERS, progress=None):
+        """Собирает тома снимка в workers потоков и отправляет каждый во все места доставки по готовности.
+
+        Последним отправляется манифест: тома с размерами и SHA-256 частей и том каждого файла.
+        На диске одновременно не больше 2 * workers томов. progress(отправлено, всего) - корутина.
+        """
+        backup_id = manifest['id']
+        shards = await asyncio.to_thread(self.plan_volumes, manifest, volume_size)
+        staging = os.path.join(self.root, 'outgoing', backup_id)
+        os.makedirs(staging, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup-volume')
+        pending = {}
+        volumes = [None] * len(shards)
+        files = {}
+        next_shard = 0
+        try:
+            while next_shard < len(shards) or pending:
+                while next_shard < len(shards) and len(pending) < workers * 2:
+                    volume_path = os.path.join(staging, volume_name(backup_id, next_shard + 1))
+                    future = loop.run_in_executor(
+                        executor, self._write_volume, manifest, shards[next_shard], volume_path, volume_size
+                    )
+                    pending[future] = next_shard
+                    next_shard += 1
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    parts = []
+                    for part_path, size, digest in future.result():
+                        part_name = os.path.basename(part_path)
+                        await asyncio.gather(*(target.put(backup_id, part_name, part_path) for target in targets))
+                        os.remove(part_path)
+                        parts.append({'name': part_name, 'size': size, 'sha256': digest})
+                    volumes[index] = {'name': volume_name(backup_id, index + 1), 'files': len(shards[index]), 'parts': parts}
+                    for path in shards[index]:
+                        files[path] = {**manifest['files'][path], 'volume': index}
+                    if progress:
+                        await progress(sum(1 for volume in volumes if volume), len(shards))
+            exported = {
+                'id': backup_id,
+                'created': manifest['created'],
+                'volume_size': volume_size,
+                'volumes': volumes,
+                'files': files,
+                'stats': manifest.get('stats', {})
+            }
+            path = os.path.join(staging, manifest_name(backup_id))
+            if not db.save_json(path, exported):
+                raise OSError(f"Не удалось записать манифест {path}")
+            await asyncio.gather(*(target.put(backup_id, manifest_name(backup_id), path) for target in targets))
+            return exported
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.to_thread(executor.shutdown, True, cancel_futures=True)
+            shutil.rmtree(staging, ignore_errors=True)
+
+def describe(manifest):
+    stats = manifest.get('stats', {})
+    return (f"Снимок {manifest['id']}: файлов {stats.get('files', 0)}, "
+            f"{stats.get('total_bytes', 0) / 1024 / 1024:.1f} МБ; "
+            f"новых {stats.get('stored', 0)} ({stats.get('stored_bytes', 0) / 1024 / 1024:.1f} МБ), "
+            f"без изменений {stats.get('unchanged', 0) + stats.get('deduplicated', 0)}")
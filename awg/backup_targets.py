@@ -0,0 +1,161 @@
+"""Места доставки томов бэкапа: Telegram, локальный каталог, S3-совместимое хранилище.
+
+У каждого места async put(backup_id, name, path) - отправить файл тома; у каталога и S3
+также get(backup_id, name, dest) для восстановления. Места задаются в config.json списком
+backup_targets, например:
+[{"type": "telegram"}, {"type": "dir", "path": "/var/backups/awg"},
+ {"type": "s3", "endpoint": "https://s3.example.com", "bucket": "awg", "access_key": "...", "secret_key": "..."}]
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime
+from urllib.parse import quote, urlparse
+
+import aiohttp
+import pytz
+from aiogram import types
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGETS = [{'type': 'telegram'}]
+S3_TIMEOUT = 600
+CHUNK_SIZE = 1 << 20
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class TelegramTarget:
+    name = 'telegram'
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def put(self, backup_id, name, path):
+        await self.bot.send_document(self.chat_id, types.InputFile(path, filename=name), caption=name)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class DirectoryTarget:
+    name = 'dir'
+
+    def __init__(self, path):
+        self.path = path
+
+    def _copy(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp_path = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+    async def put(self, backup_id, name, path):
+        await asyncio.to_thread(self._copy, path, os.path.join(self.path, backup_id, name))
+
+    async def get(self, backup_id, name, dest):
+        await asyncio.to_thread(self._copy, os.path.join(self.path, backup_id, name), dest)
+
+def sign_v4(method, url, payload_hash, access_key, secret_key, region, now=None):
+    """Заголовки запроса к S3 с подписью AWS Signature Version 4 (path-style URL без query)."""
+    now = now or datetime.now(pytz.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    parsed = urlparse(url)
+    signed_headers = 'host;x-amz-content-sha256;x-amz-date'
+    canonical_request = '\n'.join([
+        method, quote(parsed.path, safe='/~'), '',
+        f"host:{parsed.netloc}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{amz_date}\n",
+        signed_headers, payload_hash
+    ])
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+    ])
+    key = f"AWS4{secret_key}".encode()
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return {
+        'x-amz-date': amz_date,
+        'x-amz-content-sha256': payload_hash,
+        'Authorization': f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+    }
+
+class S3Target:
+    """S3-совместимое хранилище (MinIO, Yandex Object Storage и т.п.), path-style адреса."""
+    name = 's3'
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', prefix=''):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+
+    def _url(self, backup_id, name):
+        return f"{self.endpoint}/{self.bucket}/{self.prefix}{backup_id}/{name}"
+
+    async def put(self, backup_id, name, path):
+        url = self._url(backup_id, name)
+        payload_hash = await asyncio.to_thread(file_sha256, path)
+        headers = sign_v4('PUT', url, payload_hash, self.access_key, self.secret_key, self.region)
+        headers['Content-Length'] = str(os.path.getsize(path))
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=S3_TIMEOUT)) as session:
+            with open(path, 'rb') as f:
+                async with session.put(url, data=f, headers=headers) as response:
+                    if response.status >= 300:
+                        raise OSError(f"S3 PUT {name}: {response.status} {await response.text()}")
+
+    async def get(self, backup_id, name, dest):
+        url = self._url(backup_id, name)
+        headers = sign_v4('GET', url, hashlib.sha256(b'').hexdigest(), self.access_key, self.secret_key, self.region)
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=S3_TIMEOUT)) as session:
+            async with session.get(url, headers=headers) as response:
+                if response.status >= 300:
+                    raise OSError(f"S3 GET {name}: {response.status} {await response.text()}")
+                tmp_path = f"{dest}.{uuid.uuid4().hex[:8]}.tmp"
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            f.write(chunk)
+                    os.replace(tmp_path, dest)
+                except BaseException:
+                    # Обрыв соединения, таймаут или отмена: недокачанный файл не остаётся рядом с томами
+                    _remove_quietly(tmp_path)
+                    raise
+
+def make_targets(configs, bot=None, chat_id=None):
+    """Создаёт места доставки из списка backup_targets; Telegram отправляет в chat_id."""
+    targets = []
+    for config in configs or DEFAULT_TARGETS:
+        kind = config.get('type')
+        if kind == 'telegram':
+            if bot is not None and chat_id is not None:
+                targets.append(TelegramTarget(bot, chat_id))
+        elif kind == 'dir':
+            targets.append(DirectoryTarget(config['path']))
+        elif kind == 's3':
+            targets.append(S3Target(
+                config['endpoint'], config['bucket'], config['access_key'], config['secret_key'],
+                region=config.get('region', 'us-east-1'), prefix=config.get('prefix', '')
+            ))
+        else:
+            logger.error(f"Неизвестное место доставки бэкапа: {kind}")
+    return targets
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Бенчмарк хранилища db.py на синтетических данных разного размера.
+
+Для каждого размера генерируется набор данных: каталоги users/ с конфигами и status.json,
+сроки действия, привязки к Telegram и промокоды. Затем замеряется время операций
+хранилища и выводится, как оно растёт с числом пользователей (показатель k в O(n^k)).
+
+Режим сравнения (--compare модуль:Класс) прогоняет те же операции на другом хранилище и
+выводит, во сколько раз оно быстрее JSON. Класс хранилища создаётся без аргументов в рабочем
+каталоге с уже сгенерированными JSON-файлами (может перенести их к себе в prepare()) и
+реализует те же методы, что и JsonBackend.
+
+Запуск: python3 bench-db.py [--sizes 1000,10000,100000] [--repeat 5] [--compare mybackend:SqliteBackend]
+"""
+import argparse
+import importlib
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+AWG_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, AWG_DIR)
+
+import db
+
+PROMOCODES_PER_USER = 0.01
+# Операции с изменением данных выполняются на случайной выборке пользователей
+WRITES_PER_REPEAT = 20
+# Удаление истёкших замеряется на выборке и пересчитывается на всех истёкших:
+# в JSON каждое удаление переписывает файл целиком, и полный проход на 100k занял бы часы
+SWEEP_SAMPLE = 50
+
+class JsonBackend:
+    """Базовое хранилище: текущие функции db.py поверх JSON-файлов и каталога users/."""
+
+    name = 'json'
+
+    def prepare(self):
+        pass
+
+    def get_client_list(self):
+        return db.get_client_list()
+
+    def get_active_list(self):
+        return db.get_active_list()
+
+    def set_user_expiration(self, username, expiration, transfer_limit):
+        db.set_user_expiration(username, expiration, transfer_limit)
+
+    def apply_promocode(self, code):
+        return db.apply_promocode(code)
+
+    # Проход по истёкшим подпискам как в check_expired_subscriptions (bot.py), без removeclient.sh
+    def find_expired(self, now):
+        expired = []
+        data = db.load_json(db.USER_EXPIRATION_FILE, {})
+        for username, user_data in data.items():
+            expiration = user_data.get('expiration')
+            if expiration and datetime.fromisoformat(expiration) < now:
+                expired.append(username)
+        return expired
+
+    def remove_user_expiration(self, username):
+        db.remove_user_expiration(username)
+
+def generate_dataset(size, seed=1):
+    """Набор данных в текущем каталоге: 10% подписок истекли, 10% истекают в течение недели."""
+    rng = random.Random(seed)
+    now = datetime.now(pytz.utc)
+    expirations, telegram = {}, {}
+    for i in range(size):
+        username = f"user_{1000000 + i}_{i:08x}"
+        user_dir = os.path.join('users', username)
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, f"{username}.conf"), 'w') as f:
+            f.write(
+                f"[Interface]\nPrivateKey = {'A' * 43}=\nAddress = 10.8.{i // 250 % 256}.{i % 250 + 2}/32\n\n"
+                f"[Peer]\nPublicKey = {'B' * 43}=\nEndpoint = 127.0.0.1:51820\nAllowedIPs = 0.0.0.0/0\n"
+            )
+        online = rng.random() < 0.3
+        with open(os.path.join(user_dir, 'status.json'), 'w') as f:
+            f.write(f'{{"last_handshake": "{(now - timedelta(seconds=rng.randint(1, 300))).isoformat() if online else "never"}"}}')
+        bucket = rng.random()
+        if bucket < 0.1:
+            expires_at = now - timedelta(days=rng.randint(1, 30))
+        elif bucket < 0.2:
+            expires_at = now + timedelta(days=rng.randint(0, 6), hours=1)
+        else:
+            expires_at = now + timedelta(days=rng.randint(8, 365))
+        expirations[username] = {'expiration': expires_at.isoformat(), 'transfer_limit': "Неограниченно"}
+        telegram[username] = 100000000 + i
+    promocodes = {
+        f"PROMO{i:06d}": {
+            'discount': 10, 'expires_at': (now + timedelta(days=30)).isoformat(), 'max_uses': None,
+            'uses': 0, 'subscription_period': '1_month'
+        }
+        for i in range(max(10, int(size * PROMOCODES_PER_USER)))
+    }
+    db.save_json(db.USER_EXPIRATION_FILE, expirations)
+    db.save_json(db.USER_TELEGRAM_FILE, telegram)
+    db.save_json(db.PROMOCODES_FILE, promocodes)
+    return list(expirations), list(promocodes)
+
+def measure(func, repeat):
+    """Медиана времени одного вызова func() по repeat повторам, секунды."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+def run_size(backend_factory, size, repeat):
+    workdir = tempfile.mkdtemp(prefix=f'awg-db-{size}-')
+    previous = os.getcwd()
+    os.chdir(workdir)
+    try:
+        generate_started = time.perf_counter()
+        usernames, codes = generate_dataset(size)
+        generated = time.perf_counter() - generate_started
+        backend = backend_factory()
+        backend.prepare()
+        rng = random.Random(2)
+        expiration = datetime.now(pytz.utc) + timedelta(days=30)
+
+        def write_expirations():
+            for username in rng.sample(usernames, min(WRITES_PER_REPEAT, size)):
+                backend.set_user_expiration(username, expiration, "Неограниченно")
+
+        def apply_promocodes():
+            for _ in range(WRITES_PER_REPEAT):
+                backend.apply_promocode(rng.choice(codes))
+
+        def expiry_sweep():
+            started = time.perf_counter()
+            expired = backend.find_expired(datetime.now(pytz.utc))
+            scan = time.perf_counter() - started
+            sample = expired[:SWEEP_SAMPLE]
+            started = time.perf_counter()
+            for username in sample:
+                backend.remove_user_expiration(username)
+            removal = (time.perf_counter() - started) / len(sample) if sample else 0.0
+            return scan + removal * len(expired)
+
+        results = {
+            'get_client_list': measure(backend.get_client_list, repeat),
+            'get_active_list': measure(backend.get_active_list, repeat),
+            'set_user_expiration': measure(write_expirations, repeat) / WRITES_PER_REPEAT,
+            'apply_promocode': measure(apply_promocodes, repeat) / WRITES_PER_REPEAT,
+            # Проход изменяет данные (удаляет истёкшие), поэтому замеряется один раз
+            'expiry_sweep': expiry_sweep()
+        }
+        return results, generated
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def format_time(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} с"
+    if seconds >= 0.001:
+        return f"{seconds * 1000:.1f} мс"
+    return f"{seconds * 1000000:.0f} мкс"
+
+def print_curves(title, sizes, results):
+    """Таблица времени по размерам и показатель роста k: время ~ n^k между соседними размерами."""
+    print(f"\n{title}")
+    header = f"{'операция':<22}" + ''.join(f" | {size:>10}" for size in sizes) + " | рост"
+    print(header)
+    print('-' * len(header))
+    for operation in results[sizes[0]]:
+        timings = [results[size][operation] for size in sizes]
+        exponents = [
+            math.log(b / a) / math.log(size_b / size_a)
+            for a, b, size_a, size_b in zip(timings, timings[1:], sizes, sizes[1:])
+            if a > 0 and b > 0
+        ]
+        growth = ', '.join(f"n^{k:.2f}" for k in exponents) or '-'
+        print(f"{operation:<22}" + ''.join(f" | {format_time(t):>10}" for t in timings) + f" | {growth}")
+
+def print_comparison(name, sizes, baseline, candidate):
+    print(f"\nУскорение {name} относительно json (больше 1 - быстрее)")
+    header = f"{'операция':<22}" + ''.join(f" | {size:>10}" for size in sizes)
+    print(header)
+    print('-' * len(header))
+    for operation in baseline[sizes[0]]:
+        ratios = []
+        for size in sizes:
+            base, new = baseline[size][operation], candidate[size].get(operation)
+            ratios.append(f"x{base / new:.1f}" if new else '-')
+        print(f"{operation:<22}" + ''.join(f" | {ratio:>10}" for ratio in ratios))
+
+def load_backend(spec):
+    module_name, _, class_name = spec.partition(':')
+    backend = getattr(importlib.import_module(module_name), class_name)
+    missing = [name for name in vars(JsonBackend) if not name.startswith('_') and not hasattr(backend, name)]
+    if missing:
+        raise SystemExit(f"{spec}: не реализованы {', '.join(missing)}")
+    return backend
+
+def run(backend, sizes, repeat):
+    results = {}
+    for size in sizes:
+        results[size], generated = run_size(backend, size, repeat)
+        print(f"{getattr(backend, 'name', backend.__name__)}: {size} пользователей (генерация {generated:.1f} с)", file=sys.stderr)
+    return results
+
+def main(args):
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    # Бенчмарк не должен засорять вывод логами db.py
+    db.logger.setLevel('WARNING')
+    baseline = run(JsonBackend, sizes, args.repeat)
+    print_curves("json (текущий db.py)", sizes, baseline)
+    if args.compare:
+        backend = load_backend(args.compare)
+        candidate = run(backend, sizes, args.repeat)
+        name = getattr(backend, 'name', backend.__name__)
+        print_curves(name, sizes, candidate)
+        print_comparison(name, sizes, baseline, candidate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилища пользователей db.py")
+    parser.add_argument('--sizes', default='1000,10000,100000', help="Размеры наборов данных через запятую")
+    parser.add_argument('--repeat', type=int, default=5, help="Повторов каждой операции (берётся медиана)")
+    parser.add_argument('--compare', help="Хранилище для сравнения с JSON: модуль:Класс")
+    main(parser.parse_args())
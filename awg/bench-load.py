@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Нагрузочный тест bot_manager: тысячи виртуальных пользователей против локальных заглушек.
+
+Бот запускается целиком (обработчики, очереди, middleware) во временном рабочем каталоге
+против имитации Bot API (fake_botapi.py). newclient.sh, removeclient.sh, docker, wg и
+python3.11 заменены скриптами-заглушками с задержкой --shell-latency на каждый вызов.
+Виртуальные пользователи проигрывают сценарии (просмотр меню, покупка ключа, промокод,
+список клиентов у админа); время шага - от отправки обновления до первого ответа бота.
+
+Запуск: python3 bench-load.py [--users 1000] [--admins 5] [--iterations 3] [--latency 0.02]
+        [--shell-latency 0.05] [--think 0.5] [--mix browse=60,buy_key=20,redeem_promo=20]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from fake_botapi import FakeBotAPI
+
+AWG_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN = '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi'
+PROMOCODE = 'LOADTEST'
+USER_ID_BASE = 5_000_000
+ADMIN_ID_BASE = 9_000_000
+# Ответы, которые считаются ошибкой шага
+ERROR_MARKERS = ('Ошибка', 'Неверный', 'Нет прав', 'Слишком')
+
+# Шаг: (название, тип, значение); тип - text или callback
+SCENARIOS = {
+    'browse': [
+        ('start', 'text', '/start'),
+        ('home', 'callback', 'home'),
+        ('buy_key', 'callback', 'buy_key'),
+        ('home', 'callback', 'home')
+    ],
+    'buy_key': [
+        ('start', 'text', '/start'),
+        ('buy_key', 'callback', 'buy_key'),
+        ('use_promocode', 'callback', 'use_promocode'),
+        ('promocode', 'text', PROMOCODE)
+    ],
+    'redeem_promo': [
+        ('start', 'text', '/start'),
+        ('use_promocode', 'callback', 'use_promocode'),
+        ('promocode', 'text', PROMOCODE)
+    ],
+    'admin_list_users': [
+        ('start', 'text', '/start'),
+        ('list_users', 'callback', 'list_users'),
+        ('home', 'callback', 'home')
+    ]
+}
+
+SHELL_STUBS = {
+    # docker exec <контейнер> wg genkey|genpsk|pubkey|show ..., docker cp и прочее
+    'bin/docker': """#!/bin/sh
+sleep "${AWG_FAKE_LATENCY:-0}"
+case "$*" in
+  *genkey*|*genpsk*|*pubkey*) head -c 32 /dev/urandom | base64 ;;
+esac
+exit 0
+""",
+    'bin/wg': """#!/bin/sh
+sleep "${AWG_FAKE_LATENCY:-0}"
+case "$*" in
+  *genkey*|*genpsk*|*pubkey*) head -c 32 /dev/urandom | base64 ;;
+esac
+exit 0
+""",
+    # Вызывается как python3.11 awg-decode.py --encode <conf>
+    'bin/python3.11': """#!/bin/sh
+sleep "${AWG_FAKE_LATENCY:-0}"
+echo "vpn://loadtest-$(basename "$4" .conf)"
+""",
+    'newclient.sh': """#!/bin/sh
+name="$1"
+private_key=$(docker exec awg wg genkey)
+preshared_key=$(docker exec awg wg genpsk)
+mkdir -p "users/$name"
+cat > "users/$name/$name.conf" <<CONF
+[Interface]
+PrivateKey = $private_key
+Address = 10.8.1.2/32
+
+[Peer]
+PresharedKey = $preshared_key
+Endpoint = 127.0.0.1:51820
+AllowedIPs = 0.0.0.0/0
+CONF
+docker exec awg wg-quick strip wg0
+""",
+    'removeclient.sh': """#!/bin/sh
+docker exec awg wg set wg0 peer remove
+rm -rf "users/$1"
+"""
+}
+
+def prepare_workdir(args):
+    """Временный рабочий каталог бота: config.json, промокод, заглушки и клиенты."""
+    workdir = tempfile.mkdtemp(prefix='awg-load-')
+    os.makedirs(os.path.join(workdir, 'files'))
+    os.makedirs(os.path.join(workdir, 'bin'))
+    config = {
+        'bot_token': TOKEN,
+        'admin_ids': [ADMIN_ID_BASE + i for i in range(max(args.admins, 1))],
+        'wg_config_file': os.path.join(workdir, 'wg0.conf'),
+        'docker_container': 'awg',
+        'endpoint': '127.0.0.1',
+        'metrics_port': 0,
+        'update_lanes': args.lanes
+    }
+    with open(os.path.join(workdir, 'files', 'config.json'), 'w') as f:
+        json.dump(config, f)
+    promocodes = {
+        PROMOCODE: {'discount': 0, 'expires_at': None, 'max_uses': None, 'uses': 0, 'subscription_period': '1_month'}
+    }
+    with open(os.path.join(workdir, 'files', 'promocodes.json'), 'w') as f:
+        json.dump(promocodes, f)
+    for path, content in SHELL_STUBS.items():
+        full_path = os.path.join(workdir, path)
+        with open(full_path, 'w') as f:
+            f.write(content)
+        os.chmod(full_path, 0o755)
+    for i in range(args.clients):
+        name = f"client{i:06d}"
+        os.makedirs(os.path.join(workdir, 'users', name))
+        with open(os.path.join(workdir, 'users', name, f"{name}.conf"), 'w') as f:
+            f.write("[Interface]\nAddress = 10.8.0.2/32\n")
+    return workdir
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class LoadResults:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.scenarios = Counter()
+
+    def record(self, step, latency, error=None):
+        if error:
+            self.errors[step][error] += 1
+        else:
+            self.latencies[step].append(latency)
+
+    def report(self, elapsed):
+        steps = sorted(set(self.latencies) | set(self.errors))
+        total_ok = sum(len(values) for values in self.latencies.values())
+        total_errors = sum(sum(counter.values()) for counter in self.errors.values())
+        lines = [
+            f"Сценариев: {sum(self.scenarios.values())} ({', '.join(f'{k}: {v}' for k, v in sorted(self.scenarios.items()))})",
+            f"Шагов: {total_ok + total_errors} за {elapsed:.1f} с, {(total_ok + total_errors) / elapsed:.0f} шаг./с, "
+            f"ошибок: {total_errors} ({total_errors / max(total_ok + total_errors, 1) * 100:.2f}%)",
+            "",
+            f"{'шаг':<32} | {'число':>6} | {'p50, мс':>8} | {'p90, мс':>8} | {'p99, мс':>8} | {'max, мс':>8} | ошибки"
+        ]
+        for step in steps:
+            values = sorted(self.latencies[step])
+            errors = ', '.join(f"{kind}: {count}" for kind, count in self.errors[step].most_common())
+            lines.append(
+                f"{step:<32} | {len(values):>6} | {percentile(values, 0.5) * 1000:>8.1f} | "
+                f"{percentile(values, 0.9) * 1000:>8.1f} | {percentile(values, 0.99) * 1000:>8.1f} | "
+                f"{(values[-1] if values else 0) * 1000:>8.1f} | {errors or '-'}"
+            )
+        return '\n'.join(lines)
+
+async def virtual_user(api, results, user_id, scenario_names, weights, args):
+    # Пользователи приходят не одновременно, а в течение --ramp секунд
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for _ in range(args.iterations):
+        name = random.choices(scenario_names, weights)[0]
+        results.scenarios[name] += 1
+        for label, kind, value in SCENARIOS[name]:
+            step = f"{name}:{label}"
+            if kind == 'text':
+                update = api.make_update(user_id, text=value)
+            else:
+                update = api.make_update(user_id, callback_data=value)
+            response = api.expect(user_id)
+            started = time.perf_counter()
+            api.push_update(update)
+            try:
+                method, text = await asyncio.wait_for(response, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                # Поздний ответ на этот шаг исказил бы замер следующего, поэтому пользователь выходит
+                results.record(step, None, 'timeout')
+                return
+            latency = time.perf_counter() - started
+            if text.startswith(ERROR_MARKERS):
+                results.record(step, latency, text.split('\n')[0][:40])
+                break
+            results.record(step, latency)
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS or name.strip() == 'admin_list_users':
+            raise SystemExit(f"Неизвестный сценарий пользователя: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+async def main(args):
+    mix = parse_mix(args.mix)
+    workdir = prepare_workdir(args)
+    os.environ['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    os.environ['AWG_FAKE_LATENCY'] = str(args.shell_latency)
+    os.chdir(workdir)
+    sys.path.insert(0, AWG_DIR)
+    api = await FakeBotAPI(latency=args.latency).start()
+    try:
+        from aiogram.bot.api import TelegramAPIServer
+        # bot_manager настраивает логирование при импорте; настроенный заранее уровень сохраняется
+        logging.basicConfig(level=logging.WARNING)
+        import bot_manager
+        bot_manager.bot.server = TelegramAPIServer.from_base(api.base_url)
+        await bot_manager.on_startup(bot_manager.dp)
+        bot_manager.update_lanes.install()
+        polling = asyncio.create_task(bot_manager.dp.start_polling(timeout=1, relax=0))
+
+        results = LoadResults()
+        users = [
+            virtual_user(api, results, USER_ID_BASE + i, list(mix), list(mix.values()), args)
+            for i in range(args.users)
+        ]
+        users += [
+            virtual_user(api, results, ADMIN_ID_BASE + i, ['admin_list_users'], [1], args)
+            for i in range(args.admins)
+        ]
+        started = time.perf_counter()
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - started
+
+        print(f"Пользователей: {args.users} + админов: {args.admins}, клиентов: {args.clients}, "
+              f"задержка Bot API: {args.latency * 1000:.0f} мс, заглушек: {args.shell_latency * 1000:.0f} мс")
+        print(results.report(elapsed))
+        print()
+        lanes = bot_manager.update_lanes.get_stats()
+        print(f"Очереди: обработано {lanes['processed']}, ошибок {lanes['failed']}, "
+              f"ожиданий места {lanes['blocked']} ({lanes['blocked_seconds']:.1f} с), "
+              f"макс. глубина {max((lane['max_depth'] for lane in lanes['lanes']), default=0)}")
+        print(f"Антифлуд: {bot_manager.throttling.get_stats()}")
+        print(f"Повторы: {bot_manager.guard.get_stats()}")
+        print(f"Вызовы Bot API: {dict(api.calls.most_common())}")
+
+        bot_manager.dp.stop_polling()
+        await asyncio.wait([polling], timeout=5)
+        await bot_manager.update_lanes.stop(timeout=5)
+        await bot_manager.deferred.stop()
+        bot_manager.loop_watchdog.stop()
+        bot_manager.scheduler.shutdown(wait=False)
+        await (await bot_manager.bot.get_session()).close()
+    finally:
+        await api.stop()
+        os.chdir(AWG_DIR)
+        if args.keep:
+            print(f"Рабочий каталог: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с виртуальными пользователями")
+    parser.add_argument('--users', type=int, default=1000, help="Число виртуальных пользователей")
+    parser.add_argument('--admins', type=int, default=5, help="Число виртуальных админов (список клиентов)")
+    parser.add_argument('--clients', type=int, default=1000, help="Клиентов в users/ до начала теста")
+    parser.add_argument('--iterations', type=int, default=3, help="Сценариев на пользователя")
+    parser.add_argument('--mix', default='browse=60,buy_key=20,redeem_promo=20', help="Веса пользовательских сценариев")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка ответа Bot API, секунды")
+    parser.add_argument('--shell-latency', type=float, default=0.05, help="Задержка вызова docker/wg/python3.11, секунды")
+    parser.add_argument('--think', type=float, default=0.5, help="Пауза пользователя между шагами, секунды")
+    parser.add_argument('--ramp', type=float, default=10.0, help="Время подключения всех пользователей, секунды")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Ожидание ответа на шаг, секунды")
+    parser.add_argument('--lanes', type=int, default=8, help="Число очередей обработки")
+    parser.add_argument('--keep', action='store_true', help="Не удалять рабочий каталог")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Микробенчмарк: стоимость выбора обработчика callback-запроса в зависимости от числа обработчиков.
+
+Сравнивает линейный перебор lambda-фильтров (как в aiogram при @dp.callback_query_handler(lambda ...))
+с CallbackRouter (словарь + префиксное дерево для старых кнопок).
+
+Запуск: python3 bench-router.py [--calls 100000]
+"""
+import argparse
+import asyncio
+import time
+
+from callback_router import CallbackRouter
+
+class FakeCallbackQuery:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+async def _noop(callback_query, *args):
+    return None
+
+def build_linear(count):
+    filters = []
+    for i in range(count):
+        prefix = f"action{i}_"
+        filters.append((lambda c, p=prefix: c.data.startswith(p), _noop))
+    return filters
+
+async def dispatch_linear(filters, callback_query):
+    for check, handler in filters:
+        if check(callback_query):
+            return await handler(callback_query)
+
+def build_router(count):
+    router = CallbackRouter()
+    for i in range(count):
+        router.action(f"action{i}", legacy_prefix=f"action{i}_")(_noop)
+    return router
+
+async def measure(dispatch, target, queries):
+    start = time.perf_counter()
+    for query in queries:
+        await dispatch(target, query)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+async def main(calls):
+    print(f"{'обработчиков':>12} | {'linear, мкс':>12} | {'router, мкс':>12} | {'legacy, мкс':>12}")
+    for count in (10, 30, 100, 300, 1000):
+        filters = build_linear(count)
+        router = build_router(count)
+        # Худший случай для линейного перебора - последний зарегистрированный обработчик
+        legacy_queries = [FakeCallbackQuery(f"action{count - 1}_user_123456789_ab12cd34")] * calls
+        router_queries = [FakeCallbackQuery(router.encode(f"action{count - 1}", "user_123456789_ab12cd34"))] * calls
+        linear = await measure(dispatch_linear, filters, legacy_queries)
+        routed = await measure(lambda r, q: r.dispatch(q), router, router_queries)
+        legacy = await measure(lambda r, q: r.dispatch(q), router, legacy_queries)
+        print(f"{count:>12} | {linear:>12.2f} | {routed:>12.2f} | {legacy:>12.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарк диспетчеризации callback-запросов")
+    parser.add_argument('--calls', type=int, default=100000, help="Число вызовов на каждую точку")
+    args = parser.parse_args()
+    asyncio.run(main(args.calls))
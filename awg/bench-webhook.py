@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Бенчмарк: пропускная способность webhook-режима по сравнению с long polling.
+
+Оба режима работают против локальной имитации Bot API (fake_botapi.py); обработчик
+отвечает на каждое сообщение одним sendMessage. Задержка Bot API задаётся --latency.
+
+Запуск: python3 bench-webhook.py [--updates 2000] [--latency 0.02] [--lanes 8]
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+
+from fake_botapi import FakeBotAPI
+from lanes import LaneDispatcher
+from webhook import WebhookServer, SECRET_HEADER
+
+TOKEN = '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi'
+SECRET = 'bench-secret'
+
+def make_dispatcher(api):
+    bot = Bot(TOKEN, server=TelegramAPIServer.from_base(api.base_url))
+    dp = Dispatcher(bot)
+
+    @dp.message_handler()
+    async def echo(message: types.Message):
+        await message.answer(message.text)
+
+    return dp
+
+async def bench_polling(updates, latency, lanes):
+    api = await FakeBotAPI(latency=latency).start()
+    dp = make_dispatcher(api)
+    dispatcher = LaneDispatcher(dp, lanes=lanes).install()
+    Bot.set_current(dp.bot)
+    for i in range(updates):
+        api.push_update(api.make_update(1000 + i % 100, text=f"msg {i}"))
+    start = time.perf_counter()
+    polling = asyncio.create_task(dp.start_polling(timeout=1))
+    await api.wait_for_calls('sendMessage', updates)
+    elapsed = time.perf_counter() - start
+    dp.stop_polling()
+    await asyncio.wait([polling], timeout=5)
+    await dispatcher.stop()
+    await (await dp.bot.get_session()).close()
+    await api.stop()
+    return elapsed
+
+async def bench_webhook(updates, latency, lanes):
+    api = await FakeBotAPI(latency=latency).start()
+    dp = make_dispatcher(api)
+    server = WebhookServer(dp, secret_token=SECRET, lanes=lanes)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    payloads = [api.make_update(1000 + i % 100, text=f"msg {i}") for i in range(updates)]
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(headers={SECRET_HEADER: SECRET}) as session:
+        # Telegram доставляет обновления параллельно (max_connections до 100)
+        semaphore = asyncio.Semaphore(40)
+
+        async def post(payload):
+            async with semaphore:
+                async with session.post(f"http://127.0.0.1:{port}/webhook", json=payload) as response:
+                    response.raise_for_status()
+
+        await asyncio.gather(*(post(p) for p in payloads))
+    await api.wait_for_calls('sendMessage', updates)
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    await (await dp.bot.get_session()).close()
+    await api.stop()
+    return elapsed
+
+async def main(args):
+    polling = await bench_polling(args.updates, args.latency, args.lanes)
+    webhook = await bench_webhook(args.updates, args.latency, args.lanes)
+    print(f"Обновлений: {args.updates}, задержка Bot API: {args.latency * 1000:.0f} мс")
+    print(f"{'режим':>10} | {'время, с':>9} | {'обн./с':>8}")
+    for name, elapsed in (('polling', polling), ('webhook', webhook)):
+        print(f"{name:>10} | {elapsed:>9.2f} | {args.updates / elapsed:>8.0f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сравнение webhook и long polling")
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка ответа Bot API, секунды")
+    parser.add_argument('--lanes', type=int, default=8, help="Число очередей обработки")
+    asyncio.run(main(parser.parse_args()))
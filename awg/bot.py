@@ -17,6 +17,14 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import pytz
 
 import db
+import webhook
+from lanes import LaneDispatcher, DEFAULT_LANES, DEFAULT_QUEUE_SIZE
+from state_store import StateStore
+from send_queue import SendQueue, PRIORITY_BULK
+from deferred import DeferredActions, DEFERRED_LEGACY_DB_FILE
+from backup import BackupStore, BACKUP_DIR, KEEP_LAST, KEEP_DAILY, describe
+from subscriptions import SubscriptionTable
+from dashboard import Dashboard
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -40,30 +48,32 @@ pricing = setting.get('pricing', {
 # Инициализация бота и диспетчера
 bot = Bot(token=bot_token)
 dp = Dispatcher(bot)
+outbox = SendQueue(bot)
+deferred = DeferredActions(bot, DEFERRED_LEGACY_DB_FILE)
+# Хранилище общее с bot_manager.py, поэтому и срок хранения снимков тот же
+backups = BackupStore(
+    setting.get('backup_dir', BACKUP_DIR),
+    keep_last=int(setting.get('backup_keep_last', KEEP_LAST)),
+    keep_daily=int(setting.get('backup_keep_daily', KEEP_DAILY))
+)
+subscriptions = SubscriptionTable()
+stats_board = Dashboard()
 
 # Списки администраторов и модераторов
 admins = [int(admin_id) for admin_id in admin_ids]
 moderators = [int(mod_id) for mod_id in moderator_ids]
 
 # Глобальные переменные для состояний
-user_states = {}
+user_states = StateStore()
 awaiting_promo_application = {}
 
 
 # Функция для удаления сообщений с задержкой
-async def delete_message_after_delay(chat_id, message_id, delay=2):
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, message_id)
-    except Exception as e:
-        logger.error(f"Ошибка удаления сообщения: {e}")
-
-
 # Middleware для удаления сообщений администраторов
 class AdminMessageDeletionMiddleware(BaseMiddleware):
     async def on_process_message(self, message: types.Message, data: dict):
         if message.from_user.id in admins and message.text.startswith('/'):
-            asyncio.create_task(delete_message_after_delay(message.chat.id, message.message_id))
+            deferred.delete_message(message.chat.id, message.message_id)
 
 
 # Добавляем middleware
@@ -135,12 +145,12 @@ async def prompt_for_user_name(callback_query: types.CallbackQuery):
         return
 
     await callback_query.message.answer("Введите имя нового пользователя:")
-    user_states[user_id] = 'awaiting_username'
+    user_states.set(user_id, callback_query.message.chat.id, None, 'awaiting_username')
 
 
 # Обработчик ввода имени пользователя
 @dp.message_handler(
-    lambda message: message.from_user.id in user_states and user_states[message.from_user.id] == 'awaiting_username')
+    lambda message: user_states.get_state(message.from_user.id) == 'awaiting_username')
 async def process_username(message: types.Message):
     user_id = message.from_user.id
     username = message.text.strip()
@@ -176,7 +186,7 @@ async def process_username(message: types.Message):
     else:
         await message.answer("❌ Ошибка при добавлении пользователя")
 
-    del user_states[user_id]
+    user_states.delete(user_id)
 
 
 # Обработчик кнопки списка пользователей
@@ -244,28 +254,16 @@ async def create_backup_callback(callback_query: types.CallbackQuery):
         return
 
     try:
-        # Создание временной директории для бэкапа
-        backup_dir = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        os.makedirs(backup_dir, exist_ok=True)
-
-        # Копирование файлов
-        if os.path.exists('users'):
-            shutil.copytree('users', os.path.join(backup_dir, 'users'))
-        if os.path.exists('files'):
-            shutil.copytree('files', os.path.join(backup_dir, 'files'))
-
-        # Создание архива
-        shutil.make_archive(backup_dir, 'zip', backup_dir)
-
-        # Отправка архива
-        await callback_query.message.answer_document(
-            types.InputFile(f"{backup_dir}.zip"),
-            caption="📦 Резервная копия создана"
+        # Снимок и сборка архива идут в потоке, event loop не блокируется
+        manifest = await asyncio.to_thread(backups.snapshot)
+        await backups.stream_zip(
+            manifest,
+            lambda reader: callback_query.message.answer_document(
+                types.InputFile(reader, filename=f"backup_{manifest['id']}.zip"),
+                caption=f"📦 Резервная копия создана\n{describe(manifest)}"
+            )
         )
-
-        # Очистка
-        shutil.rmtree(backup_dir)
-        os.remove(f"{backup_dir}.zip")
+        await asyncio.to_thread(backups.rotate)
 
     except Exception as e:
         logger.error(f"Ошибка создания бэкапа: {e}")
@@ -275,22 +273,18 @@ async def create_backup_callback(callback_query: types.CallbackQuery):
 # Функция для проверки истекших подписок
 async def check_expired_subscriptions():
     try:
-        data = db.load_json(db.USER_EXPIRATION_FILE, {})
-        now = datetime.now(pytz.utc)
-
-        for username, user_data in data.items():
-            expiration = user_data.get('expiration')
-            if expiration and datetime.fromisoformat(expiration) < now:
-                # Деактивация пользователя с истекшей подпиской
-                db.deactive_user_db(username)
-                db.remove_user_expiration(username)
-
-                # Уведомление администратора
-                for admin_id in admins:
-                    try:
-                        await bot.send_message(admin_id, f"⚠️ Пользователь {username} деактивирован (истекла подписка)")
-                    except:
-                        pass
+        # Истёкшие выбираются из таблицы подписок диапазоном, без разбора дат каждой записи
+        for username in subscriptions.expired(datetime.now(pytz.utc)):
+            # Деактивация пользователя с истекшей подпиской
+            db.deactive_user_db(username)
+            db.remove_user_expiration(username)
+            subscriptions.clear_expiration(username)
+            stats_board.record_expire()
+
+            # Уведомление администратора (через очередь с ограничением скорости)
+            for admin_id in admins:
+                outbox.send_message(admin_id, f"⚠️ Пользователь {username} деактивирован (истекла подписка)",
+                                    priority=PRIORITY_BULK)
     except Exception as e:
         logger.error(f"Ошибка проверки подписок: {e}")
 
@@ -300,6 +294,10 @@ scheduler = AsyncIOScheduler()
 scheduler.add_job(check_expired_subscriptions, 'interval', hours=1)
 scheduler.start()
 
+async def on_startup(dispatcher):
+    # Отложенные действия, сохранённые до перезапуска, выполняются без ожидания новых
+    deferred.start()
+
 # Основная функция запуска
 if __name__ == '__main__':
     # Проверка наличия токена
@@ -314,4 +312,12 @@ if __name__ == '__main__':
         logger.warning("⚠️ Список администраторов пуст! Добавьте admin_ids в config.json")
 
     logger.info("🤖 Бот запускается...")
-    executor.start_polling(dp, skip_updates=True)
+    if setting.get('webhook_url'):
+        webhook.run(dp, setting, on_startup=on_startup)
+    else:
+        LaneDispatcher(
+            dp,
+            lanes=int(setting.get('update_lanes', DEFAULT_LANES)),
+            queue_size=int(setting.get('update_lane_queue', DEFAULT_QUEUE_SIZE))
+        ).install()
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
@@ -1,4 +1,27 @@
 import db
+import file_cache
+import broadcast
+from callback_router import CallbackRouter
+from state_store import StateStore, STATE_DB_FILE
+from user_index import UserIndex, FILTERS
+from search_index import SearchIndex
+from subscriptions import SubscriptionTable
+from dashboard import Dashboard, top_traffic
+import views
+import webhook
+import metrics
+import watchdog
+from lanes import LaneDispatcher, DEFAULT_LANES, DEFAULT_QUEUE_SIZE
+from jobs import JobRunner, STATUS_TITLES
+from idempotency import Idempotency, deduplicate
+from throttling import ThrottlingMiddleware
+from deferred import DeferredActions, DEFERRED_DB_FILE
+from config_service import ConfigService
+from backup import BackupStore, BACKUP_DIR, KEEP_LAST, KEEP_DAILY, VOLUME_SIZE, EXPORT_WORKERS
+import backup
+import backup_targets
+import reconcile
+from send_queue import SendQueue, PRIORITY_INTERACTIVE
 import aiohttp
 import logging
 import asyncio
@@ -8,6 +31,8 @@ import re
 import json
 import sys
 import uuid
+import hashlib
+import io
 from aiogram import Bot, types
 from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.middlewares import BaseMiddleware
@@ -21,43 +46,83 @@ import shutil
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Загрузка конфигурации
-setting = db.get_config()
+# Загрузка конфигурации (роли и цены перечитываются из config.json на лету)
+config = ConfigService()
+setting = config.snapshot.data
 bot_token = setting.get('bot_token')
 admin_ids = setting.get('admin_ids', [])
-moderator_ids = setting.get('moderator_ids', [])
 wg_config_file = setting.get('wg_config_file')
 docker_container = setting.get('docker_container')
 endpoint = setting.get('endpoint')
-pricing = setting.get('pricing', {
-    '1_month': 1000.0,
-    '3_months': 2500.0,
-    '6_months': 4500.0,
-    '12_months': 8000.0
-})
 
 if not all([bot_token, admin_ids, wg_config_file, docker_container, endpoint]):
     logger.error("Некоторые обязательные настройки отсутствуют.")
     sys.exit(1)
 
-admins = [int(admin_id) for admin_id in admin_ids]
-moderators = [int(mod_id) for mod_id in moderator_ids]
+admins = config.admins
+moderators = config.moderators
 bot = Bot(bot_token)
+metrics.instrument_bot(bot)
+outbox = SendQueue(bot)
+deferred = DeferredActions(bot, DEFERRED_DB_FILE)
 WG_CONFIG_FILE = wg_config_file
 DOCKER_CONTAINER = docker_container
 ENDPOINT = endpoint
-PRICING = pricing
 
 class AdminMessageDeletionMiddleware(BaseMiddleware):
     async def on_process_message(self, message: types.Message, data: dict):
         if message.from_user.id in admins and message.text.startswith('/'):
-            asyncio.create_task(delete_message_after_delay(message.chat.id, message.message_id))
+            deferred.delete_message(message.chat.id, message.message_id)
 
 dp = Dispatcher(bot)
+router = CallbackRouter(STATE_DB_FILE)
+update_lanes = LaneDispatcher(
+    dp,
+    lanes=int(setting.get('update_lanes', DEFAULT_LANES)),
+    queue_size=int(setting.get('update_lane_queue', DEFAULT_QUEUE_SIZE))
+)
 scheduler = AsyncIOScheduler(timezone=pytz.utc)
 scheduler.start()
 dp.middleware.setup(AdminMessageDeletionMiddleware())
 
+def classify_event(event):
+    """Имя действия для ограничения частоты: callback-действие, команда или ожидаемый ввод."""
+    if isinstance(event, types.CallbackQuery):
+        return router.decode(event.data or '')[0] or 'default'
+    command = event.get_command(pure=True)
+    if command:
+        return command
+    state = user_states.get_state(event.from_user.id)
+    return state.partition(':')[0] if state else 'default'
+
+def role_of(user_id):
+    if user_id in admins:
+        return 'admin'
+    if user_id in moderators:
+        return 'moderator'
+    return 'user'
+
+throttling = ThrottlingMiddleware(
+    classify_event,
+    role_of,
+    limits={action: tuple(limit) for action, limit in setting.get('rate_limits', {}).items()},
+    role_multipliers=setting.get('rate_limit_roles')
+)
+dp.middleware.setup(throttling)
+
+@config.subscribe
+def on_config_change(snapshot, changed):
+    if {'rate_limits', 'rate_limit_roles'} & changed:
+        throttling.configure(
+            limits={action: tuple(limit) for action, limit in snapshot.data.get('rate_limits', {}).items()},
+            role_multipliers=snapshot.data.get('rate_limit_roles')
+        )
+    if {'admin_ids', 'moderator_ids'} & changed:
+        logger.info(f"Роли обновлены: админов {len(snapshot.admins)}, модераторов {len(snapshot.moderators)}")
+    restart_required = {'bot_token', 'wg_config_file', 'docker_container', 'endpoint'} & changed
+    if restart_required:
+        logger.warning(f"Изменения {', '.join(sorted(restart_required))} вступят в силу после перезапуска бота")
+
 # Главное меню
 def get_main_menu_markup(user_id):
     markup = InlineKeyboardMarkup(row_width=2)
@@ -71,7 +136,11 @@ def get_main_menu_markup(user_id):
             InlineKeyboardButton("🎟️ Управление промокодами", callback_data="manage_promocodes")
         )
         markup.add(
-            InlineKeyboardButton("⚙️ Настройки", callback_data="settings"),
+            InlineKeyboardButton("📣 Рассылка", callback_data="broadcast"),
+            InlineKeyboardButton("⚙️ Настройки", callback_data="settings")
+        )
+        markup.add(
+            InlineKeyboardButton("📊 Статистика", callback_data="stats"),
             InlineKeyboardButton("🏠 Домой", callback_data="home")
         )
     elif user_id in moderators:
@@ -108,6 +177,10 @@ def get_settings_menu():
         InlineKeyboardButton("👤 Добавить админа", callback_data="add_admin"),
         InlineKeyboardButton("💰 Настройки цен", callback_data="pricing_settings")
     )
+    markup.add(
+        InlineKeyboardButton("🧵 Фоновые задачи", callback_data="jobs"),
+        InlineKeyboardButton("🩺 Диагностика", callback_data="diagnostics")
+    )
     markup.add(InlineKeyboardButton("⬅️ Назад", callback_data="home"))
     return markup
 
@@ -122,8 +195,8 @@ def get_pricing_settings_menu():
     ]
     for period_name, period_key in periods:
         markup.add(InlineKeyboardButton(
-            f"{period_name} - ₽{PRICING.get(period_key, 0):.2f}",
-            callback_data=f"set_price_{period_key}"
+            f"{period_name} - ₽{config.pricing.get(period_key, 0):.2f}",
+            callback_data=router.encode("set_price", period_key)
         ))
     markup.add(InlineKeyboardButton("⬅️ Назад", callback_data="settings"))
     return markup
@@ -139,19 +212,81 @@ def get_renewal_period_keyboard(username):
         ("Кастомная дата", "custom_date")
     ]
     for period_name, period_key in periods:
-        markup.add(InlineKeyboardButton(period_name, callback_data=f"renew_period_{username}_{period_key}"))
+        markup.add(InlineKeyboardButton(period_name, callback_data=router.encode("renew_period", username, period_key)))
     markup.add(InlineKeyboardButton("Отмена", callback_data="home"))
     return markup
 
-user_main_messages = {}
+# Страница списка клиентов: action - действие для кнопки клиента, list_action - для навигации
+def get_user_page_keyboard(list_action, action, filter_name='all', direction='a', cursor='', with_status=False):
+    names, prev_cursor, next_cursor = user_index.page(filter_name, direction, cursor)
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for username in names:
+        button_text = username
+        if with_status:
+            status = "🟢" if db.is_online(db.get_last_handshake(username)) else "❌"
+            button_text = f"{status} {username}"
+        keyboard.insert(InlineKeyboardButton(button_text, callback_data=router.encode(action, username)))
+    navigation = []
+    if prev_cursor is not None:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=router.encode(list_action, filter_name, 'b', prev_cursor)))
+    if next_cursor is not None:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=router.encode(list_action, filter_name, 'a', next_cursor)))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.row(*[
+        InlineKeyboardButton(("• " if key == filter_name else "") + title, callback_data=router.encode(list_action, key))
+        for key, title in FILTERS.items()
+    ])
+    keyboard.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+    return keyboard, names
 
-async def delete_message_after_delay(chat_id: int, message_id: int, delay: int = 2):
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, message_id)
-    except:
-        pass
+# Клавиатура выбора сегмента рассылки
+def get_broadcast_segments_keyboard():
+    markup = InlineKeyboardMarkup(row_width=1)
+    for segment, title in broadcast.SEGMENTS.items():
+        markup.add(InlineKeyboardButton(title, callback_data=router.encode("broadcast_segment", segment)))
+    markup.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+    return markup
+
+user_states = StateStore(STATE_DB_FILE)
+subscriptions = SubscriptionTable()
+user_index = UserIndex(subscriptions=subscriptions)
+stats_board = Dashboard()
+search = SearchIndex()
+jobs = JobRunner(bot, workers=2)
+backups = BackupStore(
+    setting.get('backup_dir', BACKUP_DIR),
+    keep_last=int(setting.get('backup_keep_last', KEEP_LAST)),
+    keep_daily=int(setting.get('backup_keep_daily', KEEP_DAILY))
+)
+guard = Idempotency()
+loop_watchdog = watchdog.LoopWatchdog(threshold=float(setting.get('loop_lag_threshold', watchdog.LAG_THRESHOLD)))
+
+async def render(callback_query: types.CallbackQuery, text, reply_markup=None, parse_mode=None, state=None):
+    """Показывает экран в сообщении с нажатой кнопкой и запоминает его как главное."""
+    chat_id, message_id = await views.show(
+        bot, callback_query.message.chat.id, callback_query.message.message_id,
+        text, reply_markup=reply_markup, parse_mode=parse_mode
+    )
+    user_states.set(callback_query.from_user.id, chat_id, message_id, state)
+
+def start_job(callback_query: types.CallbackQuery, title, func, *args, parse_mode=None, key=None):
+    """Запускает тяжёлую операцию в фоне; прогресс и результат выводятся в сообщение с кнопкой."""
+    user_id = callback_query.from_user.id
+    return jobs.submit(
+        title, func, *args,
+        key=key,
+        owner_id=user_id,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        done_markup=get_main_menu_markup(user_id),
+        parse_mode=parse_mode,
+        cancel_markup=lambda job: InlineKeyboardMarkup().add(
+            InlineKeyboardButton("✖️ Отменить", callback_data=router.encode("cancel_job", job.id))
+        )
+    )
 
+@metrics.timed('generate_vpn_key')
 async def generate_vpn_key(conf_path: str) -> str:
     process = await asyncio.create_subprocess_exec(
         'python3.11', '/root/amnezia-bot/awg/awg-decode.py', '--encode', conf_path,
@@ -164,41 +299,175 @@ async def generate_vpn_key(conf_path: str) -> str:
         logger.error(f"Ошибка генерации vpn://: {stderr.decode()}")
         return ""
 
-async def issue_vpn_key(user_id: int, period: str) -> bool:
+async def issue_vpn_key(user_id: int, period: str, discount: float = 0) -> bool:
     username = f"user_{user_id}_{uuid.uuid4().hex[:8]}"
-    success = db.root_add(username, ipv6=False)
+    success = await asyncio.to_thread(db.root_add, username, False)
     if success:
+        user_index.add(username)
+        search.add(username, user_id)
         months = {'1_month': 1, '3_months': 3, '6_months': 6, '12_months': 12}.get(period, 1)
         expiration = datetime.now(pytz.utc) + timedelta(days=30 * months)
-        db.set_user_expiration(username, expiration, "Неограниченно")
+        entry = db.set_user_expiration(username, expiration, "Неограниченно", period)
         db.set_user_telegram_id(username, user_id)
+        subscriptions.update(username, expiration=expiration, period=period, owner=user_id, created=entry.get('created'))
+        stats_board.record_add(period, config.pricing.get(period, 0) * (1 - discount / 100))
         conf_path = os.path.join('users', username, f'{username}.conf')
         if os.path.exists(conf_path):
             vpn_key = await generate_vpn_key(conf_path)
             caption = f"Ваш VPN ключ ({period.replace('_', ' ')}):\nAmneziaVPN:\n[Google Play](https://play.google.com/store/apps/details?id=org.amnezia.vpn&hl=ru)\n[GitHub](https://github.com/amnezia-vpn/amnezia-client)\n```\n{vpn_key}\n```"
-            with open(conf_path, 'rb') as config:
-                config_message = await bot.send_document(user_id, config, caption=caption, parse_mode="Markdown")
-                await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
+            config_message = await file_cache.send_cached_document(bot, user_id, conf_path, caption=caption, parse_mode="Markdown")
+            await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
             return True
     return False
 
+async def report_broadcast_progress(job_id, done, total, sent, failed):
+    job = broadcast.get_job(job_id)
+    if not job or not job.get('progress_message'):
+        return
+    chat_id, message_id = job['progress_message']
+    status = "✅ Рассылка завершена" if done >= total else "📣 Рассылка выполняется"
+    await bot.edit_message_text(
+        f"{status}: {done}/{total}\nДоставлено: {sent}, ошибок: {failed}",
+        chat_id=chat_id,
+        message_id=message_id
+    )
+
+async def run_broadcast_job(job_id):
+    try:
+        await broadcast.run_job(outbox, job_id, on_progress=report_broadcast_progress)
+    except Exception as e:
+        logger.error(f"Ошибка рассылки {job_id}: {str(e)}")
+
+async def send_expiry_reminders():
+    recipients = broadcast.collect_reminders(subscriptions=subscriptions)
+    if recipients:
+        job_id = broadcast.create_job(None, recipients, segment='reminder')
+        logger.info(f"Напоминания об окончании подписки: {len(recipients)}, задание {job_id}")
+        await run_broadcast_job(job_id)
+
+scheduler.add_job(send_expiry_reminders, 'interval', hours=1)
+scheduler.add_job(user_states.purge_expired, 'interval', hours=1)
+
+online_peers = metrics.gauge('awg_online_peers', "Клиенты онлайн по последнему handshake")
+storage_bytes = metrics.gauge('awg_storage_bytes', "Размер данных бота на диске", ('dir',))
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def measure_slow_metrics():
+    names = list(user_index.names)
+    online = sum(1 for name in names if db.is_online(db.get_last_handshake(name)))
+    sizes = {directory: directory_size(directory) for directory in ('files', 'users')}
+    return online, sizes, top_traffic(names)
+
+async def refresh_slow_metrics():
+    """Метрики, требующие обхода файлов, считаются в фоне раз в минуту, а не при каждом запросе /metrics."""
+    online, sizes, traffic = await asyncio.to_thread(measure_slow_metrics)
+    online_peers.set(online)
+    stats_board.set_snapshot(online, traffic)
+    for directory, size in sizes.items():
+        storage_bytes.set(size, directory)
+
+@metrics.REGISTRY.collector
+def collect_runtime_metrics():
+    outbox_stats = outbox.get_stats()
+    lane_stats = update_lanes.get_stats()
+    dedup = guard.get_stats()
+    throttle = throttling.get_stats()
+    return [
+        ('awg_clients', 'gauge', "Число клиентов", {(): len(user_index.names)}),
+        ('awg_queue_depth', 'gauge', "Глубина очередей", {
+            (('queue', 'outbox_interactive'),): outbox_stats['depth_interactive'],
+            (('queue', 'outbox_bulk'),): outbox_stats['depth_bulk'],
+            (('queue', 'outbox_delayed'),): outbox_stats['depth_delayed'],
+            (('queue', 'deferred'),): deferred.pending(),
+            (('queue', 'jobs_active'),): len(jobs.active()),
+            (('queue', 'update_lanes'),): sum(lane['depth'] for lane in lane_stats['lanes'])
+        }),
+        ('awg_lane_blocked_total', 'counter', "Ожидания места в очереди обновлений", {(): lane_stats['blocked']}),
+        ('awg_outbox_total', 'counter', "Исходящие сообщения по результату", {
+            (('result', key),): outbox_stats[key] for key in ('sent', 'retried', 'dropped', 'flood_waits')
+        }),
+        ('awg_dedup_total', 'counter', "Запросы, прошедшие через защиту от повторов", {
+            (('result', key),): dedup[key] for key in ('executed', 'joined', 'cached', 'redelivered', 'failed')
+        }),
+        ('awg_throttled_total', 'counter', "Запросы, отброшенные ограничением частоты", {
+            (('action', action),): count for action, count in throttle['throttled_actions'].items()
+        }),
+        ('awg_throttle_bans_total', 'counter', "Временные блокировки за флуд", {(): throttle['bans']})
+    ]
+
+scheduler.add_job(refresh_slow_metrics, 'interval', minutes=1)
+
+async def run_reconcile(fix=None):
+    """Сверка клиентов между users/, сервером и JSON-файлами; исправляет, если включено reconcile_fix."""
+    if fix is None:
+        fix = bool(config.get('reconcile_fix', False))
+    try:
+        result = await asyncio.to_thread(reconcile.run, DOCKER_CONTAINER, WG_CONFIG_FILE, fix)
+    except Exception as e:
+        logger.error(f"Ошибка сверки клиентов: {str(e)}")
+        return None
+    if result.count() or result.skipped:
+        logger.warning("\n".join(result.report()))
+    if result.fixed:
+        await refresh_after_reconcile()
+    return result
+
+async def refresh_after_reconcile():
+    """Сверка перенесла каталоги и удалила сроки и привязки в обход бота: состояние в памяти
+    обновляется так же, как после удаления клиента, чтобы список и статистика не показывали удалённых."""
+    before = set(user_index.names)
+    # users/ изменился, поэтому refresh() перестроит индекс; обход каталога - в потоке
+    await asyncio.to_thread(user_index.refresh)
+    removed = before.difference(user_index.names)
+    for username in removed:
+        file_cache.invalidate(os.path.join('users', username, f'{username}.conf'))
+    user_states.clear_states(lambda state: state.startswith('waiting_for_custom_date:')
+                             and state.partition(':')[2] in removed)
+    subscriptions.refresh()
+    stats_board.refresh()
+    stats_board.drop_clients(removed)
+    await sync_search()
+    if removed:
+        logger.info(f"После сверки из индексов убраны клиенты: {len(removed)}")
+
+scheduler.add_job(run_reconcile, 'interval', hours=int(setting.get('reconcile_interval_hours', 6)))
+
+async def on_startup(dispatcher):
+    deferred.start()
+    loop_watchdog.start()
+    config.start()
+    metrics_port = int(setting.get('metrics_port', metrics.DEFAULT_PORT))
+    if metrics_port:
+        try:
+            await metrics.start_server(setting.get('metrics_host', metrics.DEFAULT_HOST), metrics_port)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {str(e)}")
+        asyncio.create_task(refresh_slow_metrics())
+    for job_id in broadcast.get_unfinished_jobs():
+        logger.info(f"Возобновление рассылки {job_id}")
+        asyncio.create_task(run_broadcast_job(job_id))
+    asyncio.create_task(run_reconcile())
+
 @dp.message_handler(commands=['start', 'help'])
 async def start_command_handler(message: types.Message):
     user_id = message.from_user.id
-    if user_id in user_main_messages:
+    previous = user_states.get(user_id)
+    if previous:
         try:
-            await bot.delete_message(
-                chat_id=user_main_messages[user_id]['chat_id'],
-                message_id=user_main_messages[user_id]['message_id']
-            )
+            await bot.delete_message(chat_id=previous.chat_id, message_id=previous.message_id)
         except:
             pass
     sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
 
 @dp.message_handler(commands=['add_admin'])
 async def add_admin_command(message: types.Message):
@@ -209,281 +478,368 @@ async def add_admin_command(message: types.Message):
         new_admin_id = int(message.text.split()[1])
         if new_admin_id not in admins:
             db.add_admin(new_admin_id)
-            admins.append(new_admin_id)
+            config.reload()
             await message.answer(f"Админ {new_admin_id} добавлен.")
-            await bot.send_message(new_admin_id, "Вы назначены администратором!")
+            outbox.send_message(new_admin_id, "Вы назначены администратором!", priority=PRIORITY_INTERACTIVE)
     except:
         await message.answer("Формат: /add_admin <user_id>")
 
-@dp.message_handler()
-async def handle_messages(message: types.Message):
-    global PRICING
+async def sync_search():
+    """Если клиентов изменили в обход бота, поисковый индекс перестраивается в потоке,
+    а не в обработчике: на 50 тысячах клиентов это около секунды."""
+    fresh = await asyncio.to_thread(search.rebuilt, user_index)
+    if fresh is not None:
+        search.adopt(fresh, user_index)
+
+async def find_clients(query, limit=50):
+    await sync_search()
+    return search.search(query, limit)
+
+@dp.message_handler(commands=['find'])
+async def find_command(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in admins and user_id not in moderators:
+        await message.answer("У вас нет прав.")
+        return
+    query = message.get_args().strip()
+    if not query:
+        await message.answer("Формат: /find <часть имени, Telegram ID или заметки>")
+        return
+    names = await find_clients(query, limit=20)
+    if not names:
+        await message.answer(f"По запросу «{query}» ничего не найдено.")
+        return
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for username in names:
+        keyboard.insert(InlineKeyboardButton(username, callback_data=router.encode("client", username)))
+    keyboard.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+    sent_message = await message.answer(f"Найдено: {len(names)}", reply_markup=keyboard)
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+@dp.message_handler(commands=['note'])
+async def note_command(message: types.Message):
+    if message.from_user.id not in admins and message.from_user.id not in moderators:
+        await message.answer("У вас нет прав.")
+        return
+    parts = message.get_args().split(maxsplit=1)
+    if not parts:
+        await message.answer("Формат: /note <имя_пользователя> <текст заметки>")
+        return
+    username = parts[0]
+    note = parts[1] if len(parts) > 1 else None
+    if not os.path.exists(os.path.join('users', username, f'{username}.conf')):
+        await message.answer(f"Пользователь {username} не найден.")
+        return
+    db.set_user_note(username, note)
+    await sync_search()
+    search.add(username, db.get_user_telegram_id(username), note)
+    await message.answer(f"Заметка для {username} {'сохранена' if note else 'удалена'}.")
+
+@dp.inline_handler()
+async def inline_search_handler(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    if user_id not in admins and user_id not in moderators:
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
+    results = []
+    for username in await find_clients(inline_query.query):
+        telegram_id, note = search.get(username)
+        description = " · ".join(filter(None, [f"TG: {telegram_id}" if telegram_id else None, note]))
+        results.append(types.InlineQueryResultArticle(
+            id=hashlib.md5(username.encode()).hexdigest(),
+            title=username,
+            description=description or None,
+            input_message_content=types.InputTextMessageContent(f"/find {username}")
+        ))
+    await inline_query.answer(results, cache_time=5, is_personal=True)
+
+async def process_user_name_input(message: types.Message, arg: str):
+    """Ввод имени нового клиента."""
     user_id = message.from_user.id
-    user_state = user_main_messages.get(user_id, {}).get('state')
+    user_name = message.text.strip()
+    if not re.match(r'^[a-zA-Z0-9_-]+$', user_name):
+        await message.reply("Имя может содержать только буквы, цифры, - и _.")
+        return
 
-    if user_state == 'waiting_for_user_name':
-        user_name = message.text.strip()
-        if not re.match(r'^[a-zA-Z0-9_-]+$', user_name):
-            await message.reply("Имя может содержать только буквы, цифры, - и _.")
-            return
-        success = db.root_add(user_name, ipv6=False)
+    async def add_client():
+        success = await asyncio.to_thread(db.root_add, user_name, False)
         if success:
+            user_index.add(user_name)
+            search.add(user_name)
+            stats_board.record_add()
             conf_path = os.path.join('users', user_name, f'{user_name}.conf')
             if os.path.exists(conf_path):
                 vpn_key = await generate_vpn_key(conf_path)
                 caption = f"Конфигурация для {user_name}:\nAmneziaVPN:\n[Google Play](https://play.google.com/store/apps/details?id=org.amnezia.vpn&hl=ru)\n[GitHub](https://github.com/amnezia-vpn/amnezia-client)\n```\n{vpn_key}\n```"
-                with open(conf_path, 'rb') as config:
-                    config_message = await bot.send_document(user_id, config, caption=caption, parse_mode="Markdown")
-                    await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
+                config_message = await file_cache.send_cached_document(bot, user_id, conf_path, caption=caption, parse_mode="Markdown")
+                await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
+        return success
+
+    # Повторная отправка того же имени не создаёт второго клиента
+    await guard.run((user_id, 'add_client', user_name), add_client, request_id=(message.chat.id, message.message_id))
+    sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+async def process_admin_id_input(message: types.Message, arg: str):
+    """Ввод Telegram ID нового админа."""
+    user_id = message.from_user.id
+    try:
+        new_admin_id = int(message.text.strip())
+        if new_admin_id not in admins:
+            db.add_admin(new_admin_id)
+            config.reload()
+            await message.reply(f"Админ {new_admin_id} добавлен.")
+            outbox.send_message(new_admin_id, "Вы назначены администратором!", priority=PRIORITY_INTERACTIVE)
         sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
-    elif user_state == 'waiting_for_admin_id' and user_id in admins:
-        try:
-            new_admin_id = int(message.text.strip())
-            if new_admin_id not in admins:
-                db.add_admin(new_admin_id)
-                admins.append(new_admin_id)
-                await message.reply(f"Админ {new_admin_id} добавлен.")
-                await bot.send_message(new_admin_id, "Вы назначены администратором!")
-            sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-            user_main_messages[user_id] = {
-                'chat_id': sent_message.chat.id,
-                'message_id': sent_message.message_id,
-                'state': None
-            }
-        except:
-            await message.reply("Введите корректный Telegram ID.")
-    elif user_state == 'waiting_for_promocode':
-        promocode = message.text.strip()
+        user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+    except:
+        await message.reply("Введите корректный Telegram ID.")
+
+async def process_promocode_input(message: types.Message, arg: str):
+    """Активация промокода пользователем."""
+    user_id = message.from_user.id
+    promocode = message.text.strip()
+
+    async def activate():
         promocode_data = db.apply_promocode(promocode)
-        if promocode_data:
-            subscription_period = promocode_data.get('subscription_period')
-            if subscription_period:
-                success = await issue_vpn_key(user_id, subscription_period)
-                if success:
-                    await message.reply(f"Промокод активирован! VPN ключ на {subscription_period.replace('_', ' ')} выдан.")
-                else:
-                    await message.reply("Ошибка при выдаче ключа. Обратитесь к администратору.")
-            else:
-                await message.reply("Промокод не предоставляет ключ.")
-        else:
-            await message.reply("Неверный или истёкший промокод.")
-        sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
-    elif user_state == 'waiting_for_new_promocode' and user_id in admins:
-        try:
-            parts = message.text.strip().split()
-            if len(parts) != 5:
-                raise ValueError("Неверный формат")
-            code, discount, days_valid, max_uses, subscription_period = parts
-            discount = float(discount)
-            days_valid = int(days_valid)
-            max_uses = int(max_uses) if max_uses.lower() != 'none' else None
-            if subscription_period not in ['none', '1_month', '3_months', '6_months', '12_months']:
-                raise ValueError("Неверный период подписки")
-            subscription_period = None if subscription_period.lower() == 'none' else subscription_period
-            expires_at = datetime.now(pytz.utc) + timedelta(days=days_valid) if days_valid > 0 else None
-            if db.add_promocode(code, discount, expires_at, max_uses, subscription_period):
-                await message.reply(
-                    f"Промокод {code} добавлен: скидка {discount}%, действует {days_valid} дней, "
-                    f"макс. использований: {max_uses or 'неограничено'}, период подписки: {subscription_period or 'нет'}"
-                )
-            else:
-                await message.reply("Промокод уже существует.")
-        except:
+        if not promocode_data:
+            return "Неверный или истёкший промокод."
+        stats_board.record_redeem(promocode)
+        subscription_period = promocode_data.get('subscription_period')
+        if not subscription_period:
+            return "Промокод не предоставляет ключ."
+        if await issue_vpn_key(user_id, subscription_period, promocode_data.get('discount') or 0):
+            return f"Промокод активирован! VPN ключ на {subscription_period.replace('_', ' ')} выдан."
+        return "Ошибка при выдаче ключа. Обратитесь к администратору."
+
+    # Двойная отправка промокода получает ответ первой, а не выдаёт второй ключ
+    reply, _ = await guard.run((user_id, 'promocode', promocode), activate, request_id=(message.chat.id, message.message_id))
+    await message.reply(reply)
+    sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+async def process_new_promocode_input(message: types.Message, arg: str):
+    """Создание промокода админом."""
+    user_id = message.from_user.id
+    try:
+        parts = message.text.strip().split()
+        if len(parts) != 5:
+            raise ValueError("Неверный формат")
+        code, discount, days_valid, max_uses, subscription_period = parts
+        discount = float(discount)
+        days_valid = int(days_valid)
+        max_uses = int(max_uses) if max_uses.lower() != 'none' else None
+        if subscription_period not in ['none', '1_month', '3_months', '6_months', '12_months']:
+            raise ValueError("Неверный период подписки")
+        subscription_period = None if subscription_period.lower() == 'none' else subscription_period
+        expires_at = datetime.now(pytz.utc) + timedelta(days=days_valid) if days_valid > 0 else None
+        if db.add_promocode(code, discount, expires_at, max_uses, subscription_period):
             await message.reply(
-                "Формат: <код> <скидка%> <дней_действия> <макс_использований|none> <период_подписки|none>\n"
-                "Пример: PROMO1 10 30 none 1_month"
+                f"Промокод {code} добавлен: скидка {discount}%, действует {days_valid} дней, "
+                f"макс. использований: {max_uses or 'неограничено'}, период подписки: {subscription_period or 'нет'}"
             )
-        sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
-    elif user_state.startswith('waiting_for_price_') and user_id in admins:
-        period = user_state.split('waiting_for_price_')[1]
-        try:
-            price = float(message.text.strip())
-            if price <= 0:
-                raise ValueError("Цена должна быть положительной.")
-            db.set_pricing(period, price)
-            PRICING[period] = price
-            await message.reply(f"Цена для {period.replace('_', ' ')} обновлена: ₽{price:.2f}")
-        except:
-            await message.reply("Введите корректное число (например, 1000.00).")
-            return
-        sent_message = await message.answer("Настройки цен:", reply_markup=get_pricing_settings_menu())
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
-    elif user_state.startswith('waiting_for_custom_date_') and user_id in admins:
-        username = user_state.split('waiting_for_custom_date_')[1]
-        try:
-            expiration = datetime.strptime(message.text.strip(), '%d-%m-%Y').replace(tzinfo=pytz.utc)
-            if expiration < datetime.now(pytz.utc):
-                await message.reply("Дата должна быть в будущем.")
-                return
-            db.set_user_expiration(username, expiration, "Неограниченно")
-            await message.reply(f"Подписка для {username} продлена до {expiration.strftime('%d-%m-%Y')}.")
-        except:
-            await message.reply("Введите дату в формате ДД-ММ-ГГГГ (например, 31-12-2025).")
+        else:
+            await message.reply("Промокод уже существует.")
+    except:
+        await message.reply(
+            "Формат: <код> <скидка%> <дней_действия> <макс_использований|none> <период_подписки|none>\n"
+            "Пример: PROMO1 10 30 none 1_month"
+        )
+    sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+async def segment_recipients(segment):
+    """Получатели сегмента рассылки.
+
+    Сегменты 'all' и 'never_connected' читают user_telegram.json и status.json каждого клиента,
+    поэтому выбираются в потоке; сегменты по сроку - диапазон в таблице подписок, которую
+    event loop меняет без блокировок, поэтому они остаются в нём.
+    """
+    if segment in ('expired', 'expiring'):
+        return broadcast.select_recipients(segment, subscriptions=subscriptions)
+    return await asyncio.to_thread(broadcast.select_recipients, segment)
+
+async def process_broadcast_input(message: types.Message, segment: str):
+    """Текст рассылки для выбранного сегмента."""
+    user_id = message.from_user.id
+    recipients = await segment_recipients(segment)
+    if not recipients:
+        await message.reply("В выбранном сегменте нет получателей.")
+    else:
+        progress = await message.answer(f"📣 Рассылка выполняется: 0/{len(recipients)}")
+        job_id = broadcast.create_job(
+            message.text, recipients, admin_id=user_id, segment=segment,
+            progress_message=[progress.chat.id, progress.message_id]
+        )
+        asyncio.create_task(run_broadcast_job(job_id))
+    sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+async def process_price_input(message: types.Message, period: str):
+    """Новая цена для периода подписки."""
+    user_id = message.from_user.id
+    try:
+        price = float(message.text.strip())
+        if price <= 0:
+            raise ValueError("Цена должна быть положительной.")
+        db.set_pricing(period, price)
+        config.reload()
+        await message.reply(f"Цена для {period.replace('_', ' ')} обновлена: ₽{price:.2f}")
+    except:
+        await message.reply("Введите корректное число (например, 1000.00).")
+        return
+    sent_message = await message.answer("Настройки цен:", reply_markup=get_pricing_settings_menu())
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+async def process_custom_date_input(message: types.Message, username: str):
+    """Дата продления подписки клиента."""
+    user_id = message.from_user.id
+    try:
+        expiration = datetime.strptime(message.text.strip(), '%d-%m-%Y').replace(tzinfo=pytz.utc)
+        if expiration < datetime.now(pytz.utc):
+            await message.reply("Дата должна быть в будущем.")
             return
-        sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
+        db.set_user_expiration(username, expiration, "Неограниченно")
+        subscriptions.update(username, expiration=expiration)
+        await message.reply(f"Подписка для {username} продлена до {expiration.strftime('%d-%m-%Y')}.")
+    except:
+        await message.reply("Введите дату в формате ДД-ММ-ГГГГ (например, 31-12-2025).")
+        return
+    sent_message = await message.answer("Выберите действие:", reply_markup=get_main_menu_markup(user_id))
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
+
+# Состояние ожидания ввода -> (обработчик, только для админов)
+STATE_HANDLERS = {
+    'waiting_for_user_name': (process_user_name_input, False),
+    'waiting_for_admin_id': (process_admin_id_input, True),
+    'waiting_for_promocode': (process_promocode_input, False),
+    'waiting_for_new_promocode': (process_new_promocode_input, True),
+    'waiting_for_broadcast': (process_broadcast_input, True),
+    'waiting_for_price': (process_price_input, True),
+    'waiting_for_custom_date': (process_custom_date_input, True)
+}
 
-@dp.callback_query_handler(lambda c: c.data == "settings")
+@dp.message_handler()
+async def handle_messages(message: types.Message):
+    user_id = message.from_user.id
+    user_state = user_states.get_state(user_id)
+    if not user_state:
+        return
+    name, _, arg = user_state.partition(':')
+    handler, admin_only = STATE_HANDLERS.get(name, (None, False))
+    if handler is None or (admin_only and user_id not in admins):
+        return
+    with metrics.handler_seconds.time('input', name):
+        await handler(message, arg)
+
+@router.action("settings")
 async def settings_menu_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Настройки:",
         reply_markup=get_settings_menu()
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "pricing_settings")
+@router.action("broadcast")
+async def broadcast_menu_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    await render(
+        callback_query,
+        text="Кому отправить рассылку?",
+        reply_markup=get_broadcast_segments_keyboard()
+    )
+    await callback_query.answer()
+
+@router.action("broadcast_segment")
+async def broadcast_segment_callback(callback_query: types.CallbackQuery, segment: str):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    if segment not in broadcast.SEGMENTS:
+        await callback_query.answer("Неизвестный сегмент.", show_alert=True)
+        return
+    count = len(await segment_recipients(segment))
+    await render(
+        callback_query,
+        text=f"Сегмент: {broadcast.SEGMENTS[segment]} (получателей: {count}).\nВведите текст рассылки:",
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("Отмена", callback_data="home")),
+        state=f'waiting_for_broadcast:{segment}'
+    )
+    await callback_query.answer()
+
+@router.action("pricing_settings")
 async def pricing_settings_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Настройки цен:",
         reply_markup=get_pricing_settings_menu()
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('set_price_'))
-async def set_price_callback(callback_query: types.CallbackQuery):
+@router.action("set_price", legacy_prefix="set_price_")
+async def set_price_callback(callback_query: types.CallbackQuery, period: str):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    period = callback_query.data.split('set_price_')[1]
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text=f"Введите новую цену для {period.replace('_', ' ')} в рублях (например, 1000.00):",
-        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ Назад", callback_data="pricing_settings"))
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ Назад", callback_data="pricing_settings")),
+        state=f'waiting_for_price:{period}'
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': f'waiting_for_price_{period}'
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_user")
+@router.action("add_user")
 async def prompt_for_user_name(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Введите имя пользователя:",
-        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home")),
+        state='waiting_for_user_name'
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': 'waiting_for_user_name'
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_admin")
+@router.action("add_admin")
 async def prompt_for_admin_id(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Введите Telegram ID нового админа:",
-        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("Отмена", callback_data="home"))
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("Отмена", callback_data="home")),
+        state='waiting_for_admin_id'
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': 'waiting_for_admin_id'
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('client_'))
-async def client_selected_callback(callback_query: types.CallbackQuery):
+@router.action("client", legacy_prefix="client_")
+async def client_selected_callback(callback_query: types.CallbackQuery, username: str):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
 
     try:
-        username = callback_query.data.split('client_')[1]
-        clients = db.get_client_list()
-        client_info = next((c for c in clients if c[0] == username), None)
-        if not client_info:
+        if not os.path.exists(os.path.join('users', username, f'{username}.conf')):
             await callback_query.answer("Пользователь не найден.", show_alert=True)
             return
 
@@ -491,11 +847,10 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
         expiration = db.get_user_expiration(username)
         expiration_text = expiration.strftime("%Y-%m-%d %H:%M UTC") if expiration else "Не установлен"
 
-        active_clients = db.get_active_list()
-        active_info = next((ac for ac in active_clients if ac[0] == username), None)
-        if active_info and active_info[1] and active_info[1].lower() not in ['never', 'нет данных', '-']:
+        last_handshake = db.get_last_handshake(username)
+        if db.is_online(last_handshake):
             try:
-                last_handshake = datetime.strptime(active_info[1], "%Y-%m-%d %H:%M:%S")
+                last_handshake = datetime.strptime(last_handshake, "%Y-%m-%d %H:%M:%S")
                 status = "🟢 Онлайн" if (datetime.now(pytz.utc) - last_handshake).total_seconds() <= 60 else "❌ Офлайн"
             except:
                 pass
@@ -507,128 +862,76 @@ async def client_selected_callback(callback_query: types.CallbackQuery):
         )
 
         keyboard = InlineKeyboardMarkup(row_width=2).add(
-            InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_user_{username}"),
-            InlineKeyboardButton("🔄 Продлить", callback_data=f"renew_user_{username}"),
+            InlineKeyboardButton("🗑️ Удалить", callback_data=router.encode("delete_user", username)),
+            InlineKeyboardButton("🔄 Продлить", callback_data=router.encode("renew_user", username)),
             InlineKeyboardButton("⬅️ Назад", callback_data="list_users"),
             InlineKeyboardButton("🏠 Домой", callback_data="home")
         )
+        owner_id = db.get_user_telegram_id(username)
+        if owner_id:
+            keyboard.add(InlineKeyboardButton("👤 Все ключи владельца", callback_data=router.encode("list_users", f"u{owner_id}")))
 
-        try:
-            await bot.delete_message(
-                chat_id=callback_query.message.chat.id,
-                message_id=callback_query.message.message_id
-            )
-        except:
-            pass
-        sent_message = await bot.send_message(
-            chat_id=callback_query.message.chat.id,
+        await render(
+            callback_query,
             text=text,
             parse_mode="Markdown",
             reply_markup=keyboard
         )
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
         await callback_query.answer()
 
     except Exception as e:
         logger.error(f"Ошибка в client_selected_callback: {str(e)}")
-        sent_message = await bot.send_message(
-            chat_id=callback_query.message.chat.id,
+        await render(
+            callback_query,
             text=f"Ошибка при загрузке профиля: {str(e)}",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("⬅️ Назад", callback_data="list_users"),
                 InlineKeyboardButton("🏠 Домой", callback_data="home")
             )
         )
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
         await callback_query.answer("Ошибка на сервере.", show_alert=True)
 
-@dp.callback_query_handler(lambda c: c.data == "list_users")
-async def list_users_callback(callback_query: types.CallbackQuery):
+@router.action("list_users")
+async def list_users_callback(callback_query: types.CallbackQuery, filter_name: str = 'all', direction: str = 'a', cursor: str = ''):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
 
     try:
-        clients = db.get_client_list()
-        if not clients:
-            try:
-                await bot.delete_message(
-                    chat_id=callback_query.message.chat.id,
-                    message_id=callback_query.message.message_id
-                )
-            except:
-                pass
-            sent_message = await bot.send_message(
-                chat_id=callback_query.message.chat.id,
+        if not len(user_index):
+            await render(
+                callback_query,
                 text="Список клиентов пуст.",
                 reply_markup=InlineKeyboardMarkup().add(
                     InlineKeyboardButton("🏠 Домой", callback_data="home")
                 )
             )
-            user_main_messages[user_id] = {
-                'chat_id': sent_message.chat.id,
-                'message_id': sent_message.message_id,
-                'state': None
-            }
             await callback_query.answer()
             return
 
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        active_clients = {client[0]: client[1] for client in db.get_active_list()}
-        for client in clients:
-            username = client[0]
-            last_handshake = active_clients.get(username)
-            status = "❌" if not last_handshake or last_handshake.lower() in ['never', 'нет данных', '-'] else "🟢"
-            button_text = f"{status} {username}"
-            keyboard.insert(InlineKeyboardButton(button_text, callback_data=f"client_{username}"))
-
-        keyboard.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+        keyboard, names = get_user_page_keyboard("list_users", "client", filter_name, direction, cursor, with_status=True)
+        text = f"Выберите пользователя (всего: {len(user_index)}):" if names else "По этому фильтру клиентов нет."
 
-        try:
-            await bot.delete_message(
-                chat_id=callback_query.message.chat.id,
-                message_id=callback_query.message.message_id
-            )
-        except:
-            pass
-        sent_message = await bot.send_message(
-            chat_id=callback_query.message.chat.id,
-            text="Выберите пользователя:",
+        await render(
+            callback_query,
+            text=text,
             reply_markup=keyboard
         )
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
         await callback_query.answer()
 
     except Exception as e:
         logger.error(f"Ошибка в list_users_callback: {str(e)}")
-        sent_message = await bot.send_message(
-            chat_id=callback_query.message.chat.id,
+        await render(
+            callback_query,
             text=f"Ошибка: {str(e)}",
             reply_markup=InlineKeyboardMarkup().add(
                 InlineKeyboardButton("🏠 Домой", callback_data="home")
             )
         )
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
         await callback_query.answer("Ошибка на сервере.", show_alert=True)
 
-@dp.callback_query_handler(lambda c: c.data == "list_admins")
+@router.action("list_admins")
 async def list_admins_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
@@ -636,247 +939,166 @@ async def list_admins_callback(callback_query: types.CallbackQuery):
         return
     keyboard = InlineKeyboardMarkup(row_width=2)
     for admin_id in admins:
-        keyboard.insert(InlineKeyboardButton(f"🗑️ Удалить {admin_id}", callback_data=f"remove_admin_{admin_id}"))
+        keyboard.insert(InlineKeyboardButton(f"🗑️ Удалить {admin_id}", callback_data=router.encode("remove_admin", admin_id)))
     keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="settings"))
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text=f"Администраторы:\n" + "\n".join(f"- {admin_id}" for admin_id in admins),
         reply_markup=keyboard
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('remove_admin_'))
-async def remove_admin_callback(callback_query: types.CallbackQuery):
+@router.action("remove_admin", legacy_prefix="remove_admin_")
+async def remove_admin_callback(callback_query: types.CallbackQuery, admin_id: str):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    admin_id = int(callback_query.data.split('_')[2])
+    admin_id = int(admin_id)
     if admin_id not in admins or len(admins) <= 1:
         await callback_query.answer("Нельзя удалить последнего админа или несуществующего.", show_alert=True)
         return
     db.remove_admin(admin_id)
-    admins.remove(admin_id)
-    await bot.send_message(admin_id, "Вы удалены из администраторов.")
+    config.reload()
+    outbox.send_message(admin_id, "Вы удалены из администраторов.", priority=PRIORITY_INTERACTIVE)
     await list_admins_callback(callback_query)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('delete_user_'))
-async def client_delete_callback(callback_query: types.CallbackQuery):
+async def delete_client_job(report, username):
+    await report(f"Удаление {username} из WireGuard...")
+    # После начала деактивации отмена оставила бы клиента удалённым наполовину
+    # (пир убран, а каталог, сроки и индексы остались), поэтому удаление доводится до конца
+    task = asyncio.ensure_future(_delete_client(report, username))
+    while True:
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.done():
+                raise
+            logger.warning(f"Отмена удаления {username} отклонена: удаление уже началось.")
+
+async def _delete_client(report, username):
+    if not await asyncio.to_thread(db.deactive_user_db, username):
+        logger.error(f"Не удалось удалить пользователя {username} через db.deactive_user_db.")
+        return f"Не удалось удалить **{username}**. Проверьте логи."
+    await report("Очистка данных пользователя...")
+    file_cache.invalidate(os.path.join('users', username, f'{username}.conf'))
+    await asyncio.to_thread(shutil.rmtree, os.path.join('users', username), True)
+    user_index.remove(username)
+    search.remove(username)
+    db.remove_user_expiration(username)
+    db.set_user_telegram_id(username, None)
+    subscriptions.remove(username)
+    logger.info(f"Пользователь {username} успешно удалён.")
+    return f"Пользователь **{username}** удалён."
+
+@router.action("delete_user", legacy_prefix="delete_user_")
+async def client_delete_callback(callback_query: types.CallbackQuery, username: str):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    username = callback_query.data.split('delete_user_')[1]
-    try:
-        if db.deactive_user_db(username):
-            shutil.rmtree(os.path.join('users', username), ignore_errors=True)
-            db.remove_user_expiration(username)
-            db.set_user_telegram_id(username, None)
-            logger.info(f"Пользователь {username} успешно удалён.")
-            text = f"Пользователь **{username}** удалён."
-        else:
-            logger.error(f"Не удалось удалить пользователя {username} через db.deactive_user_db.")
-            text = f"Не удалось удалить **{username}**. Проверьте логи."
-    except Exception as e:
-        logger.error(f"Ошибка при удалении пользователя {username}: {str(e)}")
-        text = f"Ошибка при удалении **{username}**: {str(e)}"
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
-        text=text,
-        parse_mode="Markdown",
-        reply_markup=get_main_menu_markup(user_id)
-    )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
-    await callback_query.answer()
+    # Обработчик только ставит задачу, поэтому повтор отсекается по задаче, пока она не завершена
+    if jobs.find(('delete', username)):
+        await callback_query.answer("Удаление уже запущено.", show_alert=True)
+        return
+    await callback_query.answer("Удаление запущено.")
+    start_job(callback_query, f"удаление {username}", delete_client_job, username,
+              parse_mode="Markdown", key=('delete', username))
 
-@dp.callback_query_handler(lambda c: c.data.startswith('renew_user_'))
-async def renew_user_callback(callback_query: types.CallbackQuery):
+@router.action("renew_user", legacy_prefix="renew_user_")
+async def renew_user_callback(callback_query: types.CallbackQuery, username: str):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    username = callback_query.data.split('renew_user_')[1]
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Выберите период продления или укажите дату:",
         reply_markup=get_renewal_period_keyboard(username)
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('renew_period_'))
-async def renew_period_callback(callback_query: types.CallbackQuery):
+async def renew_client_job(report, username, period):
+    months = {'1_month': 1, '3_months': 3, '6_months': 6, '12_months': 12}[period]
+    expiration = datetime.now(pytz.utc) + timedelta(days=30 * months)
+    await asyncio.to_thread(db.set_user_expiration, username, expiration, "Неограниченно", period)
+    subscriptions.update(username, expiration=expiration, period=period)
+    stats_board.record_renew(period, config.pricing.get(period, 0))
+    logger.info(f"Подписка для {username} продлена на {period} до {expiration}.")
+    return f"Подписка для {username} продлена до {expiration.strftime('%Y-%m-%d %H:%M UTC')}."
+
+@router.action("renew_period")
+async def renew_period_callback(callback_query: types.CallbackQuery, username: str, period: str):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
     try:
-        parts = callback_query.data.split('renew_period_')[1].split('_', 1)
-        username = parts[0]
-        period = parts[1] if len(parts) > 1 else 'custom_date'
         if period == 'custom_date':
-            try:
-                await bot.delete_message(
-                    chat_id=callback_query.message.chat.id,
-                    message_id=callback_query.message.message_id
-                )
-            except:
-                pass
-            sent_message = await bot.send_message(
-                chat_id=callback_query.message.chat.id,
+            await render(
+                callback_query,
                 text="Введите дату продления в формате ДД-ММ-ГГГГ (например, 31-12-2025):",
-                reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("Отмена", callback_data="home"))
+                reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("Отмена", callback_data="home")),
+                state=f'waiting_for_custom_date:{username}'
             )
-            user_main_messages[user_id] = {
-                'chat_id': sent_message.chat.id,
-                'message_id': sent_message.message_id,
-                'state': f'waiting_for_custom_date_{username}'
-            }
+            await callback_query.answer()
+        elif jobs.find(('renew', username)):
+            await callback_query.answer("Продление уже выполняется.", show_alert=True)
         else:
-            months = {'1_month': 1, '3_months': 3, '6_months': 6, '12_months': 12}[period]
-            expiration = datetime.now(pytz.utc) + timedelta(days=30 * months)
-            db.set_user_expiration(username, expiration, "Неограниченно")
-            text = f"Подписка для {username} продлена до {expiration.strftime('%Y-%m-%d %H:%M UTC')}."
-            logger.info(f"Подписка для {username} продлена на {period} до {expiration}.")
-            try:
-                await bot.delete_message(
-                    chat_id=callback_query.message.chat.id,
-                    message_id=callback_query.message.message_id
-                )
-            except:
-                pass
-            sent_message = await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=text,
-                parse_mode="Markdown",
-                reply_markup=get_main_menu_markup(user_id)
-            )
-            user_main_messages[user_id] = {
-                'chat_id': sent_message.chat.id,
-                'message_id': sent_message.message_id,
-                'state': None
-            }
-        await callback_query.answer()
+            await callback_query.answer("Продление запущено.")
+            start_job(callback_query, f"продление {username}", renew_client_job, username, period,
+                      key=('renew', username))
     except Exception as e:
         text = f"Ошибка при продлении: {str(e)}"
         logger.error(f"Ошибка при продлении подписки для {username}: {str(e)}")
-        sent_message = await bot.send_message(
-            chat_id=callback_query.message.chat.id,
+        await render(
+            callback_query,
             text=text,
             parse_mode="Markdown",
             reply_markup=get_main_menu_markup(user_id)
         )
-        user_main_messages[user_id] = {
-            'chat_id': sent_message.chat.id,
-            'message_id': sent_message.message_id,
-            'state': None
-        }
         await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "home")
+@router.action("home")
 async def return_home(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Выберите действие:",
         reply_markup=get_main_menu_markup(user_id)
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "get_config")
-async def list_users_for_config(callback_query: types.CallbackQuery):
+@router.action("get_config")
+async def list_users_for_config(callback_query: types.CallbackQuery, filter_name: str = 'all', direction: str = 'a', cursor: str = ''):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    clients = db.get_client_list()
-    if not clients:
+    if not len(user_index):
         await callback_query.answer("Список пуст.", show_alert=True)
         return
 
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    for client in clients:
-        keyboard.insert(InlineKeyboardButton(client[0], callback_data=f"send_config_{client[0]}"))
-    keyboard.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    keyboard, _ = get_user_page_keyboard("get_config", "send_config", filter_name, direction, cursor)
+    await render(
+        callback_query,
         text="Выберите пользователя:",
         reply_markup=keyboard
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('send_config_'))
-async def send_user_config(callback_query: types.CallbackQuery):
+@router.action("send_config", legacy_prefix="send_config_")
+async def send_user_config(callback_query: types.CallbackQuery, username: str):
     user_id = callback_query.from_user.id
     if user_id not in admins and user_id not in moderators:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    username = callback_query.data.split('send_config_')[1]
     conf_path = os.path.join('users', username, f'{username}.conf')
     if os.path.exists(conf_path):
         vpn_key = await generate_vpn_key(conf_path)
         caption = f"Конфигурация для {username}:\nAmneziaVPN:\n[Google Play](https://play.google.com/store/apps/details?id=org.amnezia.vpn&hl=ru)\n[GitHub](https://github.com/amnezia-vpn/amnezia-client)\n```\n{vpn_key}\n```"
-        with open(conf_path, 'rb') as config:
-            config_message = await bot.send_document(user_id, config, caption=caption, parse_mode="Markdown")
-            await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
+        config_message = await file_cache.send_cached_document(bot, user_id, conf_path, caption=caption, parse_mode="Markdown")
+        await bot.pin_chat_message(user_id, config_message.message_id, disable_notification=True)
     else:
         await bot.send_message(user_id, f"Конфигурация для **{username}** не найдена.", parse_mode="Markdown")
     sent_message = await bot.send_message(
@@ -884,90 +1106,207 @@ async def send_user_config(callback_query: types.CallbackQuery):
         text="Выберите действие:",
         reply_markup=get_main_menu_markup(user_id)
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
+    user_states.set(user_id, sent_message.chat.id, sent_message.message_id)
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "create_backup")
+async def backup_job(report, user_id):
+    loop = asyncio.get_running_loop()
+
+    def progress(count):
+        # Вызывается в потоке снимка: корутина создаётся и планируется уже в event loop
+        loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(report(f"Снимок files/ и users/: обработано файлов {count}..."))
+        )
+
+    await report("Снимок files/ и users/...")
+    manifest = await asyncio.to_thread(backups.snapshot, progress)
+    targets = backup_targets.make_targets(config.get('backup_targets'), bot, user_id)
+    if not targets:
+        return "❌ Не настроено ни одного места доставки бэкапа (backup_targets)."
+
+    async def volume_progress(sent, total):
+        await report(f"Отправлено томов: {sent}/{total}...")
+
+    await report("Сжатие и отправка томов...", force=True)
+    exported = await backups.export(
+        manifest, targets,
+        volume_size=int(float(config.get('backup_volume_mb', VOLUME_SIZE / 1024 / 1024)) * 1024 * 1024),
+        workers=int(config.get('backup_workers', EXPORT_WORKERS)),
+        progress=volume_progress
+    )
+    removed, _ = await asyncio.to_thread(backups.rotate)
+    return (f"💾 Бэкап создан и отправлен ({', '.join(target.name for target in targets)}).\n"
+            f"{backup.describe(manifest)}\nТомов: {len(exported['volumes'])}, манифест: {backup.manifest_name(manifest['id'])}"
+            + (f"\nУдалено старых снимков: {len(removed)}" if removed else ""))
+
+@router.action("create_backup")
 async def create_backup_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    backup_filename = f"backup_{datetime.now().strftime('%Y-%m-%d')}.zip"
-    with zipfile.ZipFile(backup_filename, 'w') as zipf:
-        for file in ['awg-decode.py', 'newclient.sh', 'removeclient.sh']:
-            if os.path.exists(file):
-                zipf.write(file)
-        for root, _, files in os.walk('files'):
-            for file in files:
-                zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), os.getcwd()))
-        for root, _, files in os.walk('users'):
-            for file in files:
-                zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), os.getcwd()))
-    with open(backup_filename, 'rb') as f:
-        await bot.send_document(user_id, f, caption=backup_filename)
-    os.remove(backup_filename)
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
-        text="Выберите действие:",
-        reply_markup=get_main_menu_markup(user_id)
+    # Бэкап один на сервер: пока задача в очереди или выполняется, новая не запускается
+    # (кем бы и когда ни была нажата кнопка)
+    if jobs.find('backup'):
+        await callback_query.answer("Бэкап уже создаётся.", show_alert=True)
+        return
+    await callback_query.answer("Создание бэкапа запущено.")
+    start_job(callback_query, "создание бэкапа", backup_job, user_id, key='backup')
+
+@router.action("jobs")
+async def jobs_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    job_list = jobs.list()
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for job in jobs.active():
+        keyboard.add(InlineKeyboardButton(f"✖️ Отменить {job.id}", callback_data=router.encode("cancel_job", job.id)))
+    keyboard.add(
+        InlineKeyboardButton("🔄 Обновить", callback_data="jobs"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="settings")
+    )
+    text = "Фоновые задачи:\n" + "\n".join(
+        f"{job.id} · {STATUS_TITLES[job.status]} · {job.title}" + (f" · {job.progress}" if job.progress and not job.finished else "")
+        for job in reversed(job_list)
+    ) if job_list else "Фоновых задач нет."
+    dedup = guard.get_stats()
+    text += (f"\n\nПовторные запросы: ожидали выполнения {dedup['joined']}, "
+             f"из кэша {dedup['cached']}, повторная доставка {dedup['redelivered']}")
+    await render(callback_query, text=text, reply_markup=keyboard)
+    await callback_query.answer()
+
+@router.action("cancel_job")
+async def cancel_job_callback(callback_query: types.CallbackQuery, job_id: str):
+    user_id = callback_query.from_user.id
+    job = jobs.get(job_id)
+    if not job or (user_id not in admins and job.owner_id != user_id):
+        await callback_query.answer("Задача не найдена.", show_alert=True)
+        return
+    if jobs.cancel(job_id):
+        await callback_query.answer("Отмена запрошена.")
+    else:
+        await callback_query.answer("Задача уже завершена.", show_alert=True)
+
+DIAGNOSTIC_DURATION = 30
+
+async def send_text_report(user_id, filename, text):
+    await bot.send_document(user_id, types.InputFile(io.BytesIO(text.encode()), filename=filename))
+
+async def profile_job(report, user_id, duration):
+    await report(f"Сбор семплов стека event loop, {duration} с...")
+    text = await asyncio.to_thread(loop_watchdog.sample_profile, duration)
+    await send_text_report(user_id, f"profile_{datetime.now():%Y-%m-%d_%H-%M}.txt", text)
+    return "⏱ Профиль отправлен."
+
+async def memory_job(report, user_id, duration):
+    await report(f"Снимки tracemalloc с интервалом {duration} с...")
+    text = await asyncio.to_thread(watchdog.memory_report, duration)
+    await send_text_report(user_id, f"memory_{datetime.now():%Y-%m-%d_%H-%M}.txt", text)
+    return "🧠 Отчёт о памяти отправлен."
+
+@router.action("diagnostics")
+async def diagnostics_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    stalls = loop_watchdog.stalls
+    text = (f"Диагностика:\nМаксимальная задержка event loop: {loop_watchdog.max_lag * 1000:.0f} мс\n"
+            f"Зависаний дольше {loop_watchdog.threshold} с: {len(stalls)}")
+    if stalls:
+        last = stalls[-1]
+        text += f"\nПоследнее: {last.started:%d.%m %H:%M:%S}, {last.duration:.2f} с, {last.label or 'неизвестно'}"
+    keyboard = InlineKeyboardMarkup(row_width=1).add(
+        InlineKeyboardButton("📄 Отчёт о зависаниях", callback_data="diag_stalls"),
+        InlineKeyboardButton(f"⏱ Профилировать {DIAGNOSTIC_DURATION} с", callback_data="diag_profile"),
+        InlineKeyboardButton(f"🧠 Снимок памяти за {DIAGNOSTIC_DURATION} с", callback_data="diag_memory"),
+        InlineKeyboardButton("🔍 Сверка клиентов", callback_data="diag_reconcile"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="settings")
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
+    await render(callback_query, text=text, reply_markup=keyboard)
+    await callback_query.answer()
+
+@router.action("diag_stalls")
+async def diag_stalls_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
     await callback_query.answer()
+    await send_text_report(user_id, f"stalls_{datetime.now():%Y-%m-%d_%H-%M}.txt", loop_watchdog.report())
+
+@router.action("diag_profile")
+@deduplicate(guard, "Профилирование уже запущено.", ttl=DIAGNOSTIC_DURATION)
+async def diag_profile_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    await callback_query.answer("Профилирование запущено.")
+    start_job(callback_query, "профилирование", profile_job, user_id, DIAGNOSTIC_DURATION)
+
+@router.action("diag_memory")
+@deduplicate(guard, "Снимок памяти уже снимается.", ttl=DIAGNOSTIC_DURATION)
+async def diag_memory_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    await callback_query.answer("Снимок памяти запущен.")
+    start_job(callback_query, "снимок памяти", memory_job, user_id, DIAGNOSTIC_DURATION)
 
-@dp.callback_query_handler(lambda c: c.data == "buy_key")
+@router.action("diag_reconcile")
+@deduplicate(guard, "Сверка уже выполняется.")
+async def diag_reconcile_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    await callback_query.answer("Сверка запущена.")
+    # Из меню только отчёт: исправления делает плановая сверка (reconcile_fix) или reconcile.py --fix
+    result = await run_reconcile(fix=False)
+    if result is None:
+        await bot.send_message(user_id, "Сверка не удалась, подробности в логе.")
+        return
+    await send_text_report(user_id, f"reconcile_{datetime.now():%Y-%m-%d_%H-%M}.txt", "\n".join(result.report(limit=1000)))
+
+@router.action("stats")
+async def stats_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if user_id not in admins:
+        await callback_query.answer("Нет прав.", show_alert=True)
+        return
+    keyboard = InlineKeyboardMarkup(row_width=2).add(
+        InlineKeyboardButton("🔄 Обновить", callback_data="stats"),
+        InlineKeyboardButton("⬅️ Назад", callback_data="home")
+    )
+    await render(callback_query, text=stats_board.render(subscriptions), reply_markup=keyboard)
+    await callback_query.answer()
+
+@router.action("buy_key")
 async def buy_key_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Меню получения ключа:",
         reply_markup=get_buy_key_menu(user_id)
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "use_promocode")
+@router.action("use_promocode")
 async def use_promocode_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Введите промокод для получения ключа:",
-        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home")),
+        state='waiting_for_promocode'
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': 'waiting_for_promocode'
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "manage_promocodes")
+@router.action("manage_promocodes")
 async def manage_promocodes_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
@@ -983,51 +1322,28 @@ async def manage_promocodes_callback(callback_query: types.CallbackQuery):
         InlineKeyboardButton("🗑️ Удалить промокод", callback_data="delete_promocode"),
         InlineKeyboardButton("🏠 Домой", callback_data="home")
     )
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text=text,
         reply_markup=keyboard
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "add_promocode")
+@router.action("add_promocode")
 async def add_promocode_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Введите промокод в формате: <код> <скидка%> <дней_действия> <макс_использований|none> <период_подписки|none>\nПример: PROMO1 10 30 none 1_month",
-        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
+        reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 Домой", callback_data="home")),
+        state='waiting_for_new_promocode'
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': 'waiting_for_new_promocode'
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "delete_promocode")
+@router.action("delete_promocode")
 async def delete_promocode_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     if user_id not in admins:
@@ -1036,39 +1352,32 @@ async def delete_promocode_callback(callback_query: types.CallbackQuery):
     promocodes = db.get_promocodes()
     keyboard = InlineKeyboardMarkup(row_width=2)
     for code in promocodes:
-        keyboard.insert(InlineKeyboardButton(f"🗑️ {code}", callback_data=f"remove_promocode_{code}"))
+        keyboard.insert(InlineKeyboardButton(f"🗑️ {code}", callback_data=router.encode("remove_promocode", code)))
     keyboard.add(InlineKeyboardButton("🏠 Домой", callback_data="home"))
-    try:
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id
-        )
-    except:
-        pass
-    sent_message = await bot.send_message(
-        chat_id=callback_query.message.chat.id,
+    await render(
+        callback_query,
         text="Выберите промокод для удаления:",
         reply_markup=keyboard
     )
-    user_main_messages[user_id] = {
-        'chat_id': sent_message.chat.id,
-        'message_id': sent_message.message_id,
-        'state': None
-    }
     await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('remove_promocode_'))
-async def remove_promocode_callback(callback_query: types.CallbackQuery):
+@router.action("remove_promocode", legacy_prefix="remove_promocode_")
+async def remove_promocode_callback(callback_query: types.CallbackQuery, code: str):
     user_id = callback_query.from_user.id
     if user_id not in admins:
         await callback_query.answer("Нет прав.", show_alert=True)
         return
-    code = callback_query.data.split('remove_promocode_')[1]
     if db.remove_promocode(code):
         await callback_query.answer(f"Промокод {code} удалён.", show_alert=True)
     else:
         await callback_query.answer(f"Промокод {code} не найден.", show_alert=True)
     await manage_promocodes_callback(callback_query)
 
+router.setup(dp)
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if setting.get('webhook_url'):
+        webhook.run(dp, setting, on_startup=on_startup, dispatcher=update_lanes)
+    else:
+        update_lanes.install()
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime
+
+import pytz
+
+import db
+from subscriptions import SubscriptionTable, to_epoch
+from send_queue import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+# История завершённых рассылок; сами задания - в BROADCASTS_DIR, по файлу на задание
+BROADCASTS_FILE = 'files/broadcasts.json'
+BROADCASTS_DIR = 'files/broadcasts'
+HISTORY_LIMIT = 100
+REMINDERS_FILE = 'files/reminders.json'
+BATCH_SIZE = 50
+REMINDER_DAYS = 3
+
+SEGMENTS = {
+    'all': "Все пользователи",
+    'expiring': f"Истекает в ближайшие {REMINDER_DAYS} дн.",
+    'expired': "Подписка истекла",
+    'never_connected': "Ни разу не подключались"
+}
+
+def _never_connected(username):
+    status_file = os.path.join('users', username, 'status.json')
+    status = db.load_json(status_file, {})
+    last_handshake = status.get('last_handshake', 'never')
+    return not last_handshake or last_handshake.lower() in ['never', 'нет данных', '-']
+
+def select_recipients(segment, now=None, subscriptions=None):
+    """Возвращает отсортированный список уникальных Telegram ID для сегмента.
+
+    Сегменты по сроку действия выбираются из таблицы подписок диапазоном, без разбора дат.
+    """
+    now = now or datetime.now(pytz.utc)
+    if segment == 'expired':
+        subscriptions = subscriptions if subscriptions is not None else SubscriptionTable()
+        owners = (subscriptions.owner_of(username) for username in subscriptions.expired(now))
+        return sorted({owner for owner in owners if owner})
+    if segment == 'expiring':
+        subscriptions = subscriptions if subscriptions is not None else SubscriptionTable()
+        return sorted({owner for _, _, owner in subscriptions.expiring(now, REMINDER_DAYS) if owner})
+    telegram = db.load_json(db.USER_TELEGRAM_FILE, {})
+    recipients = set()
+    for username, telegram_id in telegram.items():
+        if not telegram_id:
+            continue
+        if segment == 'never_connected' and not _never_connected(username):
+            continue
+        recipients.add(int(telegram_id))
+    return sorted(recipients)
+
+def _job_path(job_id, suffix=''):
+    return os.path.join(BROADCASTS_DIR, f"{job_id}{suffix}.json")
+
+def create_job(text, recipients, admin_id=None, segment=None, progress_message=None):
+    """Создаёт задание рассылки. Элемент recipients - chat_id или [chat_id, текст].
+
+    Задание с получателями записывается один раз в свой файл; после каждой пачки
+    переписывается только небольшой файл прогресса.
+    """
+    job_id = uuid.uuid4().hex[:8]
+    db.save_json(_job_path(job_id), {
+        'text': text,
+        'segment': segment,
+        'admin_id': admin_id,
+        'progress_message': progress_message,
+        'recipients': recipients,
+        'created_at': datetime.now(pytz.utc).isoformat()
+    })
+    _save_progress(job_id, position=0, sent=0, failed=0, status='pending')
+    return job_id
+
+def _save_progress(job_id, **progress):
+    db.save_json(_job_path(job_id, '.progress'), progress)
+
+def get_job(job_id):
+    """Задание с прогрессом; для завершённого - запись из истории (без получателей)."""
+    job = db.load_json(_job_path(job_id), {})
+    if job:
+        job.update(db.load_json(_job_path(job_id, '.progress'), {}))
+        return job
+    return db.load_json(BROADCASTS_FILE, {}).get(job_id)
+
+def _save_history(history):
+    for old_id in sorted(history, key=lambda i: history[i].get('finished_at') or '')[:-HISTORY_LIMIT]:
+        del history[old_id]
+    db.save_json(BROADCASTS_FILE, history)
+
+def _finish_job(job_id, job, **progress):
+    """Переносит итог задания в историю (не больше HISTORY_LIMIT записей) и удаляет его файлы."""
+    history = db.load_json(BROADCASTS_FILE, {})
+    history[job_id] = {
+        'segment': job.get('segment'),
+        'admin_id': job.get('admin_id'),
+        'progress_message': job.get('progress_message'),
+        'total': len(job.get('recipients', ())),
+        'created_at': job.get('created_at'),
+        'finished_at': datetime.now(pytz.utc).isoformat(),
+        **progress
+    }
+    _save_history(history)
+    for suffix in ('', '.progress'):
+        try:
+            os.remove(_job_path(job_id, suffix))
+        except FileNotFoundError:
+            pass
+    return history[job_id]
+
+def _migrate_legacy_jobs():
+    """Раньше все задания целиком лежали в broadcasts.json: незавершённые переносятся в
+    отдельные файлы, завершённые сворачиваются в записи истории."""
+    history = db.load_json(BROADCASTS_FILE, {})
+    legacy = {job_id: job for job_id, job in history.items() if 'recipients' in job}
+    if not legacy:
+        return
+    for job_id, job in legacy.items():
+        del history[job_id]
+        progress = {key: job.get(key, 0) for key in ('position', 'sent', 'failed')}
+        if job.get('status') in ('pending', 'running'):
+            db.save_json(_job_path(job_id), {key: job.get(key) for key in
+                                             ('text', 'segment', 'admin_id', 'progress_message', 'recipients', 'created_at')})
+            _save_progress(job_id, status=job['status'], **progress)
+        else:
+            history[job_id] = {
+                'segment': job.get('segment'), 'admin_id': job.get('admin_id'),
+                'progress_message': job.get('progress_message'), 'total': len(job['recipients']),
+                'created_at': job.get('created_at'), 'finished_at': job.get('finished_at'),
+                'status': job.get('status'), **progress
+            }
+    _save_history(history)
+    logger.info(f"Задания рассылок перенесены в {BROADCASTS_DIR}: {len(legacy)}")
+
+def get_unfinished_jobs():
+    """Возвращает ID заданий, прерванных перезапуском."""
+    _migrate_legacy_jobs()
+    if not os.path.isdir(BROADCASTS_DIR):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(BROADCASTS_DIR)
+                  if name.endswith('.json') and not name.endswith('.progress.json'))
+
+async def run_job(outbox, job_id, on_progress=None, batch_size=BATCH_SIZE):
+    """Отправляет задание пачками, сохраняя позицию после каждой пачки."""
+    job = get_job(job_id)
+    if not job or 'recipients' not in job:
+        return None
+    recipients = job['recipients']
+    position, sent, failed = job['position'], job['sent'], job['failed']
+    _save_progress(job_id, position=position, sent=sent, failed=failed, status='running')
+    while position < len(recipients):
+        batch = recipients[position:position + batch_size]
+        futures = []
+        for recipient in batch:
+            chat_id, text = recipient if isinstance(recipient, list) else (recipient, job['text'])
+            futures.append(outbox.send_message(chat_id, text, priority=PRIORITY_BULK))
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed_now = sum(1 for r in results if isinstance(r, Exception))
+        sent += len(results) - failed_now
+        failed += failed_now
+        position += len(batch)
+        _save_progress(job_id, position=position, sent=sent, failed=failed, status='running')
+        if on_progress:
+            try:
+                await on_progress(job_id, position, len(recipients), sent, failed)
+            except Exception as e:
+                logger.error(f"Ошибка обновления прогресса рассылки {job_id}: {str(e)}")
+    summary = _finish_job(job_id, job, position=position, sent=sent, failed=failed, status='done')
+    logger.info(f"Рассылка {job_id} завершена: отправлено {sent}, ошибок {failed}")
+    return summary
+
+def collect_reminders(now=None, days=REMINDER_DAYS, subscriptions=None):
+    """Собирает напоминания о скором окончании подписки по диапазону сроков из таблицы подписок."""
+    now = now or datetime.now(pytz.utc)
+    subscriptions = subscriptions if subscriptions is not None else SubscriptionTable()
+    reminded = db.load_json(REMINDERS_FILE, {})
+    recipients = []
+    for username, expires, telegram_id in subscriptions.expiring(now, days):
+        # Отметка - срок в секундах эпохи (раньше - ISO-строка): после продления напоминание придёт снова
+        mark = reminded.get(username)
+        if isinstance(mark, str):
+            mark = to_epoch(mark)
+        if not telegram_id or mark == expires:
+            continue
+        expires_at = datetime.fromtimestamp(expires, pytz.utc)
+        text = (f"⏰ Подписка {username} истекает {expires_at.strftime('%d-%m-%Y %H:%M UTC')}.\n"
+                f"Продлите её, чтобы VPN продолжил работать.")
+        recipients.append([telegram_id, text])
+        reminded[username] = expires
+    # Убираем отметки для удалённых пользователей
+    reminded = {u: e for u, e in reminded.items() if u in subscriptions.rows}
+    db.save_json(REMINDERS_FILE, reminded)
+    return recipients
@@ -0,0 +1,185 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Формат callback_data (версия 2): "2:action" или "2:action:arg1:arg2".
+# Аргументы экранируются (% и :), поэтому имена с "_" разбираются однозначно.
+# Версия 1 - то же без префикса версии (и кнопки, заданные строкой, например "home").
+# Версия 0 - старые кнопки вида "client_<имя>", разбираются по префиксному дереву.
+# Если данные длиннее лимита Telegram, аргументы сохраняются в SQLite под коротким токеном:
+# "2:~:<токен>", поэтому такие кнопки работают и после перезапуска.
+CODEC_VERSION = 2
+MAX_CALLBACK_DATA = 64
+TOKEN_MARK = '~'
+SEPARATOR = ':'
+
+def _escape(value):
+    return str(value).replace('%', '%25').replace(':', '%3A')
+
+def _unescape(value):
+    return value.replace('%3A', ':').replace('%25', '%')
+
+class CallbackRouter:
+    """Диспетчер callback-запросов: разбор callback_data и поиск обработчика за O(1)."""
+
+    def __init__(self, db_path=None, max_tokens=10000):
+        self.handlers = {}
+        # действие -> (минимум, максимум) аргументов обработчика; максимум None - без ограничения
+        self.arity = {}
+        self.legacy_trie = {}
+        self.max_tokens = max_tokens
+        self.tokens = OrderedDict()
+        self._db = None
+        if db_path:
+            self._open(db_path)
+
+    def _open(self, db_path):
+        try:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS callback_tokens ("
+                "token TEXT PRIMARY KEY, action TEXT, args TEXT, created REAL)"
+            )
+            self._db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка открытия хранилища токенов {db_path}: {str(e)}")
+            self._db = None
+
+    def _remember(self, token, value):
+        self.tokens[token] = value
+        self.tokens.move_to_end(token)
+        if len(self.tokens) > self.max_tokens:
+            self.tokens.popitem(last=False)
+
+    def _store_token(self, token, action, args):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR IGNORE INTO callback_tokens (token, action, args, created) VALUES (?, ?, ?, ?)",
+                (token, action, json.dumps(args, ensure_ascii=False), time.time())
+            )
+            # В базе остаются max_tokens последних токенов
+            self._db.execute(
+                "DELETE FROM callback_tokens WHERE rowid <= (SELECT MAX(rowid) FROM callback_tokens) - ?",
+                (self.max_tokens,)
+            )
+            self._db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи токена callback: {str(e)}")
+
+    def _load_token(self, token):
+        value = self.tokens.get(token)
+        if value is not None or self._db is None:
+            return value
+        try:
+            row = self._db.execute(
+                "SELECT action, args FROM callback_tokens WHERE token = ?", (token,)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Ошибка чтения токена callback: {str(e)}")
+            return None
+        if row is None:
+            return None
+        value = (row[0], tuple(json.loads(row[1])))
+        self._remember(token, value)
+        return value
+
+    def action(self, name, legacy_prefix=None):
+        """Декоратор: регистрирует обработчик действия (и, при необходимости, старый префикс)."""
+        def decorator(handler):
+            if name in self.handlers:
+                raise ValueError(f"Действие {name} уже зарегистрировано")
+            self.handlers[name] = handler
+            self.arity[name] = self._arity(handler)
+            if legacy_prefix:
+                node = self.legacy_trie
+                for char in legacy_prefix:
+                    node = node.setdefault(char, {})
+                node[None] = name
+            return handler
+        return decorator
+
+    @staticmethod
+    def _arity(handler):
+        """Сколько аргументов callback_data принимает обработчик (без самого callback_query)."""
+        params = list(inspect.signature(handler).parameters.values())[1:]
+        if any(p.kind == p.VAR_POSITIONAL for p in params):
+            return 0, None
+        positional = [p for p in params if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+        required = sum(1 for p in positional if p.default is p.empty)
+        return required, len(positional)
+
+    def encode(self, action, *args):
+        """Кодирует действие и аргументы в callback_data, укладываясь в 64 байта."""
+        data = SEPARATOR.join([str(CODEC_VERSION), action] + [_escape(arg) for arg in args])
+        if len(data.encode()) <= MAX_CALLBACK_DATA:
+            return data
+        args = tuple(str(arg) for arg in args)
+        # Токен зависит только от содержимого: повторная отрисовка той же кнопки не пишет в базу
+        token = hashlib.sha1(data.encode()).hexdigest()[:16]
+        if token not in self.tokens:
+            self._store_token(token, action, args)
+        self._remember(token, (action, args))
+        return SEPARATOR.join((str(CODEC_VERSION), TOKEN_MARK, token))
+
+    def _decode_legacy(self, data):
+        node, match = self.legacy_trie, None
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], i + 1)
+        if match:
+            return match[0], (data[match[1]:],)
+        return None, ()
+
+    def decode(self, data):
+        """Возвращает (action, args); action равен None, если данные не распознаны."""
+        if data in self.handlers:
+            return data, ()
+        if SEPARATOR in data:
+            action, *args = data.split(SEPARATOR)
+            if action.isdigit():
+                # Кнопки другой версии формата разбирать наугад нельзя
+                if int(action) != CODEC_VERSION or not args:
+                    return None, ()
+                action, *args = args
+            if action == TOKEN_MARK:
+                return (self._load_token(args[0]) if len(args) == 1 else None) or (None, ())
+            if action in self.handlers:
+                return action, tuple(_unescape(arg) for arg in args)
+        return self._decode_legacy(data)
+
+    def _accepts(self, action, args):
+        minimum, maximum = self.arity.get(action, (0, None))
+        return len(args) >= minimum and (maximum is None or len(args) <= maximum)
+
+    async def dispatch(self, callback_query):
+        action, args = self.decode(callback_query.data or '')
+        handler = self.handlers.get(action)
+        if handler is not None and not self._accepts(action, args):
+            logger.warning(f"Неверное число аргументов callback {action}: {len(args)}")
+            handler = None
+        if handler is None:
+            logger.warning(f"Неизвестный callback: {callback_query.data}")
+            await callback_query.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+            return
+        with metrics.handler_seconds.time('callback', action):
+            return await handler(callback_query, *args)
+
+    def setup(self, dp):
+        """Регистрирует единственный обработчик callback-запросов в диспетчере aiogram."""
+        dp.register_callback_query_handler(self.dispatch)
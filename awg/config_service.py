@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+
+import db
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 2.0
+DEFAULT_PRICING = {
+    '1_month': 1000.0,
+    '3_months': 2500.0,
+    '6_months': 4500.0,
+    '12_months': 8000.0
+}
+
+def _ids(values):
+    result = set()
+    for value in values or []:
+        try:
+            result.add(int(value))
+        except (TypeError, ValueError):
+            logger.warning(f"Некорректный ID в config.json: {value}")
+    return frozenset(result)
+
+class ConfigSnapshot:
+    """Неизменяемый срез конфигурации; заменяется целиком при перечитывании файла."""
+    __slots__ = ('data', 'admins', 'moderators', 'pricing')
+
+    def __init__(self, data):
+        self.data = data
+        self.admins = _ids(data.get('admin_ids'))
+        self.moderators = _ids(data.get('moderator_ids'))
+        self.pricing = {**DEFAULT_PRICING, **data.get('pricing', {})}
+
+class RoleView:
+    """Живое представление роли: проверка `user_id in admins` всегда идёт по текущему срезу за O(1)."""
+
+    def __init__(self, service, role):
+        self._service = service
+        self._role = role
+
+    def _ids(self):
+        return getattr(self._service.snapshot, self._role)
+
+    def __contains__(self, user_id):
+        return user_id in self._ids()
+
+    def __iter__(self):
+        return iter(sorted(self._ids()))
+
+    def __len__(self):
+        return len(self._ids())
+
+class ConfigService:
+    """config.json с перечитыванием на лету.
+
+    Файл проверяется по mtime/размеру раз в poll_interval секунд; при изменении новый срез
+    подменяет старый одной операцией, затем вызываются подписчики callback(snapshot, changed_keys).
+    Если файл повреждён, продолжает действовать предыдущая конфигурация.
+    """
+
+    def __init__(self, path=db.CONFIG_FILE, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.subscribers = []
+        self._stamp = None
+        self._task = None
+        self.snapshot = ConfigSnapshot({})
+        self.admins = RoleView(self, 'admins')
+        self.moderators = RoleView(self, 'moderators')
+        self.reload()
+
+    @property
+    def pricing(self):
+        return self.snapshot.pricing
+
+    def get(self, key, default=None):
+        return self.snapshot.data.get(key, default)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def reload(self, force=False):
+        """Перечитывает файл, если он изменился. Возвращает множество изменённых ключей."""
+        stamp = self._file_stamp()
+        if stamp == self._stamp and not force:
+            return set()
+        self._stamp = stamp
+        data = db.load_json(self.path, None)
+        if not isinstance(data, dict) or not data:
+            logger.error(f"Не удалось прочитать {self.path}, действует прежняя конфигурация")
+            return set()
+        previous = self.snapshot.data
+        changed = {key for key in set(previous) | set(data) if previous.get(key) != data.get(key)}
+        if not changed:
+            return changed
+        self.snapshot = ConfigSnapshot(data)
+        if previous:
+            logger.info(f"Конфигурация перечитана, изменены: {', '.join(sorted(changed))}")
+        for callback in self.subscribers:
+            try:
+                callback(self.snapshot, changed)
+            except Exception as e:
+                logger.error(f"Ошибка подписчика конфигурации: {str(e)}")
+        return changed
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания конфигурации: {str(e)}")
@@ -0,0 +1,164 @@
+import fcntl
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pytz
+
+import db
+from subscriptions import PERIODS
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_FILE = 'files/dashboard.json'
+HISTORY_DAYS = 90
+TOP_TRAFFIC = 10
+TOP_PROMOCODES = 3
+PERIOD_TITLES = {'1_month': "1 месяц", '3_months': "3 месяца", '6_months': "6 месяцев", '12_months': "12 месяцев"}
+
+def format_bytes(size):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+def top_traffic(names, limit=TOP_TRAFFIC):
+    """[(трафик в байтах, имя)] клиентов с наибольшим трафиком, по убыванию."""
+    return heapq.nlargest(limit, ((db.get_traffic(name), name) for name in names))
+
+class Dashboard:
+    """Материализованные показатели для экрана статистики админа.
+
+    Счётчики (новые клиенты по дням, продажи по периодам, активации промокодов, деактивации
+    по сроку) обновляются в момент события в files/dashboard.json под файловой блокировкой, поэтому
+    экран собирается из готовых чисел без обхода users/ и JSON-файлов. Подписки считаются
+    таблицей подписок, онлайн и трафик - фоновой задачей метрик раз в минуту.
+    """
+
+    def __init__(self, path=DASHBOARD_FILE):
+        self.path = path
+        self._mtime = None
+        self._apply(db.load_json(path, {}))
+        self.online = None
+        self.top_traffic = []
+        self.snapshot_at = None
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _apply(self, data):
+        self.since = data.get('since') or datetime.now(pytz.utc).date().isoformat()
+        self.new_by_day = data.get('new_by_day', {})
+        # период -> {'count': продаж, 'amount': сумма}
+        self.sales = data.get('sales', {})
+        self.redemptions = data.get('redemptions', 0)
+        self.redemptions_by_code = data.get('redemptions_by_code', {})
+        self.deactivated = data.get('deactivated', 0)
+        self._mtime = self._file_mtime()
+
+    def refresh(self):
+        """Перечитывает счётчики, если файл изменил другой процесс (bot.py или bot_manager.py)."""
+        if self._file_mtime() != self._mtime:
+            self._apply(db.load_json(self.path, {}))
+
+    def _update(self, mutate):
+        """Изменяет счётчики в файле под блокировкой: читает свежую копию, mutate(data) правит её.
+
+        bot.py и bot_manager.py - разные процессы, и запись своей копии из памяти затёрла бы
+        счётчики другого.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = db.load_json(self.path, {})
+            data.setdefault('since', datetime.now(pytz.utc).date().isoformat())
+            mutate(data)
+            db.save_json(self.path, data)
+            self._apply(data)
+
+    @staticmethod
+    def _sale(data, period, amount):
+        sale = data.setdefault('sales', {}).setdefault(period, {'count': 0, 'amount': 0.0})
+        sale['count'] += 1
+        sale['amount'] = round(sale['amount'] + amount, 2)
+
+    def record_add(self, period=None, amount=0.0, now=None):
+        """Новый клиент; с period - ещё и продажа подписки на сумму amount."""
+        day = (now or datetime.now(pytz.utc)).date().isoformat()
+
+        def mutate(data):
+            new_by_day = data.setdefault('new_by_day', {})
+            if day not in new_by_day:
+                # Новый день: старые дни отбрасываются, словарь не растёт больше HISTORY_DAYS
+                for old_day in sorted(new_by_day)[:max(0, len(new_by_day) - HISTORY_DAYS + 1)]:
+                    del new_by_day[old_day]
+            new_by_day[day] = new_by_day.get(day, 0) + 1
+            if period:
+                self._sale(data, period, amount)
+        self._update(mutate)
+
+    def record_renew(self, period, amount):
+        self._update(lambda data: self._sale(data, period, amount))
+
+    def record_redeem(self, code):
+        def mutate(data):
+            data['redemptions'] = data.get('redemptions', 0) + 1
+            by_code = data.setdefault('redemptions_by_code', {})
+            by_code[code] = by_code.get(code, 0) + 1
+        self._update(mutate)
+
+    def record_expire(self, count=1):
+        def mutate(data):
+            data['deactivated'] = data.get('deactivated', 0) + count
+        self._update(mutate)
+
+    def set_snapshot(self, online, top):
+        """Показатели, которые считает фоновая задача метрик."""
+        self.online = online
+        self.top_traffic = top
+        self.snapshot_at = datetime.now(pytz.utc)
+
+    def drop_clients(self, names):
+        """Убирает удалённых клиентов из снимка трафика до следующего пересчёта."""
+        if names:
+            self.top_traffic = [(size, name) for size, name in self.top_traffic if name not in names]
+
+    def new_since(self, days, now=None):
+        today = (now or datetime.now(pytz.utc)).date()
+        return sum(self.new_by_day.get((today - timedelta(days=i)).isoformat(), 0) for i in range(days))
+
+    def render(self, subscriptions, now=None):
+        self.refresh()
+        now = now or datetime.now(pytz.utc)
+        stats = subscriptions.stats(now)
+        lines = [
+            "📊 Статистика",
+            f"Подписки: всего {stats['total']}, активных {stats['active']}, истёкших {stats['expired']}"
+            + (f" (без срока {stats['unlimited']})" if stats['unlimited'] else ""),
+            "Онлайн: " + (f"{self.online} (на {self.snapshot_at:%H:%M} UTC)" if self.online is not None else "считается..."),
+            f"Новых клиентов: сегодня {self.new_since(1, now)}, за 7 дней {self.new_since(7, now)}",
+            f"Деактивировано по сроку: {self.deactivated}",
+            "",
+            f"Продажи с {self.since}:"
+        ]
+        total = 0.0
+        for period in PERIODS:
+            sale = self.sales.get(period)
+            if sale:
+                lines.append(f"  {PERIOD_TITLES[period]}: {sale['count']} на ₽{sale['amount']:.2f}")
+                total += sale['amount']
+        lines.append(f"  Итого: ₽{total:.2f}")
+        lines.append(f"Активаций промокодов: {self.redemptions}")
+        if self.redemptions_by_code:
+            top_codes = heapq.nlargest(TOP_PROMOCODES, self.redemptions_by_code.items(), key=lambda item: item[1])
+            lines.append("  " + ", ".join(f"{code} - {count}" for code, count in top_codes))
+        if self.top_traffic:
+            lines.append("")
+            lines.append("Топ по трафику:")
+            lines.extend(f"  {name}: {format_bytes(size)}" for size, name in self.top_traffic if size)
+        return "\n".join(lines)
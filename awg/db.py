@@ -1,11 +1,16 @@
+import fcntl
 import json
 import os
 import subprocess
 import logging
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
 import pytz
 import shutil
 
+import metrics
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -13,6 +18,8 @@ CONFIG_FILE = 'files/config.json'
 USER_EXPIRATION_FILE = 'files/user_expiration.json'
 USER_TELEGRAM_FILE = 'files/user_telegram.json'
 PROMOCODES_FILE = 'files/promocodes.json'
+USER_NOTES_FILE = 'files/user_notes.json'
+CLIENTS_LOCK_FILE = 'files/clients.lock'
 
 def load_json(file_path, default=None):
     """Загружает JSON-файл, возвращает default при ошибке или отсутствии файла."""
@@ -25,53 +32,87 @@ def load_json(file_path, default=None):
     return default if default is not None else {}
 
 def save_json(file_path, data):
-    """Сохраняет данные в JSON-файл."""
+    """Сохраняет данные в JSON-файл (через временный файл, чтобы читатели не видели его наполовину записанным).
+
+    Имя временного файла уникально: одновременные записи из потоков и процессов не пишут в один файл.
+    """
+    tmp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.tmp"
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w') as f:
+        with open(tmp_path, 'w') as f:
             json.dump(data, f, indent=4, default=str)
+        os.replace(tmp_path, file_path)
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения {file_path}: {str(e)}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
         return False
 
+@contextmanager
+def clients_lock():
+    """Файловая блокировка изменений пиров: newclient.sh, removeclient.sh и сверка (reconcile.py)
+    переписывают конфигурацию сервера целиком и не должны работать одновременно."""
+    os.makedirs(os.path.dirname(CLIENTS_LOCK_FILE), exist_ok=True)
+    with open(CLIENTS_LOCK_FILE, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
 def get_config():
     """Возвращает конфигурацию из config.json."""
     return load_json(CONFIG_FILE, {})
 
+def update_config(mutator):
+    """Изменяет config.json под файловой блокировкой: mutator(config) правит словарь на месте.
+
+    Блокировка не даёт двум процессам бота перезаписать изменения друг друга.
+    """
+    os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
+    with open(f"{CONFIG_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            config = get_config()
+            if not config and os.path.exists(CONFIG_FILE):
+                logger.error(f"{CONFIG_FILE} не читается, изменение не сохранено")
+                return False
+            mutator(config)
+            return save_json(CONFIG_FILE, config)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
 def add_admin(admin_id):
     """Добавляет ID администратора в конфигурацию."""
-    config = get_config()
-    admin_ids = config.get('admin_ids', [])
-    if str(admin_id) not in admin_ids:
-        admin_ids.append(str(admin_id))
+    def mutate(config):
+        admin_ids = config.get('admin_ids', [])
+        if str(admin_id) not in [str(i) for i in admin_ids]:
+            admin_ids.append(str(admin_id))
         config['admin_ids'] = admin_ids
-        save_json(CONFIG_FILE, config)
+    update_config(mutate)
 
 def remove_admin(admin_id):
     """Удаляет ID администратора из конфигурации."""
-    config = get_config()
-    admin_ids = config.get('admin_ids', [])
-    admin_id_str = str(admin_id)
-    if admin_id_str in admin_ids:
-        admin_ids.remove(admin_id_str)
-        config['admin_ids'] = admin_ids
-        save_json(CONFIG_FILE, config)
+    def mutate(config):
+        config['admin_ids'] = [i for i in config.get('admin_ids', []) if str(i) != str(admin_id)]
+    update_config(mutate)
 
 def set_pricing(period, price):
     """Устанавливает цену для указанного периода подписки."""
-    config = get_config()
-    config['pricing'] = config.get('pricing', {})
-    config['pricing'][period] = price
-    save_json(CONFIG_FILE, config)
+    def mutate(config):
+        config['pricing'] = config.get('pricing', {})
+        config['pricing'][period] = price
+    update_config(mutate)
 
+@metrics.timed('root_add')
 def root_add(name, ipv6=False):
     """Добавляет нового пользователя через newclient.sh."""
     try:
         cmd = ['./newclient.sh', name]
         if not ipv6:
             cmd.append('--no-ipv6')
-        process = subprocess.run(cmd, capture_output=True, text=True)
+        with clients_lock():
+            process = subprocess.run(cmd, capture_output=True, text=True)
         if process.returncode == 0:
             return True
         logger.error(f"Ошибка добавления пользователя {name}: {process.stderr}")
@@ -80,10 +121,12 @@ def root_add(name, ipv6=False):
         logger.error(f"Исключение при добавлении пользователя {name}: {str(e)}")
         return False
 
+@metrics.timed('remove_client')
 def deactive_user_db(name):
     """Деактивирует пользователя через removeclient.sh."""
     try:
-        process = subprocess.run(['./removeclient.sh', name], capture_output=True, text=True)
+        with clients_lock():
+            process = subprocess.run(['./removeclient.sh', name], capture_output=True, text=True)
         if process.returncode == 0:
             return True
         logger.error(f"Ошибка удаления пользователя {name}: {process.stderr}")
@@ -123,14 +166,43 @@ def get_active_list():
                     active.append((user_dir, last_handshake))
     return active
 
-def set_user_expiration(username, expiration, transfer_limit):
-    """Устанавливает срок действия и лимит трафика для пользователя."""
+def get_last_handshake(username):
+    """Возвращает последний handshake одного клиента из его status.json или None."""
+    status = load_json(os.path.join('users', username, 'status.json'), {})
+    return status.get('last_handshake')
+
+def get_traffic(username):
+    """Суммарный трафик клиента в байтах из его traffic.json (0, если данных нет)."""
+    traffic = load_json(os.path.join('users', username, 'traffic.json'), {})
+    try:
+        return int(traffic.get('total_incoming', 0)) + int(traffic.get('total_outgoing', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def is_online(last_handshake):
+    """Проверяет, был ли у клиента handshake (значение из status.json)."""
+    return bool(last_handshake) and last_handshake.lower() not in ['never', 'нет данных', '-']
+
+def set_user_expiration(username, expiration, transfer_limit, period=None):
+    """Устанавливает срок действия и лимит трафика для пользователя.
+
+    period - период оплаченной подписки; без него сохраняется прежний. Время создания
+    записывается при первой установке срока.
+    """
     data = load_json(USER_EXPIRATION_FILE, {})
-    data[username] = {
+    previous = data.get(username)
+    entry = {
         'expiration': expiration.isoformat() if expiration else None,
         'transfer_limit': transfer_limit
     }
+    if period or (previous and previous.get('period')):
+        entry['period'] = period or previous['period']
+    entry['created'] = previous.get('created') if previous else datetime.now(pytz.utc).isoformat()
+    if entry['created'] is None:
+        del entry['created']
+    data[username] = entry
     save_json(USER_EXPIRATION_FILE, data)
+    return entry
 
 def get_user_expiration(username):
     """Получает срок действия подписки пользователя."""
@@ -157,6 +229,19 @@ def get_user_telegram_id(username):
     data = load_json(USER_TELEGRAM_FILE, {})
     return data.get(username)
 
+def set_user_note(username, note):
+    """Сохраняет заметку администратора о пользователе (пустая заметка удаляется)."""
+    data = load_json(USER_NOTES_FILE, {})
+    if note:
+        data[username] = note
+    else:
+        data.pop(username, None)
+    save_json(USER_NOTES_FILE, data)
+
+def get_user_notes():
+    """Возвращает все заметки о пользователях."""
+    return load_json(USER_NOTES_FILE, {})
+
 def add_promocode(code, discount, expires_at, max_uses, subscription_period):
     """Добавляет новый промокод."""
     promocodes = load_json(PROMOCODES_FILE, {})
@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+from aiogram.utils.exceptions import TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+DEFERRED_DB_FILE = 'files/deferred.db'
+# Очередь старой точки входа bot.py: своя база, чтобы не выполнять действия bot_manager.py
+DEFERRED_LEGACY_DB_FILE = 'files/deferred_legacy.db'
+DELETE_BATCH = 100
+
+class DeferredActions:
+    """Отложенные действия (удаление сообщений и т.п.) на одном таймере вместо задачи на каждое.
+
+    Действия хранятся в куче по времени выполнения, одна фоновая задача спит до ближайшего.
+    Наступившие действия группируются по (действие, чат) и выполняются пачкой: удаление
+    сообщений одного чата - одним вызовом deleteMessages. При указании db_path очередь
+    записывается в SQLite и восстанавливается после перезапуска.
+    Обработчик действия: async handler(chat_id, payloads) - список накопившихся параметров.
+    """
+
+    def __init__(self, bot, db_path=None):
+        self.bot = bot
+        self.handlers = {'delete_message': self._delete_messages}
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._db = None
+        self.stats = {'scheduled': 0, 'executed': 0, 'batches': 0, 'failed': 0}
+        if db_path:
+            self._open(db_path)
+
+    def _open(self, db_path):
+        try:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS deferred ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, due REAL, action TEXT, chat_id INTEGER, payload TEXT)"
+            )
+            self._db.commit()
+            rows = self._db.execute("SELECT id, due, action, chat_id, payload FROM deferred").fetchall()
+            for row_id, due, action, chat_id, payload in rows:
+                self._heap.append((due, next(self._seq), action, chat_id, json.loads(payload), row_id))
+            heapq.heapify(self._heap)
+            if rows:
+                logger.info(f"Восстановлено отложенных действий: {len(rows)}")
+        except Exception as e:
+            logger.error(f"Ошибка открытия очереди отложенных действий {db_path}: {str(e)}")
+            self._db = None
+
+    def register(self, action, handler):
+        self.handlers[action] = handler
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def schedule(self, action, chat_id, payload=None, delay=0):
+        """Планирует действие через delay секунд."""
+        due = time.time() + delay
+        row_id = None
+        if self._db:
+            try:
+                cursor = self._db.execute(
+                    "INSERT INTO deferred (due, action, chat_id, payload) VALUES (?, ?, ?, ?)",
+                    (due, action, chat_id, json.dumps(payload))
+                )
+                self._db.commit()
+                row_id = cursor.lastrowid
+            except Exception as e:
+                logger.error(f"Ошибка записи отложенного действия: {str(e)}")
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (due, next(self._seq), action, chat_id, payload, row_id))
+        self.stats['scheduled'] += 1
+        self.start()
+        if earliest is None or due < earliest:
+            self._wakeup.set()
+
+    def delete_message(self, chat_id, message_id, delay=2):
+        self.schedule('delete_message', chat_id, message_id, delay)
+
+    def pending(self):
+        return len(self._heap)
+
+    async def _run(self):
+        while True:
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            groups = defaultdict(list)
+            row_ids = []
+            while self._heap and self._heap[0][0] <= now:
+                due, _, action, chat_id, payload, row_id = heapq.heappop(self._heap)
+                groups[(action, chat_id)].append(payload)
+                if row_id is not None:
+                    row_ids.append((row_id,))
+            for (action, chat_id), payloads in groups.items():
+                await self._execute(action, chat_id, payloads)
+            if self._db and row_ids:
+                try:
+                    self._db.executemany("DELETE FROM deferred WHERE id = ?", row_ids)
+                    self._db.commit()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки отложенных действий: {str(e)}")
+
+    async def _execute(self, action, chat_id, payloads):
+        handler = self.handlers.get(action)
+        if handler is None:
+            logger.error(f"Неизвестное отложенное действие: {action}")
+            self.stats['failed'] += len(payloads)
+            return
+        try:
+            await handler(chat_id, payloads)
+            self.stats['executed'] += len(payloads)
+        except Exception as e:
+            self.stats['failed'] += len(payloads)
+            logger.error(f"Ошибка отложенного действия {action} для {chat_id}: {str(e)}")
+        self.stats['batches'] += 1
+
+    async def _delete_messages(self, chat_id, message_ids):
+        for i in range(0, len(message_ids), DELETE_BATCH):
+            batch = message_ids[i:i + DELETE_BATCH]
+            if len(batch) > 1:
+                try:
+                    await self.bot.request('deleteMessages', {'chat_id': chat_id, 'message_ids': json.dumps(batch)})
+                    continue
+                except TelegramAPIError as e:
+                    logger.debug(f"deleteMessages недоступен, удаляем по одному: {str(e)}")
+            for message_id in batch:
+                try:
+                    await self.bot.delete_message(chat_id, message_id)
+                except Exception as e:
+                    logger.error(f"Ошибка удаления сообщения: {e}")
+
+    def get_stats(self):
+        return {**self.stats, 'pending': len(self._heap)}
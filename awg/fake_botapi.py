@@ -0,0 +1,161 @@
+"""Локальная имитация Telegram Bot API для бенчмарков и нагрузочного тестирования.
+
+Отвечает правдоподобными объектами на методы, которые вызывает бот, отдаёт обновления
+через getUpdates и считает вызовы. Задержку ответа можно задать для имитации сети.
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+# Вызовы, которые считаются ответом бота пользователю
+RESPONSE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument', 'answerCallbackQuery'}
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.updates = asyncio.Queue()
+        self.calls = Counter()
+        self.chat_messages = Counter()
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(1000)
+        self._waiters = defaultdict(list)
+        self._callback_chats = {}
+        self.runner = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def make_message(self, chat_id, text=None, **extra):
+        message = {
+            'message_id': next(self._message_id),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER
+        }
+        if text is not None:
+            message['text'] = text
+        message.update(extra)
+        return message
+
+    def make_update(self, user_id, text=None, callback_data=None, inline_query=None):
+        """Формирует обновление от пользователя: сообщение, нажатие кнопки или inline-запрос."""
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        update = {'update_id': next(self._update_id)}
+        if callback_data is not None:
+            message = self.make_message(user_id, "menu")
+            self._callback_chats[str(update['update_id'])] = user_id
+            update['callback_query'] = {
+                'id': str(update['update_id']), 'from': user, 'message': message,
+                'chat_instance': str(user_id), 'data': callback_data
+            }
+        elif inline_query is not None:
+            update['inline_query'] = {'id': str(update['update_id']), 'from': user, 'query': inline_query, 'offset': ''}
+        else:
+            message = {
+                'message_id': next(self._message_id), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': text or ''
+            }
+            if text and text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            update['message'] = message
+        return update
+
+    def push_update(self, update):
+        self.updates.put_nowait(update)
+
+    def expect(self, chat_id):
+        """Future, который завершится при следующем ответе бота в этот чат: (метод, текст)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append(future)
+        return future
+
+    def _responded(self, method, params):
+        if method not in RESPONSE_METHODS:
+            return
+        if method == 'answerCallbackQuery':
+            chat_id = self._callback_chats.pop(str(params.get('callback_query_id')), None)
+        else:
+            chat_id = int(params.get('chat_id') or 0)
+        for future in self._waiters.pop(chat_id, ()):
+            if not future.done():
+                future.set_result((method, params.get('text') or params.get('caption') or ''))
+
+    async def wait_for_calls(self, method, count, timeout=60):
+        """Ждёт, пока метод будет вызван count раз."""
+        deadline = time.monotonic() + timeout
+        while self.calls[method] < count:
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError(f"{method}: {self.calls[method]}/{count}")
+            await asyncio.sleep(0.01)
+
+    async def _params(self, request):
+        if request.content_type == 'multipart/form-data':
+            params = {}
+            async for part in await request.multipart():
+                params[part.name] = (await part.read()) if part.filename else await part.text()
+            return params
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post()) or dict(request.query)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = await self._dispatch(method, params)
+        self._responded(method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _dispatch(self, method, params):
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id not in (None, '') else 0
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            timeout = float(params.get('timeout') or 0)
+            updates = []
+            try:
+                updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+            except asyncio.TimeoutError:
+                return []
+            limit = int(params.get('limit') or 100)
+            while not self.updates.empty() and len(updates) < limit:
+                updates.append(self.updates.get_nowait())
+            return updates
+        if method in ('sendMessage', 'editMessageText'):
+            self.chat_messages[chat_id] += 1
+            if method == 'editMessageText':
+                return self.make_message(chat_id, params.get('text'), message_id=int(params.get('message_id') or 0))
+            return self.make_message(chat_id, params.get('text'))
+        if method == 'editMessageReplyMarkup':
+            return self.make_message(chat_id, "menu", message_id=int(params.get('message_id') or 0))
+        if method == 'sendDocument':
+            document = {'file_id': f"file{next(self._message_id)}", 'file_unique_id': 'u', 'file_name': 'file'}
+            return self.make_message(chat_id, document=document, caption=params.get('caption'))
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': self.updates.qsize()}
+        # deleteMessage, pinChatMessage, answerCallbackQuery, answerInlineQuery, setWebhook, deleteWebhook...
+        return True
+
+    async def start(self, port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
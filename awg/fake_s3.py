@@ -0,0 +1,105 @@
+"""Локальная замена S3-совместимого хранилища для проверки доставки бэкапов.
+
+Принимает PUT и GET по адресам /<bucket>/<key> и хранит объекты в каталоге root.
+Если заданы ключи, проверяет подпись AWS Signature Version 4 и контрольную сумму тела,
+как настоящее хранилище. Запуск отдельно: python3 fake_s3.py --root /tmp/s3 --port 9000
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+import uuid
+from datetime import datetime
+
+import pytz
+from aiohttp import web
+
+from backup_targets import sign_v4
+
+CREDENTIAL = re.compile(r'Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request')
+
+class FakeS3:
+    def __init__(self, root, access_key=None, secret_key=None):
+        # Абсолютный путь: _path() сравнивает с ним нормализованные пути объектов
+        self.root = os.path.abspath(root)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.runner = None
+        self.port = None
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _path(self, bucket, key):
+        path = os.path.normpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(self.root + os.sep):
+            raise web.HTTPBadRequest(text="bad key")
+        return path
+
+    def _check_signature(self, request, payload_hash):
+        if not self.secret_key:
+            return
+        match = CREDENTIAL.search(request.headers.get('Authorization', ''))
+        if not match or match.group(1) != self.access_key:
+            raise web.HTTPForbidden(text="InvalidAccessKeyId")
+        amz_date = datetime.strptime(request.headers.get('x-amz-date', ''), '%Y%m%dT%H%M%SZ').replace(tzinfo=pytz.utc)
+        # request.url не собирается из Host с портом в этой версии aiohttp
+        url = f"http://{request.host}{request.path}"
+        expected = sign_v4(request.method, url, payload_hash, self.access_key, self.secret_key, match.group(3), now=amz_date)
+        if not hmac.compare_digest(expected['Authorization'], request.headers['Authorization']):
+            raise web.HTTPForbidden(text="SignatureDoesNotMatch")
+
+    async def handle_put(self, request):
+        path = self._path(request.match_info['bucket'], request.match_info['key'])
+        payload_hash = request.headers.get('x-amz-content-sha256', '')
+        self._check_signature(request, payload_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        digest = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            async for chunk in request.content.iter_chunked(1 << 20):
+                digest.update(chunk)
+                f.write(chunk)
+        if payload_hash != 'UNSIGNED-PAYLOAD' and digest.hexdigest() != payload_hash:
+            os.remove(tmp_path)
+            raise web.HTTPBadRequest(text="XAmzContentSHA256Mismatch")
+        os.replace(tmp_path, path)
+        return web.Response(headers={'ETag': f'"{digest.hexdigest()[:32]}"'})
+
+    async def handle_get(self, request):
+        path = self._path(request.match_info['bucket'], request.match_info['key'])
+        self._check_signature(request, request.headers.get('x-amz-content-sha256', ''))
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound(text="NoSuchKey")
+        return web.FileResponse(path)
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_put('/{bucket}/{key:.+}', self.handle_put)
+        app.router.add_get('/{bucket}/{key:.+}', self.handle_get)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+async def main(args):
+    server = await FakeS3(args.root, args.access_key, args.secret_key).start(port=args.port)
+    print(f"Хранилище доступно на {server.endpoint}, каталог {args.root}")
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальная замена S3 для бэкапов")
+    parser.add_argument('--root', required=True, help="Каталог для объектов")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--access-key')
+    parser.add_argument('--secret-key')
+    asyncio.run(main(parser.parse_args()))
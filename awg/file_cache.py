@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import os
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FILE_IDS_FILE = 'files/file_ids.json'
+
+# {'by_hash': {sha256: file_id}, 'by_path': {path: sha256}}
+_cache = None
+
+def _load():
+    global _cache
+    if _cache is None:
+        data = db.load_json(FILE_IDS_FILE, {})
+        _cache = {
+            'by_hash': data.get('by_hash', {}),
+            'by_path': data.get('by_path', {})
+        }
+    return _cache
+
+def _save():
+    db.save_json(FILE_IDS_FILE, _load())
+
+def file_hash(path):
+    """Считает SHA-256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_file_id(path):
+    """Возвращает сохранённый file_id для текущего содержимого файла или None."""
+    cache = _load()
+    digest = file_hash(path)
+    old_digest = cache['by_path'].get(path)
+    if old_digest and old_digest != digest:
+        # Файл изменился - старый file_id больше не соответствует содержимому
+        cache['by_hash'].pop(old_digest, None)
+        cache['by_path'].pop(path, None)
+        _save()
+    return cache['by_hash'].get(digest), digest
+
+def remember_file_id(path, digest, file_id):
+    """Запоминает file_id, полученный после первой загрузки файла."""
+    cache = _load()
+    cache['by_hash'][digest] = file_id
+    cache['by_path'][path] = digest
+    _save()
+
+def invalidate(path):
+    """Удаляет из кэша все записи, связанные с файлом."""
+    cache = _load()
+    digest = cache['by_path'].pop(path, None)
+    if digest:
+        cache['by_hash'].pop(digest, None)
+        _save()
+
+@metrics.timed('send_document')
+async def send_cached_document(bot, chat_id, path, **kwargs):
+    """Отправляет файл, повторно используя file_id Telegram, если содержимое не менялось."""
+    file_id, digest = get_file_id(path)
+    if file_id:
+        try:
+            return await bot.send_document(chat_id, file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"file_id для {path} недействителен, загружаем заново: {str(e)}")
+            invalidate(path)
+    message = await bot.send_document(chat_id, types.InputFile(path, filename=os.path.basename(path)), **kwargs)
+    if message.document:
+        remember_file_id(path, digest, message.document.file_id)
+    return message
@@ -0,0 +1,106 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60
+MAX_ENTRIES = 10000
+
+class Idempotency:
+    """Защита дорогих операций (выдача ключа, создание клиента) от повторного запуска.
+
+    Операция определяется ключом (пользователь, действие, аргументы). Повторный запрос
+    с тем же ключом, пока операция выполняется, ждёт её результат; после завершения
+    в течение ttl секунд получает сохранённый результат. Повторная доставка того же
+    запроса (ID callback-запроса или сообщения) распознаётся отдельно.
+    Ошибки не кэшируются: после исключения операцию можно повторить.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight = {}
+        self._results = OrderedDict()
+        self._requests = OrderedDict()
+        self.stats = {'executed': 0, 'joined': 0, 'cached': 0, 'redelivered': 0, 'failed': 0}
+
+    def _cached(self, key):
+        entry = self._results.get(key)
+        if entry is None:
+            return False, None
+        expires, result = entry
+        if expires < time.monotonic():
+            del self._results[key]
+            return False, None
+        return True, result
+
+    def _remember(self, store, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_entries:
+            store.popitem(last=False)
+
+    async def run(self, key, func, *args, request_id=None, ttl=None):
+        """Выполняет func(*args) не более одного раза на ключ. Возвращает (результат, повтор ли это)."""
+        if request_id is not None:
+            if request_id in self._requests:
+                self.stats['redelivered'] += 1
+                key = self._requests[request_id]
+            else:
+                self._remember(self._requests, request_id, key)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['joined'] += 1
+            return await asyncio.shield(future), True
+        found, result = self._cached(key)
+        if found:
+            self.stats['cached'] += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.stats['failed'] += 1
+            future.set_exception(e)
+            # Исключение получат ожидающие повторы; если их нет, не выводим предупреждение
+            future.exception()
+            raise
+        else:
+            self.stats['executed'] += 1
+            future.set_result(result)
+            self._remember(self._results, key, (time.monotonic() + (self.ttl if ttl is None else ttl), result))
+            return result, False
+        finally:
+            del self._inflight[key]
+
+    def forget(self, key):
+        self._results.pop(key, None)
+
+    def get_stats(self):
+        return {**self.stats, 'inflight': len(self._inflight), 'cached_results': len(self._results)}
+
+def deduplicate(guard, notice="Запрос уже обрабатывается.", ttl=None):
+    """Декоратор обработчика callback-запроса: повторное нажатие не запускает действие заново."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(callback_query, *args):
+            key = (callback_query.from_user.id, handler.__name__, args)
+            result, duplicate = await guard.run(
+                key, handler, callback_query, *args, request_id=callback_query.id, ttl=ttl
+            )
+            if duplicate:
+                try:
+                    await callback_query.answer(notice)
+                except Exception:
+                    pass
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+import views
+
+logger = logging.getLogger(__name__)
+
+MAX_FINISHED_JOBS = 50
+PROGRESS_INTERVAL = 1.0
+
+STATUS_TITLES = {
+    'queued': "⏳ В очереди",
+    'running': "⚙️ Выполняется",
+    'done': "✅ Готово",
+    'failed': "❌ Ошибка",
+    'cancelled': "✖️ Отменено"
+}
+
+class Job:
+    __slots__ = ('id', 'title', 'key', 'owner_id', 'chat_id', 'message_id', 'status', 'progress',
+                 'created', 'task', '_last_report')
+
+    def __init__(self, title, owner_id, chat_id, message_id, key=None):
+        self.id = uuid.uuid4().hex[:8]
+        self.title = title
+        self.key = key
+        self.owner_id = owner_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.status = 'queued'
+        self.progress = ''
+        self.created = time.time()
+        self.task = None
+        self._last_report = 0.0
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+class JobRunner:
+    """Фоновое выполнение тяжёлых операций с ограничением числа одновременных задач.
+
+    Функция задачи получает первым аргументом report(text) для вывода прогресса
+    и возвращает итоговый текст, который показывается в том же сообщении.
+    cancel_markup может быть функцией от задачи (кнопка отмены знает ID задачи).
+    Задача с ключом key не запускается повторно, пока предыдущая с тем же ключом
+    в очереди или выполняется: submit() возвращает уже идущую задачу.
+    """
+
+    def __init__(self, bot, workers=2):
+        self.bot = bot
+        self.workers = workers
+        self._semaphore = None
+        self.jobs = OrderedDict()
+
+    def submit(self, title, func, *args, owner_id=None, chat_id=None, message_id=None,
+               done_markup=None, parse_mode=None, cancel_markup=None, key=None):
+        if key is not None:
+            existing = self.find(key)
+            if existing:
+                return existing
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        job = Job(title, owner_id, chat_id, message_id, key)
+        self.jobs[job.id] = job
+        self._trim()
+        job.task = asyncio.create_task(self._run(job, func, args, done_markup, parse_mode, cancel_markup))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def find(self, key):
+        """Незавершённая задача с ключом key или None."""
+        for job in self.jobs.values():
+            if job.key == key and not job.finished:
+                return job
+        return None
+
+    def list(self):
+        return list(self.jobs.values())
+
+    def active(self):
+        return [job for job in self.jobs.values() if not job.finished]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.finished:
+            return False
+        job.task.cancel()
+        return True
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    async def _show(self, job, text, reply_markup=None, parse_mode=None):
+        if job.chat_id is None:
+            return
+        try:
+            job.chat_id, job.message_id = await views.show(
+                self.bot, job.chat_id, job.message_id, text, reply_markup=reply_markup, parse_mode=parse_mode
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обновления сообщения задачи {job.id}: {str(e)}")
+
+    async def _run(self, job, func, args, done_markup, parse_mode, cancel_markup):
+        if callable(cancel_markup):
+            cancel_markup = cancel_markup(job)
+
+        async def report(text, force=False):
+            job.progress = text
+            now = time.monotonic()
+            if force or now - job._last_report >= PROGRESS_INTERVAL:
+                job._last_report = now
+                await self._show(job, f"{STATUS_TITLES[job.status]}: {job.title}\n{text}", cancel_markup)
+
+        try:
+            await self._show(job, f"{STATUS_TITLES['queued']}: {job.title}", cancel_markup)
+            async with self._semaphore:
+                job.status = 'running'
+                await report("Начато", force=True)
+                result = await func(report, *args)
+            job.status = 'done'
+            job.progress = result or ''
+            await self._show(job, result or f"{STATUS_TITLES['done']}: {job.title}", done_markup, parse_mode)
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            await self._show(job, f"{STATUS_TITLES['cancelled']}: {job.title}", done_markup)
+        except Exception as e:
+            job.status = 'failed'
+            job.progress = str(e)
+            logger.error(f"Ошибка задачи {job.id} ({job.title}): {str(e)}")
+            await self._show(job, f"{STATUS_TITLES['failed']}: {job.title}\n{str(e)}", done_markup)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot, types
+from aiogram.dispatcher import Dispatcher
+
+import metrics
+import watchdog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANES = 8
+DEFAULT_QUEUE_SIZE = 100
+
+def update_type(update):
+    return next((name for name in update.values if name != 'update_id'), 'unknown')
+
+def describe(update):
+    """Короткое описание обновления для отчётов о зависаниях."""
+    kind = update_type(update)
+    event = update.values.get(kind)
+    detail = getattr(event, 'data', None) or getattr(event, 'text', None) or ''
+    return f"{kind} {update.update_id} от {update_key(update)}: {detail[:64]}"
+
+def update_key(update):
+    """Ключ упорядочивания обновления: ID пользователя, иначе ID чата, иначе ID обновления."""
+    for name, value in update.values.items():
+        if name == 'update_id' or not hasattr(value, 'values'):
+            continue
+        inner = value.values
+        user = inner.get('from') or inner.get('user')
+        if user is not None:
+            return user.id
+        chat = inner.get('chat')
+        if chat is not None:
+            return chat.id
+    return update.update_id
+
+class Lane:
+    __slots__ = ('index', 'queue', 'processed', 'failed', 'max_depth', 'busy_since', 'slowest')
+
+    def __init__(self, index, queue_size):
+        self.index = index
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.busy_since = None
+        self.slowest = 0.0
+
+class LaneDispatcher:
+    """Распределение обновлений по N очередям по ID пользователя.
+
+    Обновления одного пользователя обрабатываются строго по порядку в своей очереди,
+    разные очереди работают параллельно, поэтому долгая выдача ключа одному пользователю
+    не задерживает остальных. Очереди ограничены: при переполнении submit ждёт места.
+    on_done(update) вызывается после обработки каждого обновления (успешной или нет).
+    """
+
+    def __init__(self, dp, lanes=DEFAULT_LANES, queue_size=DEFAULT_QUEUE_SIZE, on_done=None):
+        self.dp = dp
+        self.size = lanes
+        self.queue_size = queue_size
+        self.on_done = on_done
+        self.lanes = []
+        self.workers = []
+        self._submit_lock = None
+        self.stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'blocked': 0, 'blocked_seconds': 0.0}
+
+    def start(self):
+        if self.workers:
+            return
+        self.lanes = [Lane(i, self.queue_size) for i in range(self.size)]
+        self.workers = [asyncio.create_task(self._worker(lane)) for lane in self.lanes]
+        self._submit_lock = asyncio.Lock()
+
+    def lane_for(self, update):
+        return self.lanes[update_key(update) % self.size]
+
+    async def submit(self, update):
+        """Ставит обновление в очередь его пользователя, ожидая места при переполнении."""
+        if isinstance(update, dict):
+            update = types.Update(**update)
+        if not self.workers:
+            self.start()
+        lane = self.lane_for(update)
+        self.stats['submitted'] += 1
+        if lane.queue.full():
+            self.stats['blocked'] += 1
+            started = time.monotonic()
+            await lane.queue.put(update)
+            self.stats['blocked_seconds'] += time.monotonic() - started
+        else:
+            lane.queue.put_nowait(update)
+        lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+
+    async def submit_many(self, updates):
+        # Пачки из разных задач не должны перемешиваться, пока одна ждёт места в очереди
+        if not self.workers:
+            self.start()
+        async with self._submit_lock:
+            for update in updates:
+                await self.submit(update)
+
+    async def _worker(self, lane):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            update = await lane.queue.get()
+            lane.busy_since = time.monotonic()
+            watchdog.set_task_label(describe(update))
+            try:
+                with metrics.handler_seconds.time('update', update_type(update)):
+                    await self.dp.process_update(update)
+                lane.processed += 1
+                self.stats['processed'] += 1
+            except Exception as e:
+                lane.failed += 1
+                self.stats['failed'] += 1
+                logger.error(f"Ошибка обработки обновления {update.update_id} в очереди {lane.index}: {str(e)}")
+            finally:
+                lane.slowest = max(lane.slowest, time.monotonic() - lane.busy_since)
+                lane.busy_since = None
+                if self.on_done:
+                    try:
+                        self.on_done(update)
+                    except Exception as e:
+                        logger.error(f"Ошибка отметки обновления {update.update_id}: {str(e)}")
+                lane.queue.task_done()
+
+    async def join(self):
+        for lane in self.lanes:
+            await lane.queue.join()
+
+    def pending(self):
+        return sum(lane.queue.qsize() for lane in self.lanes) + sum(1 for lane in self.lanes if lane.busy_since)
+
+    async def stop(self, timeout=None):
+        """Дожидается обработки очередей (не дольше timeout) и останавливает обработчики."""
+        drained = True
+        if self.lanes:
+            try:
+                await asyncio.wait_for(self.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                drained = False
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        return drained
+
+    def install(self, dp=None):
+        """Подключает очереди к long polling: пачки из getUpdates идут через submit."""
+        dp = dp or self.dp
+
+        async def process_polling_updates(updates, fast=True):
+            await self.submit_many(updates)
+
+        dp._process_polling_updates = process_polling_updates
+        return self
+
+    def get_stats(self):
+        now = time.monotonic()
+        return {
+            **self.stats,
+            'lanes': [
+                {
+                    'depth': lane.queue.qsize(),
+                    'max_depth': lane.max_depth,
+                    'processed': lane.processed,
+                    'failed': lane.failed,
+                    'busy_for': round(now - lane.busy_since, 3) if lane.busy_since else 0.0,
+                    'slowest': round(lane.slowest, 3)
+                }
+                for lane in self.lanes
+            ]
+        }
@@ -0,0 +1,235 @@
+"""Метрики в текстовом формате Prometheus без внешних зависимостей.
+
+Счётчики и гистограммы обновляются за O(1) (гистограмма - бинарный поиск по границам),
+значения gauge-функций и сборщиков вычисляются только при запросе /metrics.
+"""
+import bisect
+import functools
+import inspect
+import logging
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9101
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self.values.items()
+        ]
+
+class Gauge(Metric):
+    """Значение задаётся set() или вычисляется функцией при каждом запросе метрик."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.func = func
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def render(self):
+        values = self.values
+        if self.func:
+            try:
+                result = self.func()
+                values = result if isinstance(result, dict) else {(): result}
+            except Exception as e:
+                logger.error(f"Ошибка вычисления метрики {self.name}: {str(e)}")
+                values = {}
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels if isinstance(labels, tuple) else (labels,))} {value}"
+            for labels, value in values.items()
+        ]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            # счётчики по корзинам, сумма, количество
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            errors.inc(self.histogram.name, ':'.join(str(label) for label in self.labels))
+        return False
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Регистрирует функцию, возвращающую [(имя, тип, описание, {метки: значение})] при каждом запросе."""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                logger.error(f"Ошибка сборщика метрик {collect.__name__}: {str(e)}")
+                continue
+            for name, kind, documentation, values in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values.items():
+                    labelnames = tuple(label for label, _ in labels)
+                    lines.append(f"{name}{_labels(labelnames, tuple(v for _, v in labels))} {value}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=(), func=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, func))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+errors = counter('awg_errors_total', "Ошибки по операциям", ('operation', 'name'))
+handler_seconds = histogram('awg_handler_seconds', "Длительность обработчиков обновлений", ('kind', 'name'))
+step_seconds = histogram('awg_step_seconds', "Длительность шагов выдачи и удаления ключей", ('step',))
+api_seconds = histogram('awg_telegram_api_seconds', "Длительность вызовов Telegram Bot API", ('method',))
+
+def timed(step):
+    """Декоратор: время выполнения функции (обычной или async) попадает в awg_step_seconds.
+
+    Исключение или результат False считается ошибкой шага.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with step_seconds.time(step):
+                    result = await func(*args, **kwargs)
+                if result is False:
+                    errors.inc(step_seconds.name, step)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with step_seconds.time(step):
+                result = func(*args, **kwargs)
+            if result is False:
+                errors.inc(step_seconds.name, step)
+            return result
+        return wrapper
+    return decorator
+
+def instrument_bot(bot):
+    """Оборачивает bot.request: каждый вызов Bot API учитывается в awg_telegram_api_seconds."""
+    request = bot.request
+
+    @functools.wraps(request)
+    async def timed_request(method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(method, data, files, **kwargs)
+        except Exception:
+            errors.inc(api_seconds.name, method)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+    bot.request = timed_request
+    return bot
+
+async def handle_metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+async def start_server(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Запускает локальный HTTP-сервер с /metrics; возвращает runner для остановки."""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
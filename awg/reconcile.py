@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Сверка состояния клиентов между всеми местами, где оно хранится.
+
+Источники: каталоги users/<имя>/, пиры конфигурации сервера (из контейнера, при его
+недоступности - локальная копия files/server.conf), clientsTable, user_expiration.json и
+user_telegram.json. Все источники читаются один раз и сверяются по публичному ключу и имени
+за один проход по каждому, поэтому сверка 50 тысяч клиентов занимает доли секунды.
+
+По умолчанию только отчёт. С fix=True расхождения исправляются пачкой: конфигурация сервера
+переписывается один раз и применяется одним wg syncconf, каждый JSON-файл сохраняется один раз,
+каталоги клиентов без пира переносятся в orphans/, а не удаляются.
+
+Запуск из каталога бота: python3 reconcile.py [--fix] [--force]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
+
+import db
+import wg
+
+logger = logging.getLogger(__name__)
+
+USERS_DIR = 'users'
+ORPHANS_DIR = 'orphans'
+SERVER_CONF = os.path.join('files', 'server.conf')
+CLIENTS_TABLE = os.path.join('files', 'clientsTable')
+# Каталоги моложе этого могут принадлежать клиенту, которого прямо сейчас создаёт newclient.sh
+GRACE_PERIOD = 600
+# Если исправление затронет большую долю клиентов, вероятнее ошибка в источнике (пустой ответ
+# контейнера, не тот рабочий каталог), чем настоящие сироты; такое исправление требует force
+MAX_FIX_SHARE = 0.2
+
+ISSUES = {
+    'peer_without_user': "Пиры без клиента в users/",
+    'user_without_peer': "Клиенты без пира на сервере",
+    'incomplete_user': "Каталоги users/ без конфигурации (прерванный newclient.sh)",
+    'peer_without_table': "Пиры без записи в clientsTable",
+    'table_without_peer': "Записи clientsTable без пира",
+    'unnamed_peer': "Пиры без имени (только отчёт)",
+    'expiration_orphan': "Сроки действия удалённых клиентов",
+    'telegram_orphan': "Привязки Telegram удалённых клиентов"
+}
+FIXABLE = tuple(kind for kind in ISSUES if kind != 'unnamed_peer')
+# Исправления, которые переписывают конфигурацию сервера и clientsTable
+PEER_FIXES = ('peer_without_user', 'peer_without_table', 'table_without_peer')
+# Исправления, которые переносят каталоги клиентов в orphans/
+DIR_FIXES = ('incomplete_user', 'user_without_peer')
+
+class Sources:
+    """Снимок всех источников, прочитанный один раз."""
+    __slots__ = ('users', 'server_text', 'peers', 'clients_table', 'expirations', 'telegram', 'live')
+
+    def __init__(self, users, server_text, clients_table, expirations, telegram, live):
+        self.users = users
+        self.server_text = server_text
+        self.peers = wg.parse_server_config(server_text)
+        self.clients_table = clients_table
+        self.expirations = expirations
+        self.telegram = telegram
+        self.live = live
+
+def _scan_users(users_dir):
+    """{имя: (есть ли <имя>.conf, mtime каталога)} за один обход users/."""
+    users = {}
+    try:
+        with os.scandir(users_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    has_conf = os.path.exists(os.path.join(entry.path, f"{entry.name}.conf"))
+                    users[entry.name] = (has_conf, entry.stat().st_mtime)
+    except FileNotFoundError:
+        pass
+    return users
+
+def _read_container(docker_container, path):
+    return subprocess.run(
+        ["docker", "exec", "-i", docker_container, "cat", path],
+        capture_output=True, text=True, check=True, timeout=60
+    ).stdout
+
+def _parse_table(text):
+    try:
+        table = json.loads(text) if text.strip() else []
+    except ValueError:
+        logger.error("clientsTable не разбирается как JSON")
+        return None
+    return table if isinstance(table, list) else None
+
+def load_sources(docker_container=None, wg_config_file=None, users_dir=USERS_DIR):
+    """Читает все источники. Конфигурация сервера и clientsTable берутся из контейнера;
+    если он недоступен - из локальных копий, и исправлять пиры по ним нельзя (live=False)."""
+    live = False
+    server_text = table_text = None
+    if docker_container and wg_config_file:
+        try:
+            server_text = _read_container(docker_container, wg_config_file)
+            live = True
+            try:
+                table_text = _read_container(docker_container, wg.CLIENTS_TABLE_PATH)
+            except subprocess.CalledProcessError:
+                table_text = '[]'
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"Не удалось прочитать конфигурацию из контейнера, сверка по локальной копии: {str(e)}")
+    if server_text is None:
+        server_text = _read_local(SERVER_CONF)
+    if table_text is None:
+        table_text = _read_local(CLIENTS_TABLE)
+    clients_table = _parse_table(table_text)
+    if clients_table is None:
+        # Неразборчивую таблицу не перезаписываем, её записи просто не участвуют в сверке
+        clients_table, live = [], False
+    return Sources(
+        _scan_users(users_dir), server_text, clients_table,
+        db.load_json(db.USER_EXPIRATION_FILE, {}), db.load_json(db.USER_TELEGRAM_FILE, {}), live
+    )
+
+def _read_local(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+def find_issues(sources, now=None, grace=GRACE_PERIOD):
+    """Все расхождения за один проход по каждому источнику: {вид: [(имя, публичный ключ)]}."""
+    now = now or time.time()
+    issues = defaultdict(list)
+    table = {}
+    for entry in sources.clients_table:
+        if isinstance(entry, dict) and entry.get('clientId'):
+            table[entry['clientId']] = (entry.get('userData') or {}).get('clientName')
+
+    peer_by_name = {}
+    for key, peer in sources.peers.items():
+        name = peer.name or table.get(key)
+        if not name:
+            issues['unnamed_peer'].append((None, key))
+            continue
+        peer_by_name[name] = key
+        if key not in table:
+            issues['peer_without_table'].append((name, key))
+        if name not in sources.users:
+            issues['peer_without_user'].append((name, key))
+    for key, name in table.items():
+        if key not in sources.peers:
+            issues['table_without_peer'].append((name, key))
+
+    # Клиенты, которые останутся после исправления: сроки и привязки остальных - сироты
+    remaining = set()
+    for name, (has_conf, mtime) in sources.users.items():
+        if now - mtime < grace:
+            remaining.add(name)
+        elif not has_conf:
+            issues['incomplete_user'].append((name, peer_by_name.get(name)))
+        elif name not in peer_by_name:
+            issues['user_without_peer'].append((name, None))
+        else:
+            remaining.add(name)
+    for name in sources.expirations:
+        if name not in remaining:
+            issues['expiration_orphan'].append((name, None))
+    for name in sources.telegram:
+        if name not in remaining:
+            issues['telegram_orphan'].append((name, None))
+    return issues
+
+class Reconciliation:
+    __slots__ = ('sources', 'issues', 'fixed', 'skipped', 'duration')
+
+    def __init__(self, sources, issues, duration):
+        self.sources = sources
+        self.issues = issues
+        self.fixed = {}
+        self.skipped = None
+        self.duration = duration
+
+    def count(self, kinds=ISSUES):
+        return sum(len(self.issues.get(kind, ())) for kind in kinds)
+
+    def report(self, limit=20):
+        sources = self.sources
+        lines = [
+            f"Сверка за {self.duration * 1000:.0f} мс: каталогов users/ {len(sources.users)}, "
+            f"пиров {len(sources.peers)}{'' if sources.live else ' (локальная копия)'}, "
+            f"записей clientsTable {len(sources.clients_table)}, сроков {len(sources.expirations)}, "
+            f"привязок Telegram {len(sources.telegram)}"
+        ]
+        for kind, title in ISSUES.items():
+            found = self.issues.get(kind)
+            if found:
+                names = [name or key for name, key in found[:limit]]
+                lines.append(f"{title} ({len(found)}): {', '.join(names)}" + (" ..." if len(found) > limit else ""))
+        if not self.count():
+            lines.append("Расхождений нет")
+        if self.fixed:
+            lines.append("Исправлено: " + '; '.join(f"{ISSUES[kind]} - {count}" for kind, count in self.fixed.items()))
+        if self.skipped:
+            lines.append(f"Не исправлено: {self.skipped}")
+        return lines
+
+def _move_aside(names, users_dir, stamp):
+    target = os.path.join(ORPHANS_DIR, stamp)
+    os.makedirs(target, exist_ok=True)
+    for name in names:
+        try:
+            shutil.move(os.path.join(users_dir, name), os.path.join(target, name))
+        except FileNotFoundError:
+            pass
+
+def _fix_peers(result, docker_container, wg_config_file):
+    sources, issues = result.sources, result.issues
+    remove_keys = {key for kind in ('peer_without_user', 'incomplete_user') for _, key in issues.get(kind, ()) if key}
+    stale_keys = {key for _, key in issues.get('table_without_peer', ())}
+    missing = [(name, key) for name, key in issues.get('peer_without_table', ()) if key not in remove_keys]
+    with open(SERVER_CONF, 'w') as f:
+        f.write(wg.remove_peers(sources.server_text, remove_keys))
+    created = datetime.now(pytz.utc).strftime('%a %b %d %H:%M:%S %Y')
+    table = [entry for entry in sources.clients_table
+             if not (isinstance(entry, dict) and entry.get('clientId') in remove_keys | stale_keys)]
+    table.extend({'clientId': key, 'userData': {'clientName': name, 'creationDate': created}} for name, key in missing)
+    db.save_json(CLIENTS_TABLE, table)
+    wg.apply_server_config(docker_container, wg_config_file, SERVER_CONF, CLIENTS_TABLE)
+
+def _drop_keys(path, names):
+    data = db.load_json(path, {})
+    for name in names:
+        data.pop(name, None)
+    db.save_json(path, data)
+
+def apply_fixes(result, docker_container, wg_config_file, users_dir=USERS_DIR):
+    """Исправляет найденное. Вызывается только по живой конфигурации сервера (sources.live)."""
+    issues = result.issues
+    # Пиры прерванного newclient.sh без клиентской конфигурации бесполезны: их ключ утерян
+    if result.count(PEER_FIXES) or any(key for _, key in issues.get('incomplete_user', ())):
+        _fix_peers(result, docker_container, wg_config_file)
+        result.fixed.update((kind, len(issues.get(kind, ()))) for kind in PEER_FIXES)
+    orphan_dirs = [name for kind in DIR_FIXES for name, _ in issues.get(kind, ())]
+    if orphan_dirs:
+        _move_aside(orphan_dirs, users_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        result.fixed.update((kind, len(issues.get(kind, ()))) for kind in DIR_FIXES)
+    # Файлы перечитываются перед записью, чтобы не затереть изменения бота за время сверки
+    for kind, path in (('expiration_orphan', db.USER_EXPIRATION_FILE), ('telegram_orphan', db.USER_TELEGRAM_FILE)):
+        if issues.get(kind):
+            _drop_keys(path, [name for name, _ in issues[kind]])
+            result.fixed[kind] = len(issues[kind])
+    result.fixed = {kind: count for kind, count in result.fixed.items() if count}
+
+def run(docker_container=None, wg_config_file=None, fix=False, force=False, users_dir=USERS_DIR):
+    """Сверка (и при fix=True исправление) под блокировкой изменений пиров."""
+    with db.clients_lock():
+        started = time.perf_counter()
+        sources = load_sources(docker_container, wg_config_file, users_dir)
+        result = Reconciliation(sources, find_issues(sources), 0.0)
+        result.duration = time.perf_counter() - started
+        fixable = result.count(FIXABLE)
+        if not fix or not fixable:
+            return result
+        # Сироты определяются по набору пиров: по устаревшей локальной копии настоящие клиенты
+        # выглядели бы клиентами без пира, поэтому без живой конфигурации не исправляется ничего
+        if not sources.live:
+            result.skipped = "конфигурация сервера прочитана не из контейнера, исправления не выполнялись"
+            return result
+        total = max(len(sources.users) + len(sources.peers), 1)
+        if not force and fixable > total * MAX_FIX_SHARE:
+            result.skipped = (f"исправление затронет {fixable} из {total} записей (больше {MAX_FIX_SHARE:.0%}), "
+                              f"нужен запуск с force")
+            return result
+        apply_fixes(result, docker_container, wg_config_file, users_dir)
+    return result
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    setting = db.get_config()
+    result = run(setting.get('docker_container'), setting.get('wg_config_file'), fix=args.fix, force=args.force)
+    print('\n'.join(result.report(limit=args.limit)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сверка клиентов между users/, сервером, clientsTable и JSON-файлами")
+    parser.add_argument('--fix', action='store_true', help="Исправить расхождения (по умолчанию только отчёт)")
+    parser.add_argument('--force', action='store_true', help=f"Исправлять, даже если затронуто больше {MAX_FIX_SHARE:.0%} записей")
+    parser.add_argument('--limit', type=int, default=20, help="Сколько имён выводить для каждого вида расхождений")
+    main(parser.parse_args())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Восстановление из бэкапа с проверкой контрольных сумм и сверкой с живым интерфейсом.
+
+Источник - тома из каталога (--dir, туда же можно сложить тома, скачанные из Telegram),
+из S3 (--s3, место доставки из backup_targets) или локальный снимок (--snapshot).
+Тома скачиваются и проверяются по SHA-256 параллельно, каждый файл при распаковке сверяется
+с хэшем из манифеста. Только если всё сошлось, files/ и users/ подменяются восстановленными
+(прежние переносятся в restore_previous/), производное состояние бота (кэш file_id, главные
+сообщения и токены кнопок, счётчики статистики) сбрасывается, а все пиры загружаются
+в контейнер одним wg syncconf. Индексы клиентов бот строит при запуске сам. В конце выводятся расхождения с живым интерфейсом.
+
+Бот на время восстановления нужно остановить.
+Запуск из каталога бота: python3 restore.py --dir /var/backups/awg [--id 20250101-120000]
+        [--verify-only] [--no-apply] [--workers 4]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import db
+import wg
+from backup import BackupStore, BACKUP_DIR, BACKUP_SOURCES, CHUNK_SIZE, manifest_name
+from backup_targets import S3Target, file_sha256, make_targets
+from dashboard import DASHBOARD_FILE
+from file_cache import FILE_IDS_FILE
+from state_store import STATE_DB_FILE
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = 'restore_tmp'
+PREVIOUS_DIR = 'restore_previous'
+SERVER_CONF = os.path.join('files', 'server.conf')
+CLIENTS_TABLE = os.path.join('files', 'clientsTable')
+
+class VerificationError(Exception):
+    pass
+
+class DirectorySource:
+    """Тома в каталоге: <path>/<id>/<том> (как пишет место доставки dir) или прямо в <path>."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _find(self, backup_id, name):
+        for candidate in (os.path.join(self.path, backup_id, name), os.path.join(self.path, name)):
+            if os.path.exists(candidate):
+                return candidate
+        raise FileNotFoundError(f"{name} не найден в {self.path}")
+
+    def latest_id(self):
+        suffix = '.manifest.json'
+        found = []
+        for root, _, names in os.walk(self.path):
+            found.extend(name[len('backup_'):-len(suffix)] for name in names
+                         if name.startswith('backup_') and name.endswith(suffix))
+        return max(found) if found else None
+
+    async def get(self, backup_id, name, dest):
+        await asyncio.to_thread(shutil.copyfile, self._find(backup_id, name), dest)
+
+def _safe_path(tree, name):
+    if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise VerificationError(f"{name}: недопустимый путь")
+    return os.path.join(tree, name)
+
+def _extract_member(archive, name, dest, expected_hash):
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    digest = hashlib.sha256()
+    with archive.open(name) as src, open(dest, 'wb') as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    if digest.hexdigest() != expected_hash:
+        raise VerificationError(f"{name}: содержимое не совпадает с манифестом")
+
+def extract_volume(volume_path, files, tree):
+    """Распаковывает том в tree, сверяя каждый файл с хэшем из манифеста."""
+    restored = 0
+    with zipfile.ZipFile(volume_path) as archive:
+        for name in archive.namelist():
+            entry = files.get(name)
+            if entry is None:
+                raise VerificationError(f"{name}: файла нет в манифесте")
+            dest = _safe_path(tree, name)
+            _extract_member(archive, name, dest, entry['hash'])
+            os.chmod(dest, entry.get('mode', 0o644))
+            restored += 1
+    return restored
+
+def join_parts(part_paths, volume_path):
+    with open(volume_path, 'wb') as dst:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as src:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            os.remove(part_path)
+
+async def fetch_volumes(source, backup_id, staging, tree, workers):
+    """Скачивает манифест и тома, проверяет SHA-256 частей и файлов. Возвращает манифест."""
+    manifest_path = os.path.join(staging, manifest_name(backup_id))
+    await source.get(backup_id, manifest_name(backup_id), manifest_path)
+    manifest = db.load_json(manifest_path, None)
+    if not manifest or 'volumes' not in manifest:
+        raise VerificationError(f"Манифест {manifest_name(backup_id)} не читается")
+    loop = asyncio.get_running_loop()
+    downloads = asyncio.Semaphore(workers)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restore')
+
+    async def restore_volume(volume):
+        part_paths = []
+        for part in volume['parts']:
+            part_path = os.path.join(staging, part['name'])
+            async with downloads:
+                await source.get(backup_id, part['name'], part_path)
+            digest = await loop.run_in_executor(executor, file_sha256, part_path)
+            if digest != part['sha256']:
+                raise VerificationError(f"{part['name']}: контрольная сумма не совпадает")
+            part_paths.append(part_path)
+        volume_path = part_paths[0]
+        if len(part_paths) > 1:
+            volume_path = os.path.join(staging, volume['name'])
+            await loop.run_in_executor(executor, join_parts, part_paths, volume_path)
+        restored = await loop.run_in_executor(executor, extract_volume, volume_path, manifest['files'], tree)
+        os.remove(volume_path)
+        if restored != volume['files']:
+            raise VerificationError(f"{volume['name']}: файлов {restored}, ожидалось {volume['files']}")
+        return restored
+
+    try:
+        await asyncio.gather(*(restore_volume(volume) for volume in manifest['volumes']))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return manifest
+
+def restore_snapshot(store, manifest, tree, workers):
+    """Восстанавливает локальный снимок из хранилища объектов, сверяя хэши."""
+    def restore_file(item):
+        path, entry = item
+        dest = _safe_path(tree, path)
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        digest = hashlib.sha256()
+        try:
+            with store.open_object(entry['hash']) as src, open(dest, 'wb') as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+        except (OSError, EOFError) as e:
+            raise VerificationError(f"{path}: объект в хранилище не читается ({str(e)})")
+        if digest.hexdigest() != entry['hash']:
+            raise VerificationError(f"{path}: объект в хранилище повреждён")
+        os.chmod(dest, entry.get('mode', 0o644))
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restore') as executor:
+        list(executor.map(restore_file, manifest['files'].items()))
+    return manifest
+
+def swap_in(tree, sources=BACKUP_SOURCES):
+    """Подменяет текущие files/, users/ и скрипты восстановленными; прежние переносит в restore_previous/."""
+    aside = os.path.join(PREVIOUS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(aside, exist_ok=True)
+    for source in sources:
+        staged = os.path.join(tree, source)
+        if not os.path.exists(staged):
+            continue
+        if os.path.exists(source):
+            os.replace(source, os.path.join(aside, source))
+        os.replace(staged, source)
+    return aside
+
+def reset_derived_state():
+    """Сбрасывает сохранённое состояние, которое бот вычислил из прежних данных.
+
+    file_id в Telegram указывают на файлы на момент отправки, главные сообщения и токены
+    кнопок - на клиентов, которых после восстановления может не быть, а счётчики статистики
+    ведутся с момента бэкапа. Исходные файлы остаются в бэкапе. Возвращает список сброшенного.
+    """
+    reset = []
+    for path in (FILE_IDS_FILE, DASHBOARD_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+            reset.append(path)
+    if os.path.exists(STATE_DB_FILE):
+        connection = sqlite3.connect(STATE_DB_FILE)
+        try:
+            for table in ('user_state', 'callback_tokens'):
+                try:
+                    connection.execute(f"DELETE FROM {table}")
+                except sqlite3.OperationalError:
+                    continue
+                reset.append(f"{STATE_DB_FILE}:{table}")
+            connection.commit()
+        finally:
+            connection.close()
+    return reset
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+def consistency_report(root, live):
+    """Сверка восстановленного состояния: server.conf, clientsTable, users/ и живой интерфейс."""
+    lines = []
+    expected = wg.parse_server_config(read_text(os.path.join(root, SERVER_CONF)))
+    users_dir = os.path.join(root, 'users')
+    users = set(os.listdir(users_dir)) if os.path.isdir(users_dir) else set()
+    clients_table = db.load_json(os.path.join(root, CLIENTS_TABLE), [])
+    table_keys = {client.get('clientId') for client in clients_table if isinstance(client, dict)}
+    peer_names = {peer.name for peer in expected.values() if peer.name}
+
+    lines.append(f"Пиров в server.conf: {len(expected)}, каталогов users/: {len(users)}, записей clientsTable: {len(table_keys)}")
+    if not expected:
+        lines.append("⚠️ В бэкапе нет files/server.conf - пиры восстановить не из чего")
+    for title, names in (
+        ("Клиенты без пира в server.conf", sorted(users - peer_names)),
+        ("Пиры без каталога в users/", sorted(peer_names - users)),
+        ("Пиры без записи в clientsTable", sorted(peer.name or key for key, peer in expected.items() if key not in table_keys)),
+        ("Записи clientsTable без пира", sorted(key for key in table_keys - expected.keys() if key))
+    ):
+        if names:
+            lines.append(f"{title} ({len(names)}): {', '.join(names[:20])}" + (" ..." if len(names) > 20 else ""))
+    if live is None:
+        lines.append("Живой интерфейс не проверен")
+        return lines
+    missing, extra, changed = wg.diff_peers(expected, live)
+    lines.append(f"Живой интерфейс: пиров {len(live)}, не загружено {len(missing)}, лишних {len(extra)}, "
+                 f"с другими AllowedIPs {len(changed)}")
+    for peer in missing[:20]:
+        lines.append(f"  - нет в интерфейсе: {peer.name or peer.public_key} ({peer.allowed_ips})")
+    for peer in extra[:20]:
+        lines.append(f"  + лишний в интерфейсе: {peer.public_key} ({peer.allowed_ips})")
+    for expected_peer, live_peer in changed[:20]:
+        lines.append(f"  ~ {expected_peer.name or expected_peer.public_key}: {expected_peer.allowed_ips} -> {live_peer.allowed_ips}")
+    if not (missing or extra or changed):
+        lines.append("Расхождений с живым интерфейсом нет")
+    return lines
+
+def live_peers(setting):
+    try:
+        return wg.read_live_peers(setting['docker_container'], setting['wg_config_file'])
+    except Exception as e:
+        logger.error(f"Не удалось прочитать пиры интерфейса: {str(e)}")
+        return None
+
+def make_source(args, setting):
+    if args.dir:
+        return DirectorySource(args.dir)
+    targets = [target for target in make_targets(setting.get('backup_targets')) if isinstance(target, S3Target)]
+    if not targets:
+        raise SystemExit("В backup_targets нет места доставки s3")
+    return targets[0]
+
+async def main(args):
+    setting = db.get_config()
+    started = time.perf_counter()
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    tree = os.path.join(STAGING_DIR, 'tree')
+    os.makedirs(tree)
+    try:
+        if args.snapshot:
+            store = BackupStore(setting.get('backup_dir', BACKUP_DIR))
+            snapshot_id = store.list_snapshots()[-1] if args.snapshot == 'latest' and store.list_snapshots() else args.snapshot
+            manifest = store.load(snapshot_id)
+            if manifest is None:
+                raise SystemExit(f"Снимок {args.snapshot} не найден")
+            await asyncio.to_thread(restore_snapshot, store, manifest, tree, args.workers)
+        else:
+            source = make_source(args, setting)
+            backup_id = args.id or (source.latest_id() if isinstance(source, DirectorySource) else None)
+            if not backup_id:
+                raise SystemExit("Не найден манифест бэкапа, укажите --id")
+            manifest = await fetch_volumes(source, backup_id, STAGING_DIR, tree, args.workers)
+    except VerificationError as e:
+        shutil.rmtree(STAGING_DIR, ignore_errors=True)
+        raise SystemExit(f"❌ Проверка не пройдена, текущие данные не изменены: {str(e)}")
+    total_bytes = sum(entry['size'] for entry in manifest['files'].values())
+    print(f"Бэкап {manifest['id']}: проверено файлов {len(manifest['files'])}, {total_bytes / 1024 / 1024:.1f} МБ "
+          f"за {time.perf_counter() - started:.1f} с")
+
+    if args.verify_only:
+        report = consistency_report(tree, live_peers(setting))
+        shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    else:
+        aside = swap_in(tree)
+        shutil.rmtree(STAGING_DIR, ignore_errors=True)
+        print(f"Данные восстановлены, прежние перенесены в {aside}")
+        reset = reset_derived_state()
+        if reset:
+            print(f"Сброшено производное состояние: {', '.join(reset)}")
+        # Контейнер и путь к конфигурации берутся из восстановленного config.json, если он есть
+        setting = db.get_config() or setting
+        if not args.no_apply and os.path.exists(SERVER_CONF):
+            apply_started = time.perf_counter()
+            try:
+                await asyncio.to_thread(
+                    wg.apply_server_config, setting['docker_container'], setting['wg_config_file'], SERVER_CONF, CLIENTS_TABLE
+                )
+                print(f"Пиры применены к {setting['docker_container']} за {time.perf_counter() - apply_started:.1f} с")
+            except Exception as e:
+                print(f"❌ Ошибка применения пиров: {str(e)}")
+        report = consistency_report('.', live_peers(setting))
+    print('\n'.join(report))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Восстановление бота из бэкапа")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help="Каталог с томами и манифестом")
+    source.add_argument('--s3', action='store_true', help="Место доставки s3 из backup_targets")
+    source.add_argument('--snapshot', help="ID локального снимка из backups/ или latest")
+    parser.add_argument('--id', help="ID бэкапа (по умолчанию последний в каталоге)")
+    parser.add_argument('--workers', type=int, default=4, help="Параллельных загрузок и проверок")
+    parser.add_argument('--verify-only', action='store_true', help="Только проверить бэкап и показать расхождения")
+    parser.add_argument('--no-apply', action='store_true', help="Не применять пиры к контейнеру")
+    asyncio.run(main(parser.parse_args()))
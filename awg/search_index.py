@@ -0,0 +1,166 @@
+import bisect
+import heapq
+import logging
+import re
+
+import db
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 50
+TOKEN_SPLIT = re.compile(r'[\s_\-.,;:]+')
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class SearchIndex:
+    """Индекс для поиска клиентов по фрагменту имени, Telegram ID или заметки.
+
+    Сначала ищутся совпадения по префиксам токенов, затем (для фрагментов от 3 символов)
+    вхождения подстроки через пересечение триграмм.
+    Все данные в памяти, обновление точечное при добавлении/удалении клиента.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.trigrams = {}
+        self.tokens = []
+        self.token_owners = {}
+        self.version = None
+
+    def _fields(self, username, telegram_id, note):
+        return [f.lower() for f in (username, str(telegram_id) if telegram_id else '', note or '') if f]
+
+    def add(self, username, telegram_id=None, note=None, _bulk=False):
+        if username in self.docs:
+            self.remove(username)
+        fields = self._fields(username, telegram_id, note)
+        self.docs[username] = (fields, telegram_id, note)
+        for field in fields:
+            for gram in _trigrams(field):
+                self.trigrams.setdefault(gram, set()).add(username)
+            for token in {field, *TOKEN_SPLIT.split(field)}:
+                if not token:
+                    continue
+                owners = self.token_owners.get(token)
+                if owners is None:
+                    owners = self.token_owners[token] = set()
+                    if _bulk:
+                        self.tokens.append(token)
+                    else:
+                        bisect.insort(self.tokens, token)
+                owners.add(username)
+
+    def remove(self, username):
+        doc = self.docs.pop(username, None)
+        if not doc:
+            return
+        for field in doc[0]:
+            for gram in _trigrams(field):
+                owners = self.trigrams.get(gram)
+                if owners:
+                    owners.discard(username)
+                    if not owners:
+                        del self.trigrams[gram]
+            for token in {field, *TOKEN_SPLIT.split(field)}:
+                owners = self.token_owners.get(token)
+                if owners:
+                    owners.discard(username)
+                    if not owners:
+                        del self.token_owners[token]
+                        i = bisect.bisect_left(self.tokens, token)
+                        if i < len(self.tokens) and self.tokens[i] == token:
+                            del self.tokens[i]
+
+    def rebuild(self, usernames, version=None):
+        """Полностью перестраивает индекс по списку имён клиентов."""
+        telegram = db.load_json(db.USER_TELEGRAM_FILE, {})
+        notes = db.get_user_notes()
+        self.docs, self.trigrams, self.tokens, self.token_owners = {}, {}, [], {}
+        for username in usernames:
+            self.add(username, telegram.get(username), notes.get(username), _bulk=True)
+        self.tokens.sort()
+        self.version = version
+        logger.info(f"Поисковый индекс перестроен: {len(self.docs)}")
+
+    def sync(self, user_index):
+        """Перестраивает индекс, если индекс имён клиентов был перестроен с диска.
+
+        Изменения через бота сюда не попадают: их вносят add()/remove(), а version индекса имён
+        меняется только при полной перестройке (клиентов изменили в обход бота).
+        """
+        user_index.refresh()
+        if self.version != user_index.version:
+            self.rebuild(user_index.names, user_index.version)
+
+    def rebuilt(self, user_index):
+        """Новый индекс, если текущий устарел, иначе None. Текущий индекс не меняется,
+        поэтому перестройку можно выполнять в потоке, пока бот ищет по старому."""
+        user_index.refresh()
+        if self.version == user_index.version:
+            return None
+        fresh = SearchIndex()
+        fresh.rebuild(list(user_index.names), user_index.version)
+        return fresh
+
+    def adopt(self, fresh, user_index):
+        """Подменяет данные индекса перестроенными и доносит клиентов, добавленных или
+        удалённых ботом, пока шла перестройка."""
+        self.docs, self.trigrams, self.tokens, self.token_owners = fresh.docs, fresh.trigrams, fresh.tokens, fresh.token_owners
+        self.version = fresh.version
+        names = set(user_index.names)
+        missing = names - self.docs.keys()
+        notes = db.get_user_notes() if missing else {}
+        for username in missing:
+            self.add(username, db.get_user_telegram_id(username), notes.get(username))
+        for username in self.docs.keys() - names:
+            self.remove(username)
+
+    def _prefix_candidates(self, query):
+        candidates = set()
+        i = bisect.bisect_left(self.tokens, query)
+        while i < len(self.tokens) and self.tokens[i].startswith(query):
+            candidates |= self.token_owners[self.tokens[i]]
+            i += 1
+            if len(candidates) > MAX_RESULTS * 20:
+                break
+        return candidates
+
+    def _trigram_candidates(self, query):
+        grams = sorted(_trigrams(query), key=lambda g: len(self.trigrams.get(g, ())))
+        if not grams or grams[0] not in self.trigrams:
+            return set()
+        candidates = set(self.trigrams[grams[0]])
+        for gram in grams[1:]:
+            candidates &= self.trigrams.get(gram, set())
+            if not candidates:
+                break
+        return {u for u in candidates if any(query in field for field in self.docs[u][0])}
+
+    def _rank(self, username, query):
+        name = username.lower()
+        fields = self.docs[username][0]
+        if query in fields:
+            score = 0
+        elif name.startswith(query):
+            score = 1
+        elif any(field.startswith(query) for field in fields):
+            score = 2
+        else:
+            score = 3
+        return (score, len(name), name)
+
+    def search(self, query, limit=MAX_RESULTS):
+        """Возвращает до limit имён клиентов, отсортированных по релевантности."""
+        query = query.strip().lower()
+        if not query:
+            return []
+        # Совпадения по префиксу ранжируются выше, поэтому подстроки ищем, только если их не хватает
+        candidates = self._prefix_candidates(query)
+        if len(candidates) < limit and len(query) >= 3:
+            candidates |= self._trigram_candidates(query)
+        return heapq.nsmallest(limit, candidates, key=lambda u: self._rank(u, query))
+
+    def get(self, username):
+        doc = self.docs.get(username)
+        return (doc[1], doc[2]) if doc else (None, None)
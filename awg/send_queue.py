@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.utils.exceptions import BadRequest, Unauthorized, RetryAfter, NetworkError, TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0
+MAX_CHAT_BUCKETS = 10000
+
+# Ошибки, при которых повторная отправка бессмысленна
+PERMANENT_ERRORS = (BadRequest, Unauthorized)
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """Сколько секунд ждать до появления токена (0 - токен есть)."""
+        now = now if now is not None else time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        """Забирает токен; возвращает 0 при успехе или время ожидания."""
+        wait = self.delay(now)
+        if wait == 0:
+            self.tokens -= 1
+        return wait
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class SendQueue:
+    """Очередь исходящих вызовов Telegram с глобальным и по-чатовым ограничением скорости."""
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, workers=4, max_retries=MAX_RETRIES):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.workers = workers
+        self.max_retries = max_retries
+        self._ready = (deque(), deque())
+        self._delayed = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._tasks = []
+        self._paused_until = 0.0
+        self.stats = {'sent': 0, 'retried': 0, 'dropped': 0, 'flood_waits': 0}
+
+    @property
+    def depth(self):
+        return len(self._ready[0]) + len(self._ready[1]) + len(self._delayed)
+
+    def get_stats(self):
+        """Возвращает счётчики и текущую глубину очереди."""
+        return dict(self.stats, depth=self.depth, depth_interactive=len(self._ready[PRIORITY_INTERACTIVE]),
+                    depth_bulk=len(self._ready[PRIORITY_BULK]), depth_delayed=len(self._delayed))
+
+    def _ensure_workers(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def _push(self, not_before, priority, call, future, attempt):
+        item = (priority, call, future, attempt)
+        if not_before <= time.monotonic():
+            self._ready[priority].append(item)
+        else:
+            heapq.heappush(self._delayed, (not_before, next(self._seq), item))
+        self._wakeup.set()
+
+    def submit(self, chat_id, method, *args, priority=PRIORITY_BULK, **kwargs):
+        """Ставит вызов bot.<method>(*args, **kwargs) в очередь, возвращает Future с результатом."""
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        self._push(0.0, priority, (chat_id, method, args, kwargs), future, 0)
+        return future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_BULK, **kwargs):
+        return self.submit(chat_id, 'send_message', chat_id, text, priority=priority, **kwargs)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_full(now)}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    def _pop_ready(self, now):
+        """Достаёт готовый элемент с наивысшим приоритетом; иначе - время до ближайшего отложенного."""
+        while self._delayed and self._delayed[0][0] <= now:
+            item = heapq.heappop(self._delayed)[2]
+            self._ready[item[0]].append(item)
+        for ready in self._ready:
+            if ready:
+                return ready.popleft(), 0.0
+        return None, (self._delayed[0][0] - now if self._delayed else None)
+
+    async def _worker(self):
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            item, wait = self._pop_ready(now)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            priority, call, future, attempt = item
+            if future.cancelled():
+                continue
+            global_wait = self.global_bucket.delay(now)
+            if global_wait:
+                # Глобальный лимит исчерпан - элемент остаётся первым в своей очереди
+                self._ready[priority].appendleft(item)
+                await asyncio.sleep(global_wait)
+                continue
+            chat_bucket = self._chat_bucket(call[0], now)
+            chat_wait = chat_bucket.take(now)
+            if chat_wait:
+                self._push(now + chat_wait, priority, call, future, attempt)
+                continue
+            self.global_bucket.take(now)
+            await self._execute(priority, call, future, attempt)
+
+    async def _execute(self, priority, call, future, attempt):
+        chat_id, method, args, kwargs = call
+        try:
+            result = await getattr(self.bot, method)(*args, **kwargs)
+            self.stats['sent'] += 1
+            if not future.done():
+                future.set_result(result)
+        except RetryAfter as e:
+            self.stats['flood_waits'] += 1
+            logger.warning(f"Flood control для чата {chat_id}: пауза {e.timeout} с")
+            self._paused_until = time.monotonic() + e.timeout
+            self._push(self._paused_until, priority, call, future, attempt)
+        except PERMANENT_ERRORS as e:
+            self._drop(call, future, e)
+        except (NetworkError, TelegramAPIError, asyncio.TimeoutError) as e:
+            if attempt + 1 >= self.max_retries:
+                self._drop(call, future, e)
+                return
+            self.stats['retried'] += 1
+            backoff = BASE_BACKOFF * (2 ** attempt)
+            self._push(time.monotonic() + backoff, priority, call, future, attempt + 1)
+        except Exception as e:
+            self._drop(call, future, e)
+
+    def _drop(self, call, future, error):
+        self.stats['dropped'] += 1
+        logger.error(f"Сообщение для чата {call[0]} ({call[1]}) отброшено: {str(error)}")
+        if not future.done():
+            future.set_exception(error)
+            # Для фоновых уведомлений результат никто не ждёт
+            future.exception()
@@ -0,0 +1,121 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STATE_DB_FILE = 'files/state.db'
+STATE_TTL = 24 * 60 * 60
+STATE_MAX_SIZE = 10000
+
+class UserState:
+    """Главное сообщение пользователя и состояние ожидания ввода."""
+    __slots__ = ('chat_id', 'message_id', 'state', 'updated')
+
+    def __init__(self, chat_id, message_id, state=None, updated=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.state = state
+        self.updated = updated if updated is not None else time.time()
+
+class StateStore:
+    """Ограниченное (LRU + TTL) хранилище состояний пользователей с опциональной записью в SQLite."""
+
+    def __init__(self, db_path=None, ttl=STATE_TTL, max_size=STATE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._db = None
+        if db_path:
+            self._open(db_path)
+
+    def _open(self, db_path):
+        try:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_state ("
+                "user_id INTEGER PRIMARY KEY, chat_id INTEGER, message_id INTEGER, state TEXT, updated REAL)"
+            )
+            self._db.execute("DELETE FROM user_state WHERE updated < ?", (time.time() - self.ttl,))
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT user_id, chat_id, message_id, state, updated FROM user_state ORDER BY updated DESC LIMIT ?",
+                (self.max_size,)
+            ).fetchall()
+            for user_id, chat_id, message_id, state, updated in reversed(rows):
+                self._items[user_id] = UserState(chat_id, message_id, state, updated)
+            logger.info(f"Загружено состояний пользователей: {len(rows)}")
+        except Exception as e:
+            logger.error(f"Ошибка открытия хранилища состояний {db_path}: {str(e)}")
+            self._db = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def get(self, user_id):
+        """Возвращает UserState или None, если записи нет или она устарела."""
+        record = self._items.get(user_id)
+        if record is None:
+            return None
+        if time.time() - record.updated > self.ttl:
+            self.delete(user_id)
+            return None
+        self._items.move_to_end(user_id)
+        return record
+
+    def get_state(self, user_id):
+        record = self.get(user_id)
+        return record.state if record else None
+
+    def set(self, user_id, chat_id, message_id, state=None):
+        """Запоминает главное сообщение пользователя и его состояние."""
+        record = UserState(chat_id, message_id, state)
+        self._items[user_id] = record
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_size:
+            evicted, _ = self._items.popitem(last=False)
+            self._execute("DELETE FROM user_state WHERE user_id = ?", (evicted,))
+        self._execute(
+            "INSERT OR REPLACE INTO user_state (user_id, chat_id, message_id, state, updated) VALUES (?, ?, ?, ?, ?)",
+            (user_id, chat_id, message_id, state, record.updated)
+        )
+        return record
+
+    def delete(self, user_id):
+        self._items.pop(user_id, None)
+        self._execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    def clear_states(self, predicate):
+        """Сбрасывает ожидание ввода у записей, для состояния которых predicate(state) истинен."""
+        cleared = 0
+        for user_id, record in list(self._items.items()):
+            if record.state and predicate(record.state):
+                self.set(user_id, record.chat_id, record.message_id)
+                cleared += 1
+        return cleared
+
+    def purge_expired(self):
+        """Удаляет устаревшие записи из памяти и базы."""
+        threshold = time.time() - self.ttl
+        expired = [user_id for user_id, record in self._items.items() if record.updated < threshold]
+        for user_id in expired:
+            self._items.pop(user_id, None)
+        self._execute("DELETE FROM user_state WHERE updated < ?", (threshold,))
+        return len(expired)
+
+    def _execute(self, query, params):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(query, params)
+            self._db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи состояния: {str(e)}")
@@ -0,0 +1,261 @@
+import bisect
+import logging
+import os
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+import db
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('1_month', '3_months', '6_months', '12_months')
+NO_PERIOD = -1
+# Значения колонки expires, кроме времени окончания в секундах эпохи
+UNLIMITED = -1   # запись в user_expiration.json без даты
+ABSENT = -2      # записи нет (клиент только привязан к Telegram) или строка свободна
+# Аргумент update(), означающий "оставить как есть"
+KEEP = object()
+
+def to_epoch(value):
+    if value is None:
+        return UNLIMITED
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+def period_code(period):
+    return PERIODS.index(period) if period in PERIODS else NO_PERIOD
+
+class SubscriptionTable:
+    """Подписки в памяти по колонкам: строка на клиента, колонки - массивы array.
+
+    expires и created - секунды эпохи (int64), period - код из PERIODS, owner - Telegram ID.
+    Таблица загружается из user_expiration.json и user_telegram.json один раз и дальше
+    обновляется точечно через update()/remove(); ISO-строки разбираются только при загрузке.
+    Датированные сроки дополнительно лежат в отсортированном индексе, поэтому истёкшие и
+    истекающие подписки выбираются бинарным поиском, а счётчики по колонкам - array.count().
+    Если файлы изменил другой процесс (bot.py, reconcile.py, restore.py), refresh() перечитывает их.
+    """
+
+    def __init__(self, expiration_file=db.USER_EXPIRATION_FILE, telegram_file=db.USER_TELEGRAM_FILE):
+        self.expiration_file = expiration_file
+        self.telegram_file = telegram_file
+        self.names = []
+        self.rows = {}
+        self.expires = array('q')
+        self.period = array('b')
+        self.owner = array('q')
+        self.created = array('q')
+        self._free = []
+        # Отсортированный индекс датированных сроков: _keys[i] - срок строки _order[i]
+        self._keys = array('q')
+        self._order = array('q')
+        # Счётчики поддерживаются при каждом изменении, чтобы stats() не обходил колонки
+        self.total = 0
+        self.unlimited = 0
+        self.with_owner = 0
+        self.period_counts = [0] * len(PERIODS)
+        self._signature = None
+        self.version = 0
+
+    def _files_signature(self):
+        signature = []
+        for path in (self.expiration_file, self.telegram_file):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def load(self):
+        expirations = db.load_json(self.expiration_file, {})
+        telegram = db.load_json(self.telegram_file, {})
+        names = sorted(expirations.keys() | {name for name, owner in telegram.items() if owner})
+        self.names = names
+        self.rows = {name: row for row, name in enumerate(names)}
+        expires, period, owner, created = [], [], [], []
+        for name in names:
+            entry = expirations.get(name)
+            if entry is None:
+                expires.append(ABSENT)
+                period.append(NO_PERIOD)
+                created.append(0)
+            else:
+                try:
+                    expires.append(to_epoch(entry.get('expiration')))
+                except (TypeError, ValueError):
+                    logger.error(f"Неверный срок действия у {name}: {entry.get('expiration')}")
+                    expires.append(UNLIMITED)
+                period.append(period_code(entry.get('period')))
+                created.append(to_epoch(entry['created']) if entry.get('created') else 0)
+            owner.append(int(telegram.get(name) or 0))
+        self.expires = array('q', expires)
+        self.period = array('b', period)
+        self.owner = array('q', owner)
+        self.created = array('q', created)
+        self._free = []
+        pairs = sorted((expiration, row) for row, expiration in enumerate(expires) if expiration >= 0)
+        self._keys = array('q', (expiration for expiration, _ in pairs))
+        self._order = array('q', (row for _, row in pairs))
+        self.total = len(self.expires) - self.expires.count(ABSENT)
+        self.unlimited = self.expires.count(UNLIMITED)
+        self.with_owner = len(self.owner) - self.owner.count(0)
+        self.period_counts = [self.period.count(code) for code in range(len(PERIODS))]
+        self._signature = self._files_signature()
+        self.version += 1
+        logger.info(f"Таблица подписок загружена: {len(self.rows)}")
+        return self
+
+    def refresh(self):
+        """Перечитывает файлы, если их изменили в обход update()/remove()."""
+        if self._signature is None or self._files_signature() != self._signature:
+            self.load()
+
+    def _unindex(self, row):
+        expiration = self.expires[row]
+        if expiration < 0:
+            return
+        i = bisect.bisect_left(self._keys, expiration)
+        while self._order[i] != row:
+            i += 1
+        del self._keys[i]
+        del self._order[i]
+
+    def _index(self, row):
+        expiration = self.expires[row]
+        if expiration >= 0:
+            i = bisect.bisect_right(self._keys, expiration)
+            self._keys.insert(i, expiration)
+            self._order.insert(i, row)
+
+    def _count(self, row, sign):
+        expiration = self.expires[row]
+        if expiration != ABSENT:
+            self.total += sign
+        if expiration == UNLIMITED:
+            self.unlimited += sign
+        if self.owner[row]:
+            self.with_owner += sign
+        if self.period[row] != NO_PERIOD:
+            self.period_counts[self.period[row]] += sign
+
+    def update(self, name, expiration=KEEP, period=KEEP, owner=KEEP, created=KEEP):
+        """Точечно меняет строку клиента (создаёт при необходимости) после записи в db.
+
+        expiration - datetime, ISO-строка или None (без срока); period - ключ PERIODS.
+        Файлы к этому моменту уже изменены самим ботом, поэтому их подпись просто запоминается.
+        """
+        row = self.rows.get(name)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self.names[row] = name
+            else:
+                row = len(self.names)
+                self.names.append(name)
+                self.expires.append(ABSENT)
+                self.period.append(NO_PERIOD)
+                self.owner.append(0)
+                self.created.append(0)
+            self.rows[name] = row
+        else:
+            self._count(row, -1)
+        if expiration is not KEEP:
+            self._unindex(row)
+            self.expires[row] = to_epoch(expiration)
+            self._index(row)
+        if period is not KEEP:
+            self.period[row] = period_code(period)
+        if owner is not KEEP:
+            self.owner[row] = int(owner or 0)
+        if created is not KEEP:
+            self.created[row] = to_epoch(created) if created else 0
+        self._count(row, 1)
+        self._signature = self._files_signature()
+        self.version += 1
+
+    def clear_expiration(self, name):
+        """Срок удалён из user_expiration.json, привязка к Telegram осталась."""
+        row = self.rows.get(name)
+        if row is None:
+            return
+        if not self.owner[row]:
+            self.remove(name)
+            return
+        self._count(row, -1)
+        self._unindex(row)
+        self.expires[row] = ABSENT
+        self.period[row] = NO_PERIOD
+        self.created[row] = 0
+        self._count(row, 1)
+        self._signature = self._files_signature()
+        self.version += 1
+
+    def remove(self, name):
+        """Клиент удалён из обоих файлов; строка освобождается для следующего."""
+        row = self.rows.pop(name, None)
+        if row is not None:
+            self._count(row, -1)
+            self._unindex(row)
+            self.names[row] = None
+            self.expires[row] = ABSENT
+            self.period[row] = NO_PERIOD
+            self.owner[row] = 0
+            self.created[row] = 0
+            self._free.append(row)
+        self._signature = self._files_signature()
+        self.version += 1
+
+    def expires_at(self, name):
+        row = self.rows.get(name)
+        return self.expires[row] if row is not None else ABSENT
+
+    def owner_of(self, name):
+        row = self.rows.get(name)
+        return self.owner[row] if row is not None else 0
+
+    def _range(self, start, end):
+        """Строки со сроком в [start, end) по отсортированному индексу."""
+        return self._order[bisect.bisect_left(self._keys, start):bisect.bisect_left(self._keys, end)]
+
+    def expired(self, now=None):
+        """Имена клиентов с истёкшей подпиской."""
+        self.refresh()
+        now = int((now or datetime.now(pytz.utc)).timestamp())
+        return [self.names[row] for row in self._range(0, now)]
+
+    def expiring(self, now=None, days=7):
+        """(имя, срок в секундах эпохи, Telegram ID) для подписок, истекающих в ближайшие days дней."""
+        self.refresh()
+        now = now or datetime.now(pytz.utc)
+        start = int(now.timestamp())
+        rows = self._range(start, start + days * 86400 + 1)
+        return [(self.names[row], self.expires[row], self.owner[row]) for row in rows]
+
+    def expiring_per_day(self, start=None, days=30):
+        """Число подписок, истекающих в каждый из days дней начиная с полуночи UTC дня start."""
+        self.refresh()
+        start = (start or datetime.now(pytz.utc)).replace(hour=0, minute=0, second=0, microsecond=0)
+        bounds = [bisect.bisect_left(self._keys, int((start + timedelta(days=day)).timestamp()))
+                  for day in range(days + 1)]
+        return [(start + timedelta(days=day), bounds[day + 1] - bounds[day]) for day in range(days)]
+
+    def stats(self, now=None):
+        """Сводка по счётчикам и одному бинарному поиску, без обхода строк."""
+        self.refresh()
+        now = int((now or datetime.now(pytz.utc)).timestamp())
+        expired = bisect.bisect_left(self._keys, now)
+        return {
+            'total': self.total,
+            'active': self.total - expired,
+            'expired': expired,
+            'unlimited': self.unlimited,
+            'by_period': dict(zip(PERIODS, self.period_counts)),
+            'with_owner': self.with_owner
+        }
+
+    def __len__(self):
+        return len(self.rows)
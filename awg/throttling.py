@@ -0,0 +1,159 @@
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from send_queue import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты по действиям: (запросов в минуту, допустимый всплеск)
+DEFAULT_LIMITS = {
+    'default': (60, 10),
+    'waiting_for_promocode': (6, 3),
+    'use_promocode': (20, 5),
+    'buy_key': (20, 5),
+    'find': (30, 5)
+}
+# Множитель лимита по роли; None - без ограничений
+DEFAULT_ROLE_MULTIPLIERS = {'admin': None, 'moderator': 3, 'user': 1}
+
+MAX_BUCKETS = 50000
+VIOLATIONS_TO_BAN = 10
+VIOLATION_WINDOW = 60
+BAN_BASE = 60
+BAN_MAX = 3600
+BAN_FORGET = 86400
+NOTICE_INTERVAL = 10
+
+class Offender:
+    __slots__ = ('violations', 'window_start', 'banned_until', 'bans', 'last_ban', 'last_notice')
+
+    def __init__(self, now):
+        self.violations = 0
+        self.window_start = now
+        self.banned_until = 0.0
+        self.bans = 0
+        self.last_ban = 0.0
+        self.last_notice = 0.0
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты запросов пользователя по каждому действию (token bucket).
+
+    classify(event) возвращает имя действия (или None, если событие не ограничивается),
+    role_of(user_id) - роль пользователя. Частые нарушения приводят к временной блокировке,
+    длительность которой удваивается с каждой следующей блокировкой.
+    """
+
+    def __init__(self, classify, role_of, limits=None, role_multipliers=None, max_buckets=MAX_BUCKETS):
+        super().__init__()
+        self.classify = classify
+        self.role_of = role_of
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.configure(limits, role_multipliers)
+        self.offenders = OrderedDict()
+        self.stats = {'allowed': 0, 'throttled': 0, 'bans': 0, 'banned_dropped': 0}
+        self.throttled_actions = Counter()
+
+    def configure(self, limits=None, role_multipliers=None):
+        """Задаёт лимиты; накопленные ведра сбрасываются, чтобы новые лимиты применились сразу."""
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.role_multipliers = {**DEFAULT_ROLE_MULTIPLIERS, **(role_multipliers or {})}
+        self.buckets.clear()
+
+    def _bucket(self, user_id, action, multiplier):
+        key = (user_id, action)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            per_minute, burst = self.limits.get(action, self.limits['default'])
+            bucket = self.buckets[key] = TokenBucket(per_minute * multiplier / 60, burst * multiplier)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def _offender(self, user_id, now):
+        offender = self.offenders.get(user_id)
+        if offender is None:
+            offender = self.offenders[user_id] = Offender(now)
+            if len(self.offenders) > self.max_buckets:
+                self.offenders.popitem(last=False)
+        else:
+            self.offenders.move_to_end(user_id)
+        return offender
+
+    def _register_violation(self, offender, user_id, now):
+        if now - offender.window_start > VIOLATION_WINDOW:
+            offender.window_start = now
+            offender.violations = 0
+        offender.violations += 1
+        if offender.violations < VIOLATIONS_TO_BAN:
+            return False
+        if now - offender.last_ban > BAN_FORGET:
+            offender.bans = 0
+        duration = min(BAN_BASE * 2 ** offender.bans, BAN_MAX)
+        offender.bans += 1
+        offender.last_ban = now
+        offender.banned_until = now + duration
+        offender.violations = 0
+        self.stats['bans'] += 1
+        logger.warning(f"Пользователь {user_id} временно заблокирован за флуд на {duration} с")
+        return True
+
+    async def _notify(self, event, text):
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text, show_alert=False)
+            else:
+                await event.reply(text)
+        except Exception:
+            pass
+
+    async def _check(self, event):
+        user_id = event.from_user.id
+        multiplier = self.role_multipliers.get(self.role_of(user_id), 1)
+        if multiplier is None:
+            return
+        action = self.classify(event)
+        if action is None:
+            return
+        now = time.monotonic()
+        offender = self.offenders.get(user_id)
+        if offender and offender.banned_until > now:
+            self.stats['banned_dropped'] += 1
+            raise CancelHandler()
+        if self._bucket(user_id, action, multiplier).take(now) == 0:
+            self.stats['allowed'] += 1
+            return
+        self.stats['throttled'] += 1
+        self.throttled_actions[action] += 1
+        offender = offender or self._offender(user_id, now)
+        banned = self._register_violation(offender, user_id, now)
+        # Предупреждаем не на каждый отброшенный запрос, чтобы не флудить в ответ
+        if banned or now - offender.last_notice >= NOTICE_INTERVAL:
+            offender.last_notice = now
+            if banned:
+                await self._notify(event, f"Слишком много запросов. Попробуйте через {int(offender.banned_until - now)} с.")
+            else:
+                await self._notify(event, "Слишком часто, подождите немного.")
+        raise CancelHandler()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self._check(message)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        await self._check(callback_query)
+
+    def get_stats(self):
+        now = time.monotonic()
+        return {
+            **self.stats,
+            'buckets': len(self.buckets),
+            'banned_now': sum(1 for o in self.offenders.values() if o.banned_until > now),
+            'throttled_actions': dict(self.throttled_actions)
+        }
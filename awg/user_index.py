@@ -0,0 +1,133 @@
+import bisect
+import logging
+import os
+from datetime import datetime
+
+import pytz
+
+import db
+from subscriptions import SubscriptionTable
+
+logger = logging.getLogger(__name__)
+
+USERS_DIR = 'users'
+PAGE_SIZE = 20
+
+FILTERS = {
+    'all': "Все",
+    'online': "🟢 Онлайн",
+    'week': "⏰ Истекают за неделю"
+}
+
+class UserIndex:
+    """Отсортированный индекс имён клиентов для постраничного вывода.
+
+    Индекс обновляется точечно при добавлении/удалении через бота и перестраивается целиком,
+    только если каталог users/ изменился извне (например, клиента добавил newclient.sh вручную).
+    """
+
+    def __init__(self, users_dir=USERS_DIR, subscriptions=None):
+        self.users_dir = users_dir
+        self.subscriptions = subscriptions
+        self.names = []
+        self._mtime = None
+        self.version = 0
+
+    def _users_mtime(self):
+        try:
+            return os.stat(self.users_dir).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def rebuild(self):
+        names = []
+        if os.path.exists(self.users_dir):
+            for entry in os.scandir(self.users_dir):
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, f"{entry.name}.conf")):
+                    names.append(entry.name)
+        names.sort()
+        self.names = names
+        self._mtime = self._users_mtime()
+        self.version += 1
+        logger.info(f"Индекс клиентов перестроен: {len(names)}")
+
+    def refresh(self):
+        """Перестраивает индекс, если каталог users/ изменился."""
+        if self._mtime is None or self._users_mtime() != self._mtime:
+            self.rebuild()
+
+    def add(self, username):
+        """Клиент добавлен ботом. mtime users/ уже изменил newclient.sh, поэтому refresh() здесь
+        перестроил бы индекс целиком: имя вставляется на место, а новый mtime просто запоминается."""
+        if self._mtime is None:
+            self.rebuild()
+            return
+        i = bisect.bisect_left(self.names, username)
+        if i == len(self.names) or self.names[i] != username:
+            self.names.insert(i, username)
+        self._mtime = self._users_mtime()
+
+    def remove(self, username):
+        """Клиент удалён ботом; как и add(), без полной перестройки."""
+        if self._mtime is None:
+            self.rebuild()
+            return
+        i = bisect.bisect_left(self.names, username)
+        if i < len(self.names) and self.names[i] == username:
+            del self.names[i]
+        self._mtime = self._users_mtime()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.names)
+
+    def _make_predicate(self, filter_name):
+        if filter_name == 'online':
+            return lambda name: db.is_online(db.get_last_handshake(name))
+        if filter_name == 'week':
+            expiring = {name for name, _, _ in self._subscriptions().expiring(datetime.now(pytz.utc), 7)}
+            return expiring.__contains__
+        if filter_name.startswith('u') and filter_name[1:].isdigit():
+            owner = int(filter_name[1:])
+            subscriptions = self._subscriptions()
+            subscriptions.refresh()
+            return lambda name: subscriptions.owner_of(name) == owner
+        return None
+
+    def _subscriptions(self):
+        if self.subscriptions is None:
+            return SubscriptionTable()
+        return self.subscriptions
+
+    def page(self, filter_name='all', direction='a', cursor='', page_size=PAGE_SIZE):
+        """Возвращает (имена страницы, курсор назад или None, курсор вперёд или None).
+
+        direction 'a' - страница после cursor, 'b' - страница перед cursor.
+        Фильтр проверяется только для просмотренных имён, пока страница не заполнится;
+        кнопки навигации показываются, если за границей страницы остались имена.
+        """
+        self.refresh()
+        names = self.names
+        predicate = self._make_predicate(filter_name)
+        page = []
+        if direction == 'b':
+            end = bisect.bisect_left(names, cursor)
+            i = end - 1
+            while i >= 0 and len(page) < page_size:
+                if predicate is None or predicate(names[i]):
+                    page.append(names[i])
+                i -= 1
+            page.reverse()
+            has_prev, has_next = i >= 0, end < len(names)
+        else:
+            start = bisect.bisect_right(names, cursor) if cursor else 0
+            i = start
+            while i < len(names) and len(page) < page_size:
+                if predicate is None or predicate(names[i]):
+                    page.append(names[i])
+                i += 1
+            has_prev, has_next = start > 0, i < len(names)
+        # Курсоры - граничные имена просмотренного диапазона, а не только совпавшие с фильтром
+        prev_cursor = (page[0] if page else cursor) if has_prev else None
+        next_cursor = (page[-1] if page else cursor) if has_next else None
+        return page, prev_cursor, next_cursor
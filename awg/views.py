@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from aiogram.utils.exceptions import MessageNotModified, MessageCantBeEdited, MessageToEditNotFound, BadRequest
+
+logger = logging.getLogger(__name__)
+
+MAX_TRACKED_MESSAGES = 10000
+# Ошибка редактирования сообщения с документом или фото; отдельного класса в aiogram нет
+NO_TEXT_TO_EDIT = "there is no text in the message to edit"
+
+# (chat_id, message_id) -> (хэш текста, хэш клавиатуры) последнего отрисованного состояния
+_rendered = OrderedDict()
+
+def _digest(value):
+    return hashlib.sha1(value.encode()).hexdigest()
+
+def _markup_digest(reply_markup):
+    if reply_markup is None:
+        return None
+    return _digest(json.dumps(reply_markup.to_python(), sort_keys=True, ensure_ascii=False))
+
+def _remember(chat_id, message_id, text_hash, markup_hash):
+    key = (chat_id, message_id)
+    _rendered[key] = (text_hash, markup_hash)
+    _rendered.move_to_end(key)
+    while len(_rendered) > MAX_TRACKED_MESSAGES:
+        _rendered.popitem(last=False)
+
+def forget(chat_id, message_id):
+    _rendered.pop((chat_id, message_id), None)
+
+async def show(bot, chat_id, message_id, text, reply_markup=None, parse_mode=None):
+    """Показывает экран в существующем сообщении, редактируя его вместо удаления и отправки.
+
+    Если текст и клавиатура не изменились, запрос к API не выполняется. Если сообщение
+    нельзя отредактировать (удалено, это документ, слишком старое), отправляется новое.
+    Прочие ошибки BadRequest (например, разбора Markdown) пробрасываются, а исходное
+    сообщение остаётся на месте: новое с тем же текстом всё равно не отправилось бы.
+    Возвращает (chat_id, message_id) сообщения, в котором теперь показан экран.
+    """
+    text_hash = _digest(f"{parse_mode}:{text}")
+    markup_hash = _markup_digest(reply_markup)
+    previous = _rendered.get((chat_id, message_id)) if message_id else None
+    if previous == (text_hash, markup_hash):
+        return chat_id, message_id
+    if message_id:
+        try:
+            if previous and previous[0] == text_hash:
+                await bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+            else:
+                await bot.edit_message_text(text, chat_id, message_id, parse_mode=parse_mode, reply_markup=reply_markup)
+            _remember(chat_id, message_id, text_hash, markup_hash)
+            return chat_id, message_id
+        except MessageNotModified:
+            _remember(chat_id, message_id, text_hash, markup_hash)
+            return chat_id, message_id
+        except BadRequest as e:
+            if not isinstance(e, (MessageCantBeEdited, MessageToEditNotFound)) and NO_TEXT_TO_EDIT not in str(e).lower():
+                logger.error(f"Ошибка редактирования сообщения {message_id}: {str(e)}")
+                raise
+            logger.debug(f"Сообщение {message_id} нельзя отредактировать, отправляем новое: {str(e)}")
+            forget(chat_id, message_id)
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except Exception:
+                pass
+    sent_message = await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    _remember(sent_message.chat.id, sent_message.message_id, text_hash, markup_hash)
+    return sent_message.chat.id, sent_message.message_id
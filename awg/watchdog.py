@@ -0,0 +1,197 @@
+"""Диагностика зависаний event loop и профилирование без внешних зависимостей.
+
+LoopWatchdog раз в interval секунд отмечается из event loop, а отдельный поток следит
+за отметками: если loop не отвечает дольше threshold, поток снимает стек потока loop
+и запоминает, какое обновление обрабатывала текущая задача. sample_profile и
+memory_report строят текстовые отчёты, которые бот отправляет админам файлом.
+"""
+import asyncio
+import io
+import linecache
+import logging
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import weakref
+from collections import Counter, deque
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LAG_THRESHOLD = 0.5
+CHECK_INTERVAL = 0.1
+MAX_STALLS = 20
+PROFILE_INTERVAL = 0.005
+
+loop_lag = metrics.histogram(
+    'awg_loop_lag_seconds', "Задержка event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+loop_stalls = metrics.counter('awg_loop_stalls_total', "Зависания event loop дольше порога")
+
+# Задача -> описание того, что она сейчас обрабатывает
+_task_labels = weakref.WeakKeyDictionary()
+
+def set_task_label(label):
+    """Подписывает текущую задачу (например, обрабатываемым обновлением) для отчётов о зависаниях."""
+    task = asyncio.current_task()
+    if task is not None:
+        _task_labels[task] = label
+
+def _running_task(loop):
+    # Чтение из другого потока: словарь только читается, в худшем случае получим None
+    try:
+        return asyncio.tasks._current_tasks.get(loop)
+    except Exception:
+        return None
+
+class Stall:
+    __slots__ = ('started', 'duration', 'stack', 'label')
+
+    def __init__(self, started, stack, label):
+        self.started = started
+        self.duration = 0.0
+        self.stack = stack
+        self.label = label
+
+class LoopWatchdog:
+    def __init__(self, threshold=LAG_THRESHOLD, interval=CHECK_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=MAX_STALLS)
+        self.max_lag = 0.0
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self._beat = now
+
+    def _monitor(self):
+        current = None
+        while not self._stop.wait(self.interval):
+            silent = time.monotonic() - self._beat
+            if silent < self.threshold:
+                if current is not None:
+                    logger.warning(
+                        f"Event loop был заблокирован {current.duration:.2f} с"
+                        + (f" ({current.label})" if current.label else "")
+                        + f":\n{''.join(current.stack[-8:])}"
+                    )
+                    current = None
+                continue
+            if current is None:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = traceback.format_stack(frame) if frame else []
+                task = _running_task(self._loop)
+                try:
+                    label = _task_labels.get(task) if task is not None else None
+                except Exception:
+                    label = None
+                current = Stall(datetime.now(), stack, label or (task.get_name() if task else None))
+                self.stalls.append(current)
+                loop_stalls.inc()
+            current.duration = silent
+
+    def report(self):
+        """Текстовый отчёт о последних зависаниях со стеками."""
+        lines = [f"Порог: {self.threshold} с, максимальная задержка: {self.max_lag:.3f} с, зависаний: {len(self.stalls)}", ""]
+        for stall in reversed(self.stalls):
+            lines.append(f"=== {stall.started:%Y-%m-%d %H:%M:%S} · {stall.duration:.2f} с · {stall.label or 'неизвестно'}")
+            lines.extend(line.rstrip('\n') for line in stall.stack)
+            lines.append("")
+        return '\n'.join(lines)
+
+    def sample_profile(self, duration, interval=PROFILE_INTERVAL):
+        """Семплирующий профилировщик потока event loop; вызывать из другого потока.
+
+        Возвращает отчёт: самые частые функции и стеки в формате flamegraph (folded).
+        """
+        stacks = Counter()
+        functions = Counter()
+        samples = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                names, seen = [], set()
+                while frame is not None:
+                    code = frame.f_code
+                    filename = code.co_filename.rsplit('/', 1)[-1]
+                    names.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                    seen.add(f"{code.co_name} ({filename})")
+                    frame = frame.f_back
+                names.reverse()
+                stacks[';'.join(names)] += 1
+                for name in seen:
+                    functions[name] += 1
+                samples += 1
+            time.sleep(interval)
+        out = io.StringIO()
+        out.write(f"Семплов: {samples} за {duration} с (интервал {interval * 1000:.0f} мс)\n\n")
+        out.write("Функции по доле семплов (включая вложенные вызовы):\n")
+        for name, count in functions.most_common(40):
+            out.write(f"{count / max(samples, 1) * 100:6.1f}%  {name}\n")
+        out.write("\nСтеки (folded, для flamegraph.pl / speedscope):\n")
+        for stack, count in stacks.most_common():
+            out.write(f"{stack} {count}\n")
+        return out.getvalue()
+
+def memory_report(duration, limit=30):
+    """Снимки tracemalloc в начале и конце интервала: где выросло потребление памяти."""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(10)
+    try:
+        own_frames = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(own_frames)
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot().filter_traces(own_frames)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    out = io.StringIO()
+    out.write(f"Отслеживается: {current / 1024 / 1024:.1f} МБ, пик: {peak / 1024 / 1024:.1f} МБ\n\n")
+    out.write(f"Рост за {duration} с:\n")
+    for stat in after.compare_to(before, 'lineno')[:limit]:
+        frame = stat.traceback[0]
+        out.write(f"{stat.size_diff / 1024:+10.1f} КБ {stat.count_diff:+7d}  {frame.filename}:{frame.lineno}\n")
+        line = linecache.getline(frame.filename, frame.lineno).strip()
+        if line:
+            out.write(f"{'':30}{line}\n")
+    out.write("\nКрупнейшие места выделения:\n")
+    for stat in after.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        out.write(f"{stat.size / 1024:10.1f} КБ {stat.count:7d}  {frame.filename}:{frame.lineno}\n")
+    return out.getvalue()
@@ -0,0 +1,182 @@
+import hmac
+import json
+import logging
+import os
+import secrets
+
+from aiohttp import web
+
+from lanes import LaneDispatcher, DEFAULT_LANES, DEFAULT_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+DEFAULT_PATH = '/webhook'
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8443
+DRAIN_TIMEOUT = 30
+SPOOL_COMPACT_THRESHOLD = 1000
+
+class UpdateSpool:
+    """Журнал входящих обновлений: запись до ответа Telegram, отметка после обработки.
+
+    При запуске необработанные обновления из журнала выполняются повторно.
+    """
+
+    def __init__(self, spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+        self.updates_path = os.path.join(spool_dir, 'updates.jsonl')
+        self.done_path = os.path.join(spool_dir, 'processed.txt')
+        self._updates = open(self.updates_path, 'a')
+        self._done = open(self.done_path, 'a')
+        self.written = 0
+
+    def pending(self):
+        """Возвращает необработанные обновления из прошлого запуска."""
+        done = set()
+        if os.path.exists(self.done_path):
+            with open(self.done_path) as f:
+                done = {line.strip() for line in f if line.strip()}
+        pending = []
+        with open(self.updates_path) as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                if str(data.get('update_id')) not in done:
+                    pending.append(data)
+        return pending
+
+    def append(self, data):
+        self._updates.write(json.dumps(data, ensure_ascii=False) + '\n')
+        self._updates.flush()
+        self.written += 1
+
+    def mark_done(self, update_id):
+        self._done.write(f"{update_id}\n")
+        self._done.flush()
+
+    def compact(self):
+        """Очищает журнал, когда все записанные обновления обработаны."""
+        for handle in (self._updates, self._done):
+            handle.seek(0)
+            handle.truncate()
+        self.written = 0
+
+    def close(self):
+        self._updates.close()
+        self._done.close()
+
+class WebhookServer:
+    """Приём обновлений Telegram через aiohttp вместо long polling.
+
+    Адрес webhook публичный, поэтому запросы без верного секретного заголовка отклоняются всегда:
+    иначе кто угодно мог бы прислать поддельное обновление, например нажатие кнопки админа.
+    """
+
+    def __init__(self, dp, path=DEFAULT_PATH, secret_token=None, lanes=DEFAULT_LANES,
+                 queue_size=DEFAULT_QUEUE_SIZE, spool_dir=None, drain_timeout=DRAIN_TIMEOUT, dispatcher=None):
+        if not secret_token:
+            raise ValueError("Для webhook нужен секретный токен (webhook_secret)")
+        self.dp = dp
+        self.path = path
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        self.spool = UpdateSpool(spool_dir) if spool_dir else None
+        self.lanes = dispatcher or LaneDispatcher(dp, lanes=lanes, queue_size=queue_size)
+        self.lanes.on_done = self._on_done
+        self.accepting = False
+        self.stats = {'received': 0, 'rejected': 0, 'replayed': 0}
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            self.stats['rejected'] += 1
+            return web.Response(status=401)
+        if not self.accepting:
+            # Во время остановки Telegram повторит доставку позже
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        self.stats['received'] += 1
+        if self.spool:
+            self.spool.append(data)
+        # При переполнении очереди пользователя ответ задерживается, и Telegram сам снижает темп доставки
+        await self.lanes.submit(data)
+        return web.Response(status=200)
+
+    def _on_done(self, update):
+        if self.spool:
+            self.spool.mark_done(update.update_id)
+            if not self.lanes.pending() and self.spool.written >= SPOOL_COMPACT_THRESHOLD:
+                self.spool.compact()
+
+    def get_stats(self):
+        return {**self.stats, **self.lanes.get_stats()}
+
+    async def _on_startup(self, app):
+        self.lanes.start()
+        if self.spool:
+            pending = self.spool.pending()
+            self.spool.compact()
+            for data in pending:
+                self.spool.append(data)
+                await self.lanes.submit(data)
+            self.stats['replayed'] = len(pending)
+            if pending:
+                logger.info(f"Повторная обработка обновлений из журнала: {len(pending)}")
+        self.accepting = True
+
+    async def _on_shutdown(self, app):
+        self.accepting = False
+        if not await self.lanes.stop(timeout=self.drain_timeout):
+            logger.warning(f"Не дождались обработки {self.lanes.pending()} обновлений, они останутся в журнале")
+        if self.spool:
+            self.spool.close()
+
+def run(dp, setting, on_startup=None, on_shutdown=None, dispatcher=None):
+    """Запускает бота в режиме webhook по параметрам из config.json."""
+    path = setting.get('webhook_path', DEFAULT_PATH)
+    secret_token = setting.get('webhook_secret')
+    if not secret_token:
+        # Токен передаётся Telegram в set_webhook, поэтому случайного на время запуска достаточно
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("webhook_secret не задан, используется случайный секретный токен")
+    server = WebhookServer(
+        dp,
+        path=path,
+        secret_token=secret_token,
+        lanes=int(setting.get('update_lanes', DEFAULT_LANES)),
+        queue_size=int(setting.get('update_lane_queue', DEFAULT_QUEUE_SIZE)),
+        spool_dir=setting.get('webhook_spool'),
+        dispatcher=dispatcher
+    )
+    app = server.make_app()
+
+    async def register_webhook(app):
+        await dp.bot.set_webhook(setting['webhook_url'], secret_token=secret_token)
+        if on_startup:
+            await on_startup(dp)
+
+    async def close_bot(app):
+        if on_shutdown:
+            await on_shutdown(dp)
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(register_webhook)
+    app.on_cleanup.append(close_bot)
+    web.run_app(
+        app,
+        host=setting.get('webhook_host', DEFAULT_HOST),
+        port=int(setting.get('webhook_port', DEFAULT_PORT))
+    )
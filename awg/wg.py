@@ -47,3 +47,112 @@ def add_peer(public_key, ip_address):
     with open(conf_path, "a") as f:
         f.write(f"\n[Peer]\nPublicKey = {public_key}\nAllowedIPs = {ip_address}/32\n")
     subprocess.run(["docker", "exec", "amnezia-awg", "wg", "syncconf", "wg0", "/config/wg0.conf"])
+
+CLIENTS_TABLE_PATH = "/opt/amnezia/awg/clientsTable"
+
+class Peer:
+    __slots__ = ('public_key', 'preshared_key', 'allowed_ips', 'name')
+
+    def __init__(self, public_key, preshared_key=None, allowed_ips='', name=None):
+        self.public_key = public_key
+        self.preshared_key = preshared_key
+        self.allowed_ips = allowed_ips
+        self.name = name
+
+def parse_server_config(text):
+    """Пиры из конфигурации сервера (files/server.conf): {публичный ключ: Peer}.
+
+    Имя клиента берётся из комментария "# имя", который пишет newclient.sh.
+    """
+    peers = {}
+    peer = None
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if line.startswith('['):
+            peer = Peer(None) if line == '[Peer]' else None
+            continue
+        if peer is None or not line:
+            continue
+        if line.startswith('#'):
+            peer.name = peer.name or line.lstrip('#').strip()
+            continue
+        key, _, value = line.partition('=')
+        key, value = key.strip(), value.strip()
+        if key == 'PublicKey':
+            peer.public_key = value
+            peers[value] = peer
+        elif key == 'PresharedKey':
+            peer.preshared_key = value
+        elif key == 'AllowedIPs':
+            peer.allowed_ips = ','.join(ip.strip() for ip in value.split(','))
+    return peers
+
+def parse_dump(text):
+    """Пиры живого интерфейса из `wg show <интерфейс> dump`: {публичный ключ: Peer}."""
+    peers = {}
+    for line in text.splitlines()[1:]:
+        fields = line.split('\t')
+        if len(fields) >= 4:
+            preshared_key = fields[1] if fields[1] != '(none)' else None
+            allowed_ips = fields[3] if fields[3] != '(none)' else ''
+            peers[fields[0]] = Peer(fields[0], preshared_key, allowed_ips)
+    return peers
+
+def interface_name(wg_config_file):
+    return os.path.splitext(os.path.basename(wg_config_file))[0]
+
+def read_live_peers(docker_container, wg_config_file):
+    """Пиры, реально загруженные в интерфейс внутри контейнера."""
+    output = subprocess.run(
+        ["docker", "exec", "-i", docker_container, "wg", "show", interface_name(wg_config_file), "dump"],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return parse_dump(output)
+
+def apply_server_config(docker_container, wg_config_file, server_conf_path, clients_table_path=None):
+    """Загружает конфигурацию сервера со всеми пирами в контейнер и применяет её одним syncconf.
+
+    В отличие от wg-quick down/up в newclient.sh, syncconf не разрывает соединения пиров,
+    которые не изменились.
+    """
+    subprocess.run(["docker", "cp", server_conf_path, f"{docker_container}:{wg_config_file}"], check=True)
+    if clients_table_path and os.path.exists(clients_table_path):
+        subprocess.run(["docker", "cp", clients_table_path, f"{docker_container}:{CLIENTS_TABLE_PATH}"], check=True)
+    stripped = f"/tmp/{interface_name(wg_config_file)}.stripped"
+    subprocess.run(
+        ["docker", "exec", "-i", docker_container, "sh", "-c",
+         f"wg-quick strip '{wg_config_file}' > '{stripped}' && "
+         f"wg syncconf '{interface_name(wg_config_file)}' '{stripped}' && rm -f '{stripped}'"],
+        capture_output=True, text=True, check=True
+    )
+
+def diff_peers(expected, live):
+    """Расхождения между ожидаемыми и живыми пирами: (нет в интерфейсе, лишние, другие AllowedIPs)."""
+    missing = [expected[key] for key in expected.keys() - live.keys()]
+    extra = [live[key] for key in live.keys() - expected.keys()]
+    changed = [
+        (expected[key], live[key]) for key in expected.keys() & live.keys()
+        if set(expected[key].allowed_ips.split(',')) != set(live[key].allowed_ips.split(','))
+    ]
+    return missing, extra, changed
+
+def remove_peers(text, public_keys):
+    """Конфигурация сервера без блоков [Peer] с указанными публичными ключами (за один проход)."""
+    kept, block = [], []
+
+    def flush():
+        if not block:
+            return
+        is_peer = block[0].strip() == '[Peer]'
+        key = next((line.partition('=')[2].strip() for line in block
+                    if line.strip().startswith('PublicKey') and '=' in line), None)
+        if not (is_peer and key in public_keys):
+            kept.extend(block)
+        block.clear()
+
+    for line in text.splitlines(keepends=True):
+        if line.strip().startswith('['):
+            flush()
+        block.append(line)
+    flush()
+    return ''.join(kept)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бота лежат плоско в awg/ и импортируются по имени, как при запуске из этого каталога
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awg'))
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import backup
+from backup import BackupStore
+
+AWG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awg')
+
+def _rotate_in_other_process(root):
+    """rotate() из отдельного процесса, как у bot.py и bot_manager.py с общим backups/."""
+    return subprocess.Popen(
+        [sys.executable, '-c', f"import backup; backup.BackupStore({root!r}, keep_last=1, keep_daily=0).rotate()"],
+        cwd=os.getcwd(), env={**os.environ, 'PYTHONPATH': AWG_DIR}
+    )
+
+def test_rotate_waits_for_snapshot_in_progress(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backup, 'PROGRESS_EVERY', 1)
+    os.makedirs('files')
+    for i in range(3):
+        with open(os.path.join('files', f"{i}.json"), 'w') as f:
+            f.write(f"{{\"n\": {i}}}")
+    root = str(tmp_path / 'backups')
+    store = BackupStore(root, sources=('files',), keep_last=1, keep_daily=0)
+    store.snapshot()
+    with open(os.path.join('files', '0.json'), 'w') as f:
+        f.write('{"n": "changed"}')
+
+    rotations = []
+
+    def progress(count):
+        # Объект нового содержимого уже записан, а манифест ещё нет
+        if not rotations:
+            rotations.append(_rotate_in_other_process(root))
+            try:
+                rotations[0].wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                pass
+            assert rotations[0].poll() is None, "rotate() не дождался окончания снимка"
+
+    manifest = store.snapshot(progress)
+    assert rotations[0].wait(timeout=30) == 0
+    assert store.list_snapshots() == [manifest['id']]
+    for entry in manifest['files'].values():
+        assert os.path.exists(store._object_path(entry['hash']))
+
+def test_rotate_keeps_objects_of_remaining_snapshots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('files')
+    store = BackupStore(str(tmp_path / 'backups'), sources=('files',), keep_last=1, keep_daily=0)
+    with open(os.path.join('files', 'a.json'), 'w') as f:
+        f.write('1')
+    first = store.snapshot()
+    with open(os.path.join('files', 'a.json'), 'w') as f:
+        f.write('22')
+    second = store.snapshot()
+    removed, freed = store.rotate()
+    assert removed == [first['id']] and freed > 0
+    assert os.path.exists(store._object_path(second['files']['files/a.json']['hash']))
+    assert not os.path.exists(store._object_path(first['files']['files/a.json']['hash']))
@@ -0,0 +1,47 @@
+import asyncio
+import os
+
+import pytest
+
+import backup_targets
+from backup_targets import S3Target
+from fake_s3 import FakeS3
+
+async def _with_s3(root, scenario):
+    s3 = await FakeS3(root, access_key='KEY', secret_key='SECRET').start()
+    try:
+        target = S3Target(s3.endpoint, 'awg', 'KEY', 'SECRET', prefix='bot/')
+        return await scenario(target)
+    finally:
+        await s3.stop()
+
+def test_roundtrip_with_relative_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'volume.zip').write_bytes(b'data' * 1000)
+
+    async def scenario(target):
+        await target.put('20250101-120000', 'volume.zip', 'volume.zip')
+        await target.get('20250101-120000', 'volume.zip', 'restored.zip')
+
+    asyncio.run(_with_s3('s3data', scenario))
+    assert (tmp_path / 'restored.zip').read_bytes() == b'data' * 1000
+    assert (tmp_path / 's3data' / 'awg' / 'bot' / '20250101-120000' / 'volume.zip').exists()
+
+def test_failed_download_leaves_no_temp_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'volume.zip').write_bytes(b'data')
+
+    def failing_replace(src, dst):
+        raise OSError("диск заполнен")
+
+    async def scenario(target):
+        await target.put('1', 'volume.zip', 'volume.zip')
+        monkeypatch.setattr(backup_targets.os, 'replace', failing_replace)
+        with pytest.raises(OSError):
+            await target.get('1', 'volume.zip', str(tmp_path / 'restored.zip'))
+        with pytest.raises(OSError):
+            await target.get('1', 'missing.zip', str(tmp_path / 'missing.zip'))
+
+    asyncio.run(_with_s3('s3data', scenario))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    assert not (tmp_path / 'restored.zip').exists()
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import WebhookServer, SECRET_HEADER
+
+SECRET = 'test-secret'
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hi'}}
+
+class FakeLanes:
+    """Очереди обновлений без aiogram: запоминают принятые обновления."""
+
+    def __init__(self):
+        self.on_done = None
+        self.submitted = []
+
+    def start(self):
+        pass
+
+    async def stop(self, timeout=None):
+        return True
+
+    async def submit(self, data):
+        self.submitted.append(data)
+
+    def pending(self):
+        return 0
+
+    def get_stats(self):
+        return {}
+
+async def _post(server, headers, accepting=True):
+    client = TestClient(TestServer(server.make_app()))
+    await client.start_server()
+    try:
+        server.accepting = accepting
+        response = await client.post(server.path, json=UPDATE, headers=headers)
+        return response.status
+    finally:
+        await client.close()
+
+def _server():
+    return WebhookServer(None, secret_token=SECRET, dispatcher=FakeLanes())
+
+def test_rejects_missing_secret():
+    server = _server()
+    assert asyncio.run(_post(server, {})) == 401
+    assert server.lanes.submitted == [] and server.stats['rejected'] == 1
+
+def test_rejects_wrong_secret():
+    server = _server()
+    assert asyncio.run(_post(server, {SECRET_HEADER: 'forged'})) == 401
+    assert server.lanes.submitted == []
+
+def test_accepts_valid_secret():
+    server = _server()
+    assert asyncio.run(_post(server, {SECRET_HEADER: SECRET})) == 200
+    assert server.lanes.submitted == [UPDATE]
+
+def test_unavailable_while_draining():
+    server = _server()
+    assert asyncio.run(_post(server, {SECRET_HEADER: SECRET}, accepting=False)) == 503
+    assert server.lanes.submitted == []
+
+def test_secret_is_required():
+    with pytest.raises(ValueError):
+        WebhookServer(None, dispatcher=FakeLanes())